@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
 """
-NMEA driver for a sounder and a GPS. Output is written to specified file
-in json format. Uses nmea_templates.py to specify sentence format and
-a mandatory config file with three mandatory sections documented in the
-documentation files. Should be run with permissions to read and write to
+NMEA driver for any number of serial devices, by default a sounder and a
+GPS. Output is written to specified file in json format. Uses
+nmea_templates.py, optionally extended from the config file, to specify
+sentence format and a mandatory config file with the sections documented
+in the documentation files. Should be run with permissions to read and write to
 the serial ports specified, and write to the log file specified. Automated
 install script should take care of that, preferably by adding a new user.
 
@@ -13,6 +14,7 @@ This should be run as an upstart job.
 
 import json
 import threading
+import collections
 import time
 import argparse
 import ConfigParser
@@ -20,19 +22,38 @@ import sys
 import logging
 import traceback
 import signal
+import select
+import errno
+import binascii
+import os
+import fcntl
+import socket
+import Queue
 
 import serial
 import setproctitle
 
 from nmea_templates import nmea_templates
 from file_lock import file_lock
+from ring_buffer import RingWriter, RingError, RecordTooLarge
+from pubsub import FrameBuffer, FrameError, pack_frame
+from nmea_replay import ReplayDevice, make_source
+from metrics import Metrics, StatsWriter
+from capture import CaptureLog
+from profiling import Profiler, Tracer
 
 CONFIG_LOCATION = '/etc/nmead.conf'
 LOGFILE_LOCATION = '/var/log/nmead.log'
 WRITER_SLEEP_TIME = 0.1
 SERIAL_TIMEOUT = 0.05
+EVENT_IDLE_TIMEOUT = 1.0
+SOCKET_CLIENT_BUFFER = 1 << 20
+CAPTURE_QUEUE_SIZE = 100000
+CAPTURE_WAIT = 0.2
 
 terminate = False   # Global termination flag
+metrics = Metrics()
+profiler = None     # Toggled by SIGUSR1
 
 
 def thunk(callable_, *args, **kwargs):
@@ -50,12 +71,69 @@ def timeout_block(nb_callable, timeout, timeiter=0.05):
             time.sleep(timeiter)
         currtime = time.time()
 
+def nmea_checksum(data):
+    """XOR of all bytes in data, folded in halves over one big integer
+       so the work is done by a handful of C-level operations."""
+    width = len(data)
+    if not width:
+        return 0
+    value = int(binascii.hexlify(data), 16)
+    while width > 1:
+        half = (width + 1) // 2
+        bits = half * 8
+        value = (value >> bits) ^ (value & ((1 << bits) - 1))
+        width = half
+    return value
+
 def chk_nmea_cs(sentence):
     """NMEA checksum evaluator"""
-    xor = 0
-    for char in sentence[1:-3]:
-        xor ^= ord(char)
-    return '%02X' % xor == sentence[-2:]
+    return '%02X' % nmea_checksum(sentence[1:-3]) == sentence[-2:]
+
+def sentence_type(header):
+    """
+    sentence_type(header: str) -> str
+
+    Reduce a sentence header to the key templates are matched by: the
+    sentence type without the talker ID ('$GNRMC', 'GPRMC' and 'RMC' all
+    give 'RMC'), or the whole address of proprietary sentences ('PGRMZ').
+    """
+    address = header.lstrip('$!').upper()
+    if address.startswith('P') or len(address) != 5:
+        return address
+    return address[2:]
+
+def compile_templates(templates, namespace=''):
+    """
+    compile_templates(templates: dict, namespace: str) -> dict
+
+    Turn {header: [field names]} into {sentence type: (field count, index
+    table)} where the index table lists (position, name) for named fields
+    only. Names are prefixed with 'namespace.' if a namespace is given.
+    """
+    prefix = namespace + '.' if namespace else ''
+    compiled = {}
+    for header, template in templates.iteritems():
+        table = tuple((index, prefix + name)
+                      for index, name in enumerate(template) if name)
+        compiled[sentence_type(header)] = (len(template), table)
+    return compiled
+
+def load_templates(cfg):
+    """
+    load_templates(cfg: ConfigParser) -> dict
+
+    Return the built-in templates extended and overridden by the
+    [templates] config section, where every option is a sentence type
+    and its value the comma separated field names, empty for fields
+    that are not published.
+    """
+    templates = dict((sentence_type(header), template)
+                     for header, template in nmea_templates.iteritems())
+    if cfg.has_section('templates'):
+        for header, fields in cfg.items('templates'):
+            templates[sentence_type(header)] = [name.strip() or None
+                                                for name in fields.split(',')]
+    return templates
 
 class CfgErr(Exception):
     """Config file related error"""
@@ -73,11 +151,125 @@ class TemplateMismatchError(Exception):
 
 
 class SharedStruct(object):
-    """Thread-shared memory with access control mechanisms"""
+    """
+    Versioned thread-shared field store. Producers queue updates without
+    ever blocking or dropping them; consumers apply the queue and take a
+    snapshot under a lock only consumers contend for. Every applied update
+    bumps the version and stamps the fields it touched.
+    """
     def __init__(self):
         self.updated = threading.Event()
         self.lock = threading.Lock()
+        self.pending = collections.deque()
         self.struct = dict()
+        self.field_versions = dict()
+        self.version = 0
+        self.consumers = []
+        self.feeds = []
+
+    def push(self, update, header=None):
+        """Queue a {field: (value, toa)} update; never blocks"""
+        self.pending.append(update)
+        self.updated.set()
+        for feed in self.feeds:
+            feed.put((header, update))
+
+    def feed(self):
+        """Register and return a StructFeed receiving every update"""
+        feed = StructFeed()
+        self.feeds.append(feed)
+        return feed
+
+    def snapshot(self):
+        """
+        snapshot() -> (version, dict)
+
+        Apply queued updates in arrival order and return a private copy
+        of the struct along with its version.
+        """
+        with self.lock:
+            # Cleared first, so a push racing with the drain sets it again.
+            self.updated.clear()
+            pending = self.pending
+            while pending:
+                update = pending.popleft()
+                self.version += 1
+                self.struct.update(update)
+                for name in update:
+                    self.field_versions[name] = self.version
+            return self.version, self.struct.copy()
+
+    def consumer(self, name):
+        """Register and return a new StructConsumer"""
+        consumer = StructConsumer(self, name)
+        self.consumers.append(consumer)
+        return consumer
+
+    def missed_updates(self):
+        """Return {consumer name: updates it never saw individually}"""
+        return dict((c.name, c.missed) for c in self.consumers)
+
+
+class StructConsumer(object):
+    """Per-consumer cursor into a SharedStruct"""
+    def __init__(self, shared_struct, name):
+        self.struct = shared_struct
+        self.name = name
+        self.version = 0
+        self.missed = 0
+
+    def poll(self):
+        """Return a snapshot newer than the last one seen, or None.
+           Updates folded into a single snapshot are counted as missed."""
+        version, struct = self.struct.snapshot()
+        if version == self.version:
+            return None
+        self.missed += version - self.version - 1
+        self.version = version
+        return struct
+
+
+class StructFeed(object):
+    """Queue of raw (header, update) pairs with a pollable wakeup pipe"""
+    def __init__(self):
+        self.queue = collections.deque()
+        self.signalled = False
+        self.rfd, self.wfd = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def put(self, item):
+        """Queue item, waking the reader if it is not already woken"""
+        self.queue.append(item)
+        if not self.signalled:
+            self.signalled = True
+            try:
+                os.write(self.wfd, 'x')
+            except OSError:
+                pass
+
+    def drain(self):
+        """Return every queued item and rearm the wakeup pipe"""
+        # Empty the pipe before clearing the flag: a put() in between
+        # then either finds the flag set and its item is still taken
+        # below, or writes a byte that wakes the reader again.
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError:
+            pass
+        self.signalled = False
+        items = []
+        queue = self.queue
+        while queue:
+            items.append(queue.popleft())
+        return items
+
+    def close(self):
+        """Close the wakeup pipe"""
+        os.close(self.rfd)
+        os.close(self.wfd)
 
 
 class ThreadClass(object):
@@ -117,120 +309,538 @@ class ThreadClass(object):
     
     def start(self):
         """Start the thread"""
-        self.th_handle = threading.Thread(target=self)
+        # Named after the device or class, for profiles.
+        self.th_handle = threading.Thread(target=self, name=getattr(
+            self, 'device_name', self.__class__.__name__))
         self.th_handle.start()
         return self.th_handle
 
 
 class Driver(ThreadClass):
     """NMEA device driver class"""
-    def __init__(self, shared_struct, params, device_name):
+    def __init__(self, shared_struct, params, device_name,
+                 timeout=SERIAL_TIMEOUT, templates=nmea_templates):
         ThreadClass.__init__(self)
         self.struct = shared_struct
         self.device_name = device_name
         self.params = dict(params)
-        self.structcpy = None
-        self.nmea_templates = nmea_templates.copy()
+        self.buffer = bytearray()
+        self.stats = metrics.counters(device_name)
+        # Queue of a CaptureThread, set by main when capture is enabled.
+        self.capture = None
+        self.nmea_templates = dict((sentence_type(header), template)
+                                   for header, template
+                                   in templates.iteritems())
         self.chk_chksums = (self.params.get('check_checksums') == 'True')
+        self.batch_read = (self.params.get('batch_read') == 'True')
         
         logging.info('%s listener starting.', self.device_name)
-        try:
-            self.device = serial.Serial(self.params['port'], 
-                                        int(self.params['baud']),
-                                        timeout=SERIAL_TIMEOUT)
-        except serial.SerialException:
-            logging.critical('Failed to open %s serial port: %s',
-                             self.device_name, self.params['port'])
-            logging.debug(traceback.format_exc())
-            main_exit()
-            return
-        logging.info('Successfully opened %s serial port.', self.device_name)
+        if self.params.get('replay'):
+            try:
+                self.device = ReplayDevice(make_source(self.params),
+                                           float(self.params['replay_speed']),
+                                           timeout)
+            except (IOError, OSError):
+                logging.critical('Failed to open %s replay source: %s',
+                                 self.device_name, self.params['replay'])
+                logging.debug(traceback.format_exc())
+                main_exit()
+                return
+            logging.info('Replaying %s into %s.', self.params['replay'],
+                         self.device_name)
+        else:
+            try:
+                self.device = serial.Serial(self.params['port'], 
+                                            int(self.params['baud']),
+                                            timeout=timeout)
+            except serial.SerialException:
+                logging.critical('Failed to open %s serial port: %s',
+                                 self.device_name, self.params['port'])
+                logging.debug(traceback.format_exc())
+                main_exit()
+                return
+            logging.info('Successfully opened %s serial port.',
+                         self.device_name)
         self.cleanup_stack.append(self.device.close)
         
         disabled_sentences = self.params.get('disable_nmea', '')
-        for dsentence in disabled_sentences.split():
-            if dsentence in self.nmea_templates:
-                del self.nmea_templates[dsentence]
+        for dsentence in disabled_sentences.replace(',', ' ').split():
+            self.nmea_templates.pop(sentence_type(dsentence), None)
+        self.compiled = compile_templates(self.nmea_templates,
+                                          self.params.get('namespace', ''))
         
     def repeat(self):
+        if self.batch_read:
+            self.read_available()
+            return
         try:
             sentence = self.device.readline()
-            toa = time.time()
-            sentence = sentence.strip()  
-            if sentence:
-                header = sentence[:6]
-                if header in self.nmea_templates:
-                    if self.chk_chksums and not chk_nmea_cs(sentence):
-                        raise ChecksumError
-                    template = self.nmea_templates[header]
-                    sentence = sentence[7:-3].split(',')
-                    if len(template) != len(sentence):
-                        raise TemplateMismatchError
-                    data = zip(sentence, [toa]*len(sentence))
-                    self.structcpy = dict(p for p in 
-                                     zip(template, data) if p[0])
+        except serial.SerialException:
+            self.serial_error()
+        else:
+            self.handle_line(sentence, time.time())
+
+    def read_available(self):
+        """Drain everything the port has buffered in one read and parse
+           the complete lines. Blocks for at most the port timeout."""
+        try:
+            data = self.device.read(self.device.inWaiting() or 1)
+        except serial.SerialException:
+            self.serial_error()
+            return
+        if data:
+            self.handle_batch(data, time.time())
+
+    def handle_batch(self, data, toa):
+        """Append data to the line buffer and parse every complete line.
+           An incomplete trailing line stays buffered for the next read."""
+        buf = self.buffer
+        buf.extend(data)
+        end = buf.rfind('\n')
+        if end < 0:
+            return
+        lines = str(buf[:end]).split('\n')
+        del buf[:end+1]
+        for sentence in lines:
+            self.handle_line(sentence, toa)
+
+    def handle_line(self, sentence, toa):
+        """Parse a single NMEA line received at toa and push it to the
+           shared struct"""
+        sentence = sentence.strip()
+        if self.capture is not None and sentence:
+            try:
+                self.capture.put_nowait((toa, self.device_name, sentence))
+            except Queue.Full:
+                self.stats['capture_drops'] += 1
+        header = sentence[:6]
+        # Templates are keyed by sentence type, whatever the talker.
+        if header[1:2] == 'P':
+            compiled = self.compiled.get(header[1:])
+        else:
+            compiled = self.compiled.get(header[3:])
+        if compiled is None or header[:1] not in ('$', '!'):
+            self.stats['ignored'] += 1
+            return
+        field_count, table = compiled
+        try:
+            if self.chk_chksums and not chk_nmea_cs(sentence):
+                raise ChecksumError
+            fields = sentence[7:-3].split(',')
+            if len(fields) != field_count:
+                raise TemplateMismatchError
         except TemplateMismatchError:
+            self.stats['template_mismatches'] += 1
             logging.error('NMEA template mismatch: %s', header)
-            logging.debug('MISMATCH: %d %d', len(template), len(sentence))
+            logging.debug('MISMATCH: %d %d', field_count, len(fields))
+            return
         except ChecksumError:
+            self.stats['checksum_errors'] += 1
             logging.warning('Bad NMEA checksum on %s:%s',
                             self.device_name, header)
-        except serial.SerialException:
-            logging.critical('Serial communication error with %s, exiting.',
-                             self.device_name)
-            main_exit(True) # Does NOT exit!
-        
-        if self.structcpy is not None and self.struct.lock.acquire(False):
-            self.struct.struct.update(self.structcpy)
-            self.struct.updated.set()
-            self.struct.lock.release()
-            self.structcpy = None
-            logging.debug('Written to struct')
+            return
+        self.stats[header] += 1
+        self.struct.push(dict((name, (fields[index], toa))
+                              for index, name in table), header)
+
+    def serial_error(self):
+        """Log a serial failure and ask all threads to exit"""
+        logging.critical('Serial communication error with %s, exiting.',
+                         self.device_name)
+        main_exit(True) # Does NOT exit!
 
             
 class Writer(ThreadClass):
-    """File writer class"""
+    """Interface writer class; publishes to a json file and/or a ring"""
     def __init__(self, shared_struct, params):
         ThreadClass.__init__(self)
         self.struct = shared_struct
         self.params = dict(params)
         self.structcpy = None
-        
-        try:
-            self.file = open(self.params['output_file'], 'w')
-        except:
-            logging.critical('Failed to open output file: %s',
-                             self.params['output_file'])
-            main_exit()
-            return
-        logging.info('Opened interface file: %s',
-                     self.params['output_file'])
-        self.cleanup_stack.append(self.file.close)
+        self.consumer = shared_struct.consumer('writer')
+        self.stats = metrics.counters('writer')
+        self.delay = metrics.histogram('writer.toa_to_write')
+        self.newest_toa = None
+        self.file = None
+        self.ring = None
+        self.transports = self.params.get('transport', 'json').split()
+        self.cleanup_stack.append(self.log_missed)
+
+        if 'json' in self.transports:
+            try:
+                self.file = open(self.params['output_file'], 'w')
+            except:
+                logging.critical('Failed to open output file: %s',
+                                 self.params['output_file'])
+                main_exit()
+                return
+            logging.info('Opened interface file: %s',
+                         self.params['output_file'])
+            self.cleanup_stack.append(self.file.close)
+
+        if 'ring' in self.transports:
+            try:
+                self.ring = RingWriter(self.params['ring_file'],
+                                       int(self.params['ring_slots']),
+                                       int(self.params['ring_slot_size']))
+            except (IOError, RingError):
+                logging.critical('Failed to create ring file: %s',
+                                 self.params['ring_file'])
+                logging.debug(traceback.format_exc())
+                main_exit()
+                return
+            logging.info('Opened ring interface file: %s',
+                         self.params['ring_file'])
+            self.cleanup_stack.append(self.ring.close)
     
     def repeat(self):
-        updated = self.struct.updated.is_set()
-        if updated and self.struct.lock.acquire(False):
-            self.structcpy = self.struct.struct.copy()
-            self.struct.lock.release()
-            self.struct.updated.clear()
-            logging.debug('Copied struct!')
+        self.publish()
+        time.sleep(WRITER_SLEEP_TIME)
+
+    def publish(self):
+        """Snapshot the struct if it was updated and write it out"""
+        if self.struct.updated.is_set():
+            snapshot = self.consumer.poll()
+            if snapshot:
+                self.structcpy = snapshot
+                self.newest_toa = max(value[1] for value
+                                      in snapshot.itervalues())
+                logging.debug('Copied struct!')
+                if self.ring is not None:
+                    self.write_ring(self.structcpy)
             
-        if self.structcpy is not None:
+        if self.file is None:
+            if self.structcpy is not None:
+                self.delay.record(time.time() - self.newest_toa)
+            self.structcpy = None
+        elif self.structcpy is not None:
             with file_lock(self.file, exclusive=True) as lock_established:
                 if lock_established:
                     self.file.truncate(0)
                     self.file.seek(0)
-                    json.dump(self.struct.struct, self.file)
+                    json.dump(self.structcpy, self.file)
                     self.file.flush()
                     self.structcpy = None
+                    self.stats['json_writes'] += 1
+                    self.delay.record(time.time() - self.newest_toa)
                     logging.debug('Written struct to file.')
-        time.sleep(WRITER_SLEEP_TIME)
+                else:
+                    self.stats['json_lock_misses'] += 1
+
+    def log_missed(self):
+        """Log how many struct versions were folded into later snapshots"""
+        logging.info('Writer missed %d intermediate struct updates.',
+                     self.consumer.missed)
+
+    def write_ring(self, struct):
+        """Append a struct snapshot to the ring interface file"""
+        try:
+            self.ring.append(json.dumps(struct), time.time())
+        except RecordTooLarge:
+            self.stats['ring_oversize_drops'] += 1
+            logging.error('Struct snapshot exceeds ring_slot_size, '
+                          'record dropped.')
+        else:
+            self.stats['ring_writes'] += 1
+            logging.debug('Written struct to ring.')
+
+class CaptureThread(ThreadClass):
+    """Writes every raw line queued by the drivers to the capture log,
+       so compression and disk writes stay off the read path"""
+    def __init__(self, params):
+        ThreadClass.__init__(self)
+        self.params = dict(params)
+        self.queue = Queue.Queue(CAPTURE_QUEUE_SIZE)
+        self.stats = metrics.counters('capture')
+        try:
+            self.log = CaptureLog(self.params['directory'],
+                                  self.params['prefix'],
+                                  int(self.params['max_size']),
+                                  int(self.params['block_size']),
+                                  float(self.params['flush_interval']))
+        except (IOError, OSError):
+            logging.critical('Failed to open capture directory: %s',
+                             self.params['directory'])
+            logging.debug(traceback.format_exc())
+            main_exit()
+            return
+        logging.info('Capturing raw NMEA to %s', self.log.fname)
+        metrics.gauge('capture.queued', self.queue.qsize)
+        metrics.gauge('capture.blocks', lambda: self.log.blocks)
+        metrics.gauge('capture.files', lambda: self.log.files)
+        self.cleanup_stack.append(self.close)
+
+    def repeat(self):
+        try:
+            item = self.queue.get(True, CAPTURE_WAIT)
+        except Queue.Empty:
+            item = None
+        try:
+            while item is not None:
+                self.log.append(*item)
+                self.stats['lines'] += 1
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    item = None
+            self.log.flush_due()
+        except (IOError, OSError):
+            # Losing the capture must not stop logging; the drivers count
+            # what they can no longer queue.
+            logging.critical('Writing capture file %s failed, capture '
+                             'stopped.', self.log.fname)
+            logging.debug(traceback.format_exc())
+            self.terminate = True
+
+    def close(self):
+        """Write out whatever is still queued and close the log"""
+        try:
+            while True:
+                self.log.append(*self.queue.get_nowait())
+                self.stats['lines'] += 1
+        except Queue.Empty:
+            pass
+        try:
+            self.log.close()
+        except (IOError, OSError):
+            logging.error('Failed to close capture file %s', self.log.fname)
+        logging.info('Captured %d lines.', self.log.written)
+
+
+class EventLoop(ThreadClass):
+    """Single thread serving every driver and the writer via poll(2).
+       The writer only runs when a port delivered data, or to retry a
+       write the json file lock previously refused."""
+    def __init__(self, drivers, writer):
+        ThreadClass.__init__(self)
+        self.writer = writer
+        self.drivers = {}
+        self.poller = select.poll()
+        for driver in drivers:
+            fileno = driver.device.fileno()
+            self.drivers[fileno] = driver
+            self.poller.register(fileno, select.POLLIN | select.POLLPRI)
+            self.cleanup_stack.append(driver.cleanup)
+        self.cleanup_stack.append(writer.cleanup)
+
+    def repeat(self):
+        if self.writer.structcpy is None:
+            timeout = EVENT_IDLE_TIMEOUT
+        else:
+            timeout = WRITER_SLEEP_TIME
+        try:
+            events = self.poller.poll(timeout * 1000)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        for fileno, event in events:
+            driver = self.drivers[fileno]
+            if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                driver.serial_error()
+                self.poller.unregister(fileno)
+            else:
+                driver.read_available()
+        if events or self.writer.structcpy is not None:
+            self.writer.publish()
+
+class PubSubClient(object):
+    """Connection state of a single publish/subscribe client"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.frames = FrameBuffer()
+        self.outbuf = bytearray()
+        self.subscribed = False
+        self.fields = None
+        self.headers = None
+
+    def subscribe(self, request):
+        """Set the client's filters from a subscription frame"""
+        self.subscribed = True
+        self.fields = frozenset(request.get('fields') or ()) or None
+        self.headers = frozenset(request.get('headers') or ()) or None
+
+    def filter(self, header, update):
+        """Return the subscribed part of update as {field: value}"""
+        if self.headers is not None and header not in self.headers:
+            return None
+        if self.fields is None:
+            return dict((name, value[0]) for name, value
+                        in update.iteritems())
+        data = dict((name, value[0]) for name, value in update.iteritems()
+                    if name in self.fields)
+        return data or None
+
+
+class PubSubServer(ThreadClass):
+    """Unix socket server pushing every struct update to subscribers"""
+    def __init__(self, shared_struct, params):
+        ThreadClass.__init__(self)
+        self.struct = shared_struct
+        self.params = dict(params)
+        self.path = self.params['socket_file']
+        self.clients = {}
+        self.stats = metrics.counters('pubsub')
+        metrics.gauge('pubsub.clients', lambda: len(self.clients))
+        self.feed = shared_struct.feed()
+        self.cleanup_stack.append(self.feed.close)
+        self.cleanup_stack.append(self.close_clients)
+
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            self.sock.bind(self.path)
+            self.sock.listen(16)
+        except (OSError, socket.error):
+            logging.critical('Failed to open publish socket: %s', self.path)
+            logging.debug(traceback.format_exc())
+            main_exit()
+            return
+        logging.info('Serving subscribers on %s', self.path)
+        self.cleanup_stack.append(self.close_socket)
+
+        self.poller = select.poll()
+        self.poller.register(self.sock.fileno(), select.POLLIN)
+        self.poller.register(self.feed.rfd, select.POLLIN)
+
+    def repeat(self):
+        try:
+            events = self.poller.poll(EVENT_IDLE_TIMEOUT * 1000)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        for fileno, event in events:
+            if fileno == self.sock.fileno():
+                self.accept()
+            elif fileno == self.feed.rfd:
+                self.fan_out(self.feed.drain())
+            elif fileno not in self.clients:
+                continue
+            elif event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                self.drop(fileno)
+            else:
+                if event & select.POLLIN:
+                    self.receive(fileno)
+                if event & select.POLLOUT and fileno in self.clients:
+                    self.flush(fileno)
+
+    def accept(self):
+        """Accept a pending connection"""
+        try:
+            sock, dummy = self.sock.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.clients[sock.fileno()] = PubSubClient(sock)
+        self.poller.register(sock.fileno(), select.POLLIN)
+        logging.info('Subscriber connected.')
+
+    def receive(self, fileno):
+        """Read subscription frames from a client"""
+        client = self.clients[fileno]
+        try:
+            data = client.sock.recv(4096)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.drop(fileno)
+            return
+        try:
+            requests = client.frames.feed(data)
+        except FrameError:
+            logging.warning('Malformed subscription, dropping subscriber.')
+            self.drop(fileno)
+            return
+        for request in requests:
+            client.subscribe(request)
+            dummy, state = self.struct.snapshot()
+            if client.fields is not None:
+                state = dict((name, value) for name, value
+                             in state.iteritems() if name in client.fields)
+            self.send(fileno, pack_frame({'h': None, 's': state}))
+
+    def fan_out(self, updates):
+        """Push every (header, update) pair to the interested clients"""
+        for header, update in updates:
+            toa = None
+            for value in update.itervalues():
+                toa = value[1]
+                break
+            for fileno, client in self.clients.items():
+                if not client.subscribed:
+                    continue
+                data = client.filter(header, update)
+                if data is not None:
+                    self.send(fileno, pack_frame({'h': header, 't': toa,
+                                                  'd': data}))
+
+    def send(self, fileno, frame):
+        """Queue a frame for a client and try to send it right away"""
+        client = self.clients.get(fileno)
+        if client is None:
+            return
+        if len(client.outbuf) + len(frame) > SOCKET_CLIENT_BUFFER:
+            self.stats['slow_client_drops'] += 1
+            logging.warning('Subscriber too slow, dropping it.')
+            self.drop(fileno)
+            return
+        self.stats['frames'] += 1
+        client.outbuf.extend(frame)
+        self.flush(fileno)
+
+    def flush(self, fileno):
+        """Send as much of a client's output buffer as it accepts"""
+        client = self.clients[fileno]
+        try:
+            sent = client.sock.send(client.outbuf)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                sent = 0
+            else:
+                self.drop(fileno)
+                return
+        del client.outbuf[:sent]
+        if client.outbuf:
+            self.poller.modify(fileno, select.POLLIN | select.POLLOUT)
+        else:
+            self.poller.modify(fileno, select.POLLIN)
+
+    def drop(self, fileno):
+        """Disconnect a client"""
+        client = self.clients.pop(fileno, None)
+        if client is None:
+            return
+        self.poller.unregister(fileno)
+        client.sock.close()
+        logging.info('Subscriber disconnected.')
+
+    def close_clients(self):
+        """Disconnect every client"""
+        for fileno in self.clients.keys():
+            self.drop(fileno)
+
+    def close_socket(self):
+        """Close and remove the listening socket"""
+        self.sock.close()
+        os.unlink(self.path)
 
 def handle_sigterm(signum, sigframe):
     """SIGTERM handler function"""
     logging.info('Received SIGTERM, exiting gracefully.')
+    if profiler is not None and profiler.running:
+        profiler.stop()
     main_exit()
 
+def handle_sigusr1(signum, sigframe):
+    """SIGUSR1 handler function, starts or stops profiling"""
+    if profiler is not None:
+        profiler.toggle()
+
 def main_exit(nonmain=False):
     """Exit all threads; should be called with
        nonmain=True from threads other than main."""
@@ -242,15 +852,35 @@ def main_exit(nonmain=False):
 
 def load_config(fname):
     """Load a config file."""
-    required_params = [('writer', ['output_file']),
-                       ('sounder', ['port']),
-                       ('gps', ['port'])]
-    optional_params = [('sounder', {'baud':'4800', 
-                                    'disable_nmea':'', 
-                                    'check_checksums':'False'}),
-                       ('gps', {'baud':'4800', 
-                               'disable_nmea':'', 
-                               'check_checksums':'False'})]
+    required_params = [('writer', ['output_file'])]
+    device_params = {'baud':'4800', 
+                     'disable_nmea':'', 
+                     'check_checksums':'False',
+                     'batch_read':'False',
+                     'replay':'',
+                     'replay_speed':'1.0',
+                     'replay_loop':'False',
+                     'synth_sentences':'$GPRMC $SDDBT',
+                     'synth_rate':'10',
+                     'synth_error_ratio':'0.0',
+                     'namespace':''}
+    optional_params = [('nmead', {'engine':'threads',
+                                  'devices':'gps sounder',
+                                  'stats_file':'',
+                                  'stats_interval':'10',
+                                  'profile_file':'/tmp/nmead.profile',
+                                  'profile_interval':'0.005',
+                                  'profile_spans':'False'}),
+                       ('writer', {'transport':'json',
+                                   'ring_file':'',
+                                   'ring_slots':'1024',
+                                   'ring_slot_size':'4096',
+                                   'socket_file':''}),
+                       ('capture', {'directory':'',
+                                    'prefix':'nmea',
+                                    'max_size':'67108864',
+                                    'block_size':'65536',
+                                    'flush_interval':'1.0'})]
     cfg = ConfigParser.ConfigParser()
     cfg.read([fname])
     if not cfg.sections():
@@ -266,7 +896,37 @@ def load_config(fname):
         if not cfg.has_section(section[0]):
             cfg.add_section(section[0])
         for option, value in section[1].iteritems():
-            cfg.set(section[0], option, value)
+            if not cfg.has_option(section[0], option):
+                cfg.set(section[0], option, value)
+
+    devices = cfg.get('nmead', 'devices').split()
+    if not devices:
+        raise CfgErr, 'No devices listed in section [nmead]!'
+    for section in devices:
+        if section in ('nmead', 'writer', 'capture', 'templates',
+                       'scanner') or devices.count(section) > 1:
+            raise CfgErr, 'Invalid device section name \'%s\'!' % section
+        if not (cfg.has_option(section, 'port') or
+                cfg.has_option(section, 'replay')):
+            raise CfgErr, ('Required config argument \'port\' '
+                           'in section [%s] missing!') % section
+        for option, value in device_params.iteritems():
+            if not cfg.has_option(section, option):
+                cfg.set(section, option, value)
+
+    if cfg.get('nmead', 'engine') not in ('threads', 'select'):
+        raise CfgErr, ('Unknown engine \'%s\'!' %
+                       cfg.get('nmead', 'engine'))
+    transports = cfg.get('writer', 'transport').split()
+    for transport in transports:
+        if transport not in ('json', 'ring', 'socket'):
+            raise CfgErr, 'Unknown writer transport \'%s\'!' % transport
+    if 'ring' in transports and not cfg.get('writer', 'ring_file'):
+        raise CfgErr, ('Required config argument \'ring_file\' '
+                       'in section [writer] missing!')
+    if 'socket' in transports and not cfg.get('writer', 'socket_file'):
+        raise CfgErr, ('Required config argument \'socket_file\' '
+                       'in section [writer] missing!')
     return cfg
     
 def main():
@@ -297,11 +957,52 @@ def main():
     
     
     struct = SharedStruct()
-    gpsdriver = Driver(struct, config.items('gps'), 'GPS')
-    soudriver = Driver(struct, config.items('sounder'), 'SOUNDER')
+    if config.get('nmead', 'engine') == 'select':
+        timeout = 0
+    else:
+        timeout = SERIAL_TIMEOUT
+    templates = load_templates(config)
+    drivers = [Driver(struct, config.items(section), section.upper(),
+                      timeout, templates)
+               for section in config.get('nmead', 'devices').split()]
     writer = Writer(struct, config.items('writer'))
     
-    th_objects = [gpsdriver, soudriver, writer]
+    if config.get('nmead', 'engine') == 'select':
+        th_objects = [EventLoop(drivers, writer)]
+    else:
+        th_objects = drivers + [writer]
+    if 'socket' in config.get('writer', 'transport').split():
+        th_objects.append(PubSubServer(struct, config.items('writer')))
+    if config.get('capture', 'directory'):
+        capture = CaptureThread(config.items('capture'))
+        for driver in drivers:
+            driver.capture = capture.queue
+        th_objects.append(capture)
+    metrics.gauge('struct.version', lambda: struct.version)
+    metrics.gauge('struct.pending', lambda: len(struct.pending))
+    metrics.gauge('struct.missed_updates', struct.missed_updates)
+    global profiler
+    tracer = None
+    if config.get('nmead', 'profile_spans') == 'True':
+        tracer = Tracer()
+        for driver in drivers:
+            if hasattr(driver, 'device'):
+                tracer.register(driver.device, 'readline',
+                                'readline.' + driver.device_name)
+                tracer.register(driver.device, 'read',
+                                'read.' + driver.device_name)
+            tracer.register(driver, 'handle_line',
+                            'parse.' + driver.device_name)
+        tracer.register(writer, 'publish', 'publish')
+        tracer.register_lock(struct, 'lock', 'struct')
+    profiler = Profiler(config.get('nmead', 'profile_file'),
+                        float(config.get('nmead', 'profile_interval')),
+                        tracer)
+    if config.get('nmead', 'stats_file'):
+        stats_writer = StatsWriter(metrics, config.get('nmead', 'stats_file'),
+                                   float(config.get('nmead',
+                                                    'stats_interval')))
+        stats_writer.start()
     if all(th_objects):
         th_handles = []
         for thread in th_objects:
@@ -313,6 +1014,7 @@ def main():
 if __name__ == '__main__':
     setproctitle.setproctitle('NMEAd')
     signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGUSR1, handle_sigusr1)
     main()
     while True:
         time.sleep(0.5)
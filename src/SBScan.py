@@ -6,6 +6,10 @@ database. Links to NMEAd over a json file respecting unix advisory
 file locks. Uses a mandatory config file with a single section that
 whose format is documented in the documentation file.
 
+With several sources configured, follows each of them in a worker process
+of its own, with its own session and fusion state, and writes the
+positions of all of them through one shared batched writer.
+
 Should be run manually using start-stop-daemon AFTER NMEAd.
 """
 
@@ -20,18 +24,84 @@ import traceback
 import time
 import datetime
 import errno
+import socket
+import multiprocessing
+import threading
+import Queue
+import os
 
 import setproctitle
 
 from file_lock import file_lock
+from ring_buffer import RingReader, RingError
+from pubsub import Subscriber, FrameError
+from fusion import Fusion
+from geo import nmea_to_degrees, degrees_to_nmea, utm_zone, to_utm
+from migrate_db import schema_current, table_columns
+from ingest import Ingest, configure_db, INGEST_QUEUE_SIZE
+from metrics import Metrics, StatsWriter
+from thinning import Thinner, local_xy
+from profiling import Profiler, Tracer
+from coverage import Coverage, CoverageError, load_polygon, write_report
 
 CONFIG_LOCATION = '/etc/sbscan.conf'
 LOGFILE_LOCATION = '/var/log/sbscan.log'
 LOCK_SLEEP_TIME = 0.02
+AGGREGATE_WAIT = 0.5
 
 stopped = False
+metrics = Metrics()
+profiler = None     # Toggled by SIGUSR1
+worker_pids = []    # Source workers SIGUSR1 is passed on to
 
 NMEA_REQDATA = ['latitude', 'longitude', 'NS', 'EW', 'depthm', 'speed']
+NMEA_SUBSCRIBE = NMEA_REQDATA + ['track', 'depthf', 'depthF']
+
+POSITION_INSERT = ('INSERT INTO positions(passing_time, lat, '
+                   'lon, speed, heading, time_between, '
+                   'depth, session_id, lat_deg, lon_deg, x, y) ' 
+                   'VALUES (?,?,?,?,?,?,?,?,?,?,?,?)')
+
+# [scanner] options and their defaults.
+SCANNER_DEFAULTS = {'transport':'json',
+                    'nmea_file':'',
+                    'ring_file':'',
+                    'socket_file':'',
+                    'minspeed':'0.5', 
+                    'maxdelta':'1.0', 
+                    'fusion':'False',
+                    'projected':'True',
+                    'pause_on_stop':'True',
+                    'polling_interval':'0.5',
+                    'log_point_count':'True',
+                    'log_point_count_interval':'1000',
+                    'commit_interval':'500',
+                    'batched_ingest':'False',
+                    'ingest_batch_size':'1000',
+                    'ingest_flush_interval':'1.0',
+                    'journal_mode':'WAL',
+                    'synchronous':'NORMAL',
+                    'stats_file':'',
+                    'stats_interval':'10',
+                    'thinning':'False',
+                    'thin_distance':'1.0',
+                    'thin_history':'64',
+                    'thin_depth_tolerance':'0.1',
+                    'source':'',
+                    'sources':'',
+                    'source_stall_timeout':'30',
+                    'profile_file':'/tmp/sbscan.profile',
+                    'profile_interval':'0.005',
+                    'profile_spans':'False',
+                    'coverage_polygon':'',
+                    'coverage_cell_size':'2.0',
+                    'coverage_beam_angle':'10.0',
+                    'coverage_min_swath':'1.0',
+                    'coverage_max_swath':'50.0',
+                    'coverage_min_gap':'4',
+                    'coverage_report_interval':'60',
+                    'coverage_save_interval':'60',
+                    'coverage_report_file':''}
 
 def safe_depth(nmea_data):
     """
@@ -43,32 +113,181 @@ def safe_depth(nmea_data):
             float(nmea_data['depthf'][0] or 0)*0.3048 or
             float(nmea_data['depthF'][0] or 0)*1.8288)
 
+def add_source_column(db):
+    """Add sessions.source to databases created without it"""
+    if 'source' not in table_columns(db, 'sessions'):
+        db.execute('ALTER TABLE sessions ADD COLUMN source TEXT')
+        db.commit()
+        logging.info('Added column sessions.source')
+
 class CfgErr(Exception):
     """Config file related error"""
     pass
 
+class SourceSink(object):
+    """Stands in for a session's Ingest in a source worker, forwarding
+       rows to the aggregator's shared writer"""
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+        self.error = None
+        self.dropped = 0
+
+    def put(self, row):
+        """Queue a row without blocking, dropping it if the writer fell
+           behind"""
+        try:
+            self.queue.put_nowait((self.name, row))
+        except Queue.Full:
+            if not self.dropped:
+                logging.warning('Source %s: writer queue full, dropping '
+                                'rows.', self.name)
+            self.dropped += 1
+            return False
+        return True
+
+class CoverageMonitor(object):
+    """Survey coverage map updated with every logged position, reported
+       and stored in the database periodically"""
+    def __init__(self, db, params):
+        self.db = db
+        self.name = os.path.basename(params['coverage_polygon'])
+        self.min_gap = int(params['coverage_min_gap'])
+        self.report_file = params['coverage_report_file']
+        self.report_interval = float(params['coverage_report_interval'])
+        self.save_interval = float(params['coverage_save_interval'])
+        try:
+            self.coverage = Coverage.resume(
+                db, self.name, load_polygon(params['coverage_polygon']),
+                float(params['coverage_cell_size']),
+                float(params['coverage_beam_angle']),
+                float(params['coverage_min_swath']),
+                float(params['coverage_max_swath']))
+        except (CoverageError, sqlite3.Error):
+            logging.critical('Failed to set up coverage: %s',
+                             sys.exc_info()[1])
+            sys.exit(1)
+        logging.info('Coverage %s: %.1f%% of %d cells covered.', self.name,
+                     self.coverage.percent(), self.coverage.target)
+        self.next_report = time.time() + self.report_interval
+        self.next_save = time.time() + self.save_interval
+        # Id ranges of the marked positions stored since the last save,
+        # appended to by the ingest thread.
+        self.live = []
+        self.live_lock = threading.Lock()
+        metrics.gauge('coverage.percent', self.coverage.percent)
+
+    def add(self, lat, lon, depth):
+        """Mark a logged position, reporting and saving when due"""
+        self.coverage.add(lat, lon, depth)
+        now = time.time()
+        if now >= self.next_report:
+            self.next_report = now + self.report_interval
+            self.report()
+        if now >= self.next_save:
+            self.next_save = now + self.save_interval
+            self.save()
+
+    def stored(self, first, last):
+        """Record that the positions with ids first to last, all marked
+           with add, are in the database"""
+        with self.live_lock:
+            if self.live and self.live[-1][1] + 1 == first:
+                self.live[-1] = (self.live[-1][0], last)
+            else:
+                self.live.append((first, last))
+
+    def report(self):
+        """Log the covered share and the largest gaps, and write the
+           report file"""
+        report = self.coverage.report(self.min_gap)
+        metrics.counters('coverage')['gaps'] = len(report['gaps'])
+        if report['gaps']:
+            gap = report['gaps'][0]
+            logging.info('Coverage %.1f%%, %d gaps, largest %.0f m2 around '
+                         '%.6f, %.6f.', report['percent'],
+                         len(report['gaps']), gap['area'], gap['lat'],
+                         gap['lon'])
+        else:
+            logging.info('Coverage %.1f%%, no gaps.', report['percent'])
+        if self.report_file:
+            try:
+                write_report(report, self.report_file)
+            except (IOError, OSError):
+                logging.error('Failed to write coverage report %s',
+                              self.report_file)
+
+    def save(self):
+        """Store the map in the database"""
+        with self.live_lock:
+            live, self.live = self.live, []
+        try:
+            self.coverage.save(self.db, self.name, live)
+        except sqlite3.Error:
+            logging.error('Failed to store coverage: %s', sys.exc_info()[1])
+
+    def close(self):
+        """Final report and save"""
+        self.save()
+        self.report()
+
 class Session(object):
     """DB logging session context manager"""
-    def __init__(self, params):
+    def __init__(self, params, ingest=None):
         self.params = params
         self.sid = None
+        self.source = params.get('source') or None
         self.paused = False
         self.have_req_nmea = False
         self.position_counter = 0
         self.last_timest = float('-inf')
+        self.last_fix_toa = float('-inf')
+        self.last_depth_toa = float('-inf')
         self.check_minspeed = (self.params['pause_on_stop'] == 'True')
         self.minspeed = float(self.params['minspeed'])
         self.commit_interval = int(self.params['commit_interval'])
         self.log_interval = int(self.params['log_point_count_interval'])
         self.log_count = (self.params['log_point_count'] == 'True')
+        if self.params['fusion'] == 'True':
+            self.fusion = Fusion(float(self.params['maxdelta']))
+        else:
+            self.fusion = None
+        # A given ingest is shared and not started or stopped here.
+        self.ingest = ingest
+        self.own_ingest = ingest is None
+        if self.params['thinning'] == 'True':
+            self.thinner = Thinner(float(self.params['thin_distance']),
+                                   int(self.params['thin_history']),
+                                   float(self.params['thin_depth_tolerance']))
+        else:
+            self.thinner = None
+        self.stats = metrics.counters('session')
+        self.delay = metrics.histogram('session.toa_to_insert')
+        self.commit_delay = metrics.histogram('ingest.toa_to_commit')
+        self.project = (self.params['projected'] == 'True')
+        self.utm_zone = None
         try:
             self.db = sqlite3.connect(self.params['db_file'])
+            configure_db(self.db, self.params['journal_mode'],
+                         self.params['synchronous'])
         except:
             logging.critical('Failed to open db file %s !', 
                              self.params['db_file'])
             sys.exit()
             
         self.cursor = self.db.cursor()
+        if not schema_current(self.db):
+            logging.critical(('Database %s predates numeric coordinates, '
+                              'upgrade it with migrate_db.py first.'),
+                             self.params['db_file'])
+            self._close()
+            sys.exit(1)
+        if self.source is not None:
+            add_source_column(self.db)
+        # Source workers leave coverage to the aggregator.
+        self.coverage = None
+        if self.own_ingest and self.params['coverage_polygon']:
+            self.coverage = CoverageMonitor(self.db, self.params)
         
     def __enter__(self):
         """Log session start time."""
@@ -76,64 +295,179 @@ class Session(object):
         start_time = time.time()
         start_tstamp = datetime.datetime.fromtimestamp(start_time)
         
-        self.safe_execute(('INSERT INTO sessions(starttime, stoptime) '
-                           'VALUES (?, NULL)'), (start_tstamp,))
+        if self.source is None:
+            self.safe_execute(('INSERT INTO sessions(starttime, stoptime) '
+                               'VALUES (?, NULL)'), (start_tstamp,))
+        else:
+            self.safe_execute(('INSERT INTO sessions(starttime, stoptime, '
+                               'source) VALUES (?, NULL, ?)'),
+                              (start_tstamp, self.source))
             
         self.sid = self.cursor.lastrowid
         assert self.sid
         
-        logging.info('Opened session: %d', self.sid)
+        if self.source is None:
+            logging.info('Opened session: %d', self.sid)
+        else:
+            logging.info('Opened session %d for source %s.', self.sid,
+                         self.source)
         
         self.db.commit()
+
+        if self.own_ingest and self.params['batched_ingest'] == 'True':
+            self.ingest = Ingest(self.params['db_file'], POSITION_INSERT,
+                                 int(self.params['ingest_batch_size']),
+                                 float(self.params['ingest_flush_interval']),
+                                 self.params['journal_mode'],
+                                 self.params['synchronous'])
+            self.ingest.on_commit = self.record_commit
+            self.ingest.start()
+            logging.info('Started batched ingest.')
         return self
         
     def __exit__(self, dummy, dummy2, dummy3):
         """Log session end time, commit changes and close the db."""
            
+        if self.own_ingest and self.ingest is not None:
+            self.ingest.stop()
+            logging.info('Ingest wrote %d points.', self.ingest.written)
+
         stop_time = time.time()
         stop_tstamp = datetime.datetime.fromtimestamp(stop_time)
         
         self.safe_execute(('UPDATE sessions SET stoptime = ? '
                            'WHERE _id = ?'), (stop_tstamp, self.sid))
+        if self.coverage is not None:
+            self.coverage.close()
         
         self._close()
         
     def check_add_position(self, nmea_data):
         """If conditions are met, log a position into the db"""
 
-        if self.check_minspeed:
-            self.paused = float(nmea_data['speed'][0]) < self.minspeed
         if not self.have_req_nmea:
             for key in NMEA_REQDATA:
                 if key not in nmea_data:
                     return
             logging.info('Received required NMEA data.')
             self.have_req_nmea = True
+        self.stats['updates'] += 1
+        if self.fusion is not None:
+            self.fuse_positions(nmea_data)
+            return
+        if self.check_minspeed:
+            self.paused = float(nmea_data['speed'][0]) < self.minspeed
         pass_time = nmea_data['latitude'][1]
-        print self.paused, pass_time > self.last_timest
         if not self.paused and pass_time > self.last_timest:
             s_g_delta = nmea_data['latitude'][1] - nmea_data['depthm'][1]
             lat = nmea_data['latitude'][0] + nmea_data['NS'][0]
             lon = nmea_data['longitude'][0] + nmea_data['EW'][0]
+            lat_deg = nmea_to_degrees(nmea_data['latitude'][0],
+                                      nmea_data['NS'][0])
+            lon_deg = nmea_to_degrees(nmea_data['longitude'][0],
+                                      nmea_data['EW'][0])
             spd = float(nmea_data['speed'][0])
             trk = float(nmea_data['track'][0])
             dpt = safe_depth(nmea_data)
             
-            self.safe_execute(('INSERT INTO positions(passing_time, lat, '
-                                 'lon, speed, heading, time_between, '
-                                 'depth, session_id) ' 
-                                 'VALUES (?,?,?,?,?,?,?,?)'),
-                                 (pass_time, lat, lon, spd,
-                                 trk, s_g_delta, dpt, self.sid))
-            self.position_counter += 1
-            
-            if not self.position_counter % self.commit_interval:
-                self.db.commit()
-            
-            if self.log_count and not (self.position_counter %
-                                       self.log_interval):
-                logging.info('Recorded %d points', self.position_counter)
+            self.add_position(pass_time, lat_deg, lon_deg, spd, trk,
+                              s_g_delta, dpt, lat, lon)
+            self.last_timest = pass_time
+
+    def fuse_positions(self, nmea_data):
+        """Queue new fixes and soundings and log every fused sounding"""
+        fix_toa = nmea_data['latitude'][1]
+        if fix_toa > self.last_fix_toa:
+            self.last_fix_toa = fix_toa
+            self.fusion.add_fix(fix_toa,
+                                nmea_to_degrees(nmea_data['latitude'][0],
+                                                nmea_data['NS'][0]),
+                                nmea_to_degrees(nmea_data['longitude'][0],
+                                                nmea_data['EW'][0]),
+                                float(nmea_data['speed'][0]),
+                                float(nmea_data['track'][0]))
+        depth_toa = nmea_data['depthm'][1]
+        if depth_toa > self.last_depth_toa:
+            self.last_depth_toa = depth_toa
+            self.fusion.add_depth(depth_toa, safe_depth(nmea_data))
+
+        for (pass_time, lat, lon, spd, trk,
+             s_g_delta, dpt) in self.fusion.fuse():
+            if self.check_minspeed:
+                self.paused = spd < self.minspeed
+            if self.paused:
+                self.stats['paused'] += 1
+                continue
+            self.add_position(pass_time, lat, lon, spd, trk, s_g_delta, dpt)
+
+    def add_position(self, pass_time, lat_deg, lon_deg, spd, trk,
+                     s_g_delta, dpt, lat=None, lon=None):
+        """
+        Insert a position row unless thinning drops it, committing and
+        logging periodically.
+        lat_deg/lon_deg are decimal degrees; lat/lon are the NMEA strings
+        kept for compatibility and are derived from them if omitted.
+        """
+        x = y = None
+        if self.project:
+            if self.utm_zone is None:
+                self.set_utm_zone(utm_zone(lat_deg, lon_deg))
+            x, y = to_utm(lat_deg, lon_deg, self.utm_zone)
+        if self.thinner is not None:
+            if x is None:
+                thin_x, thin_y = local_xy(lat_deg, lon_deg)
+            else:
+                thin_x, thin_y = x, y
+            if not self.thinner.accept(thin_x, thin_y, dpt):
+                self.stats['thinned'] += 1
+                return
+        if self.coverage is not None:
+            self.coverage.add(lat_deg, lon_deg, dpt)
+        if lat is None:
+            lat = ''.join(degrees_to_nmea(lat_deg, True))
+            lon = ''.join(degrees_to_nmea(lon_deg, False))
+        row = (pass_time, lat, lon, spd, trk, s_g_delta, dpt, self.sid,
+               lat_deg, lon_deg, x, y)
+        if self.ingest is not None:
+            if self.ingest.error is not None:
+                logging.critical('Batched ingest failed: %s',
+                                 self.ingest.error)
+                self._close()
+                sys.exit(1)
+            self.ingest.put(row)
+        else:
+            self.safe_execute(POSITION_INSERT, row)
+            self.delay.record(time.time() - pass_time)
+            if self.coverage is not None:
+                self.coverage.stored(self.cursor.lastrowid,
+                                     self.cursor.lastrowid)
+        self.position_counter += 1
+        
+        if self.ingest is None and not (self.position_counter %
+                                        self.commit_interval):
+            self.db.commit()
+        
+        if self.log_count and not (self.position_counter %
+                                   self.log_interval):
+            logging.info('Recorded %d points', self.position_counter)
             
+    def record_commit(self, batch):
+        """Ingest commit hook timing arrival to commit of every row"""
+        now = time.time()
+        for row in batch:
+            self.commit_delay.record(now - row[0])
+        if self.coverage is not None:
+            self.coverage.stored(self.ingest.last_rowid - len(batch) + 1,
+                                 self.ingest.last_rowid)
+
+    def set_utm_zone(self, zone):
+        """Fix the session's projection zone and record it"""
+        self.utm_zone = zone
+        self.safe_execute('UPDATE sessions SET utm_zone = ? WHERE _id = ?',
+                          (zone, self.sid))
+        self.db.commit()
+        logging.info('Projecting session to UTM zone %d.', zone)
+
     def safe_execute(self, querystring, argtuple):
         """Safely execute a query, logging a failure"""
         
@@ -156,16 +490,45 @@ def handle_sigterm(signum, sigframe):
     logging.info('Caught SIGTERM, exiting.')
     stopped = True
 
+def handle_sigusr1(signum, sigframe):
+    """SIGUSR1 handler function, starts or stops profiling here and in
+       every source worker"""
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except OSError:
+            pass
+    if profiler is not None:
+        profiler.toggle()
+
+def make_profiler(params, session=None, ingest=None, suffix=''):
+    """Set up the profiler SIGUSR1 toggles, with spans around the hot
+       paths of a session and a batched writer if enabled"""
+    global profiler
+    tracer = None
+    if params['profile_spans'] == 'True':
+        tracer = Tracer()
+        if session is not None:
+            tracer.register(json, 'load', 'json_load')
+            tracer.register(json, 'loads', 'json_loads')
+            tracer.register(session, 'check_add_position', 'update')
+            tracer.register(session, 'safe_execute', 'insert')
+            if isinstance(session.ingest, Ingest):
+                ingest = session.ingest
+        if ingest is not None:
+            tracer.register(ingest, 'flush', 'insert_batch')
+    profiler = Profiler(params['profile_file'] + suffix,
+                        float(params['profile_interval']), tracer)
+
+def stop_profiler():
+    """Write the report of a profile still running at exit"""
+    if profiler is not None and profiler.running:
+        profiler.stop()
+
 def load_config(fname):
     """Load a config file."""
-    required_params = [('scanner', ['db_file', 'nmea_file'])]
-    optional_params = [('scanner', {'minspeed':'0.5', 
-                                    'maxdelta':'1.0', 
-                                    'pause_on_stop':'True',
-                                    'polling_interval':'0.5',
-                                    'log_point_count':'True',
-                                    'log_point_count_interval':'1000',
-                                    'commit_interval':'500'})]
+    required_params = [('scanner', ['db_file'])]
+    optional_params = [('scanner', SCANNER_DEFAULTS)]
     cfg = ConfigParser.ConfigParser()
     cfg.read([fname])
     if not cfg.sections():
@@ -183,8 +546,289 @@ def load_config(fname):
         for option, value in section[1].iteritems():
             if not cfg.has_option(section[0], option):
                 cfg.set(section[0], option, value)
+
+    if cfg.get('scanner', 'journal_mode').upper() not in (
+            'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+        raise CfgErr, 'Unknown journal_mode \'%s\'!' % (
+            cfg.get('scanner', 'journal_mode'))
+    if cfg.get('scanner', 'synchronous').upper() not in (
+            'OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise CfgErr, 'Unknown synchronous setting \'%s\'!' % (
+            cfg.get('scanner', 'synchronous'))
+
+    sources = source_names(cfg)
+    if len(set(sources)) != len(sources):
+        raise CfgErr, 'Source listed twice in \'%s\'!' % (
+            cfg.get('scanner', 'sources'))
+    for name in sources:
+        if name == 'scanner' or not cfg.has_section(name):
+            raise CfgErr, 'Missing config section [%s] for source!' % name
+        check_transport(source_params(cfg, name), name)
+    if not sources:
+        check_transport(dict(cfg.items('scanner')), 'scanner')
     return cfg
 
+def check_transport(params, section):
+    """Check that the files a transport needs are configured"""
+    transport = params['transport']
+    if transport not in ('json', 'ring', 'socket'):
+        raise CfgErr, 'Unknown scanner transport \'%s\'!' % transport
+    required = {'json': 'nmea_file', 'ring': 'ring_file',
+                'socket': 'socket_file'}[transport]
+    if not params[required]:
+        raise CfgErr, ('Required config argument \'%s\' '
+                       'in section [%s] missing!') % (required, section)
+
+def source_names(cfg):
+    """Sections named by [scanner] sources, in order"""
+    return cfg.get('scanner', 'sources').replace(',', ' ').split()
+
+def source_params(cfg, name):
+    """[scanner] parameters overridden by those of a source's section;
+       the section name is the default source id"""
+    params = dict(cfg.items('scanner'))
+    params['source'] = name
+    params.update(cfg.items(name))
+    return params
+
+def follow_json(session, params):
+    """Poll NMEAd's json interface file and log positions"""
+    stats = metrics.counters('json')
+    try:
+        with open(params['nmea_file']) as f:
+            logging.info('Established connection to NMEAd.')
+            while not stopped:
+                with file_lock(f) as lock:
+                    if not lock:
+                        stats['lock_misses'] += 1
+                        time.sleep(LOCK_SLEEP_TIME)
+                        continue
+                    try:
+                        f.seek(0)
+                        json_file = json.load(f)
+                    except ValueError:
+                        stats['decode_errors'] += 1
+                        continue
+                stats['polls'] += 1
+                session.check_add_position(json_file)
+                time.sleep(float(params['polling_interval']))
+                
+    except IOError, err:
+        if err.errno == errno.ENOENT:
+            logging.critical(('Failed to establish connection to '
+                              'NMEAd through %s. Is NMEAd running? '
+                              'Does SBScan have the '
+                              'required permissions?'), 
+                              params['nmea_file'])
+            sys.exit()
+        else:
+            raise
+
+def follow_ring(session, params):
+    """Read every snapshot NMEAd appended to its ring file"""
+    try:
+        reader = RingReader(params['ring_file'])
+    except (IOError, RingError):
+        logging.critical(('Failed to establish connection to '
+                          'NMEAd through ring file %s. Is NMEAd running '
+                          'with the ring transport enabled?'),
+                          params['ring_file'])
+        sys.exit()
+    logging.info('Established ring connection to NMEAd.')
+    stats = metrics.counters('ring')
+    overruns = 0
+    try:
+        while not stopped:
+            records = reader.read()
+            if reader.overruns != overruns:
+                logging.warning('Ring overrun, %d snapshots lost.',
+                                reader.overruns - overruns)
+                overruns = reader.overruns
+                stats['overruns'] = overruns
+            stats['records'] += len(records)
+            for dummy, dummy2, payload in records:
+                try:
+                    nmea_data = json.loads(payload)
+                except ValueError:
+                    stats['decode_errors'] += 1
+                    continue
+                session.check_add_position(nmea_data)
+            if not records:
+                time.sleep(float(params['polling_interval']))
+    finally:
+        reader.close()
+
+def follow_socket(session, params):
+    """Subscribe to NMEAd's socket and log on every pushed update"""
+    try:
+        subscriber = Subscriber(params['socket_file'], NMEA_SUBSCRIBE)
+    except socket.error:
+        logging.critical(('Failed to establish connection to '
+                          'NMEAd through socket %s. Is NMEAd running '
+                          'with the socket transport enabled?'),
+                          params['socket_file'])
+        sys.exit()
+    logging.info('Subscribed to NMEAd.')
+    stats = metrics.counters('socket')
+    try:
+        while not stopped:
+            try:
+                updates = subscriber.receive(merge=False)
+            except (EOFError, FrameError, socket.error):
+                logging.critical('Lost connection to NMEAd.')
+                break
+            stats['frames'] += len(updates)
+            # Frames read together are applied one at a time, so every
+            # sounding is seen.
+            for update in updates:
+                subscriber.apply(update)
+                session.check_add_position(subscriber.state)
+    finally:
+        subscriber.close()
+
+def follow(session, params):
+    """Log positions from the configured transport until stopped"""
+    if params['transport'] == 'ring':
+        follow_ring(session, params)
+    elif params['transport'] == 'socket':
+        follow_socket(session, params)
+    else:
+        follow_json(session, params)
+
+def run_source(params, queue):
+    """Source worker process: follow one source into its own session"""
+    setproctitle.setproctitle('SBScan %s' % params['source'])
+    sink = SourceSink(params['source'], queue)
+    with Session(params, sink) as session:
+        make_profiler(params, session, suffix='.' + params['source'])
+        follow(session, params)
+    stop_profiler()
+    logging.info('Source %s: logged %d points.', params['source'],
+                 session.position_counter)
+
+def aggregate(params, sources):
+    """
+    Follow several sources at once, each in a worker process with its own
+    session, fusion and thinning state, and write every position through
+    one shared batched Ingest. A source that stalls or dies only stops
+    its own rows.
+    """
+    global stopped, worker_pids
+    try:
+        db = sqlite3.connect(params['db_file'])
+        add_source_column(db)
+    except sqlite3.Error:
+        logging.critical('Failed to open db file %s !', params['db_file'])
+        sys.exit(1)
+    coverage = None
+    if params['coverage_polygon']:
+        coverage = CoverageMonitor(db, params)
+    # Connections must not be shared with forked processes.
+    db.close()
+    queue = multiprocessing.Queue(INGEST_QUEUE_SIZE)
+    workers = {}
+    for source in sources:
+        worker = multiprocessing.Process(target=run_source,
+                                         args=(source, queue),
+                                         name=source['source'])
+        worker.start()
+        workers[source['source']] = worker
+    worker_pids = [worker.pid for worker in workers.itervalues()]
+    logging.info('Following %d sources.', len(workers))
+    if coverage is not None:
+        coverage.db = sqlite3.connect(params['db_file'])
+
+    # Started after forking; the workers have no use for the thread.
+    ingest = Ingest(params['db_file'], POSITION_INSERT,
+                    int(params['ingest_batch_size']),
+                    float(params['ingest_flush_interval']),
+                    params['journal_mode'], params['synchronous'])
+    commit_delay = metrics.histogram('ingest.toa_to_commit')
+    def record_commit(batch):
+        now = time.time()
+        for row in batch:
+            commit_delay.record(now - row[0])
+        if coverage is not None:
+            coverage.stored(ingest.last_rowid - len(batch) + 1,
+                            ingest.last_rowid)
+    ingest.on_commit = record_commit
+    make_profiler(params, ingest=ingest)
+    ingest.start()
+    metrics.gauge('ingest.written', lambda: ingest.written)
+    metrics.gauge('ingest.dropped', lambda: ingest.dropped)
+    metrics.gauge('ingest.queued', lambda: ingest.queue.qsize())
+    metrics.gauge('sources.alive', lambda: sum(worker.is_alive()
+                                               for worker in
+                                               workers.itervalues()))
+
+    counts = metrics.counters('sources')
+    stall_timeout = float(params['source_stall_timeout'])
+    last_row = dict((name, time.time()) for name in workers)
+    stalled = set()
+    running = set(workers)
+    terminated = False
+    next_check = 0
+    while running:
+        if stopped and not terminated:
+            for worker in workers.itervalues():
+                if worker.is_alive():
+                    worker.terminate()
+            terminated = True
+        if ingest.error is not None and not stopped:
+            logging.critical('Batched ingest failed: %s', ingest.error)
+            stopped = True
+            continue
+        try:
+            name, row = queue.get(True, AGGREGATE_WAIT)
+        except Queue.Empty:
+            pass
+        else:
+            ingest.put(row)
+            if coverage is not None:
+                coverage.add(row[8], row[9], row[6])
+            counts[name] += 1
+            last_row[name] = time.time()
+            if name in stalled:
+                stalled.discard(name)
+                logging.info('Source %s resumed.', name)
+        now = time.time()
+        if now < next_check:
+            continue
+        next_check = now + AGGREGATE_WAIT
+        for name in sorted(running):
+            if not workers[name].is_alive():
+                # Its rows were all queued before it exited.
+                running.discard(name)
+                if workers[name].exitcode and not stopped:
+                    logging.error('Source %s exited with status %d.',
+                                  name, workers[name].exitcode)
+            elif (now - last_row[name] > stall_timeout and
+                  name not in stalled):
+                stalled.add(name)
+                logging.warning('Source %s logged nothing for %d s.', name,
+                                stall_timeout)
+    # Rows still queued by workers that just exited.
+    while True:
+        try:
+            name, row = queue.get(True, AGGREGATE_WAIT)
+        except Queue.Empty:
+            break
+        ingest.put(row)
+        if coverage is not None:
+            coverage.add(row[8], row[9], row[6])
+        counts[name] += 1
+    for worker in workers.itervalues():
+        worker.join()
+    stop_profiler()
+    if ingest.error is not None:
+        sys.exit(1)
+    ingest.stop()
+    if coverage is not None:
+        coverage.close()
+        coverage.db.close()
+    logging.info('Ingest wrote %d points from %d sources.', ingest.written,
+                 len(workers))
+
 def main():
     """Program entry point"""
     apr = argparse.ArgumentParser()
@@ -215,37 +859,37 @@ def main():
         logging.info('Loaded config file.')
     
     params = dict(config.items('scanner'))
+    stats_writer = None
+    if params['stats_file']:
+        stats_writer = StatsWriter(metrics, params['stats_file'],
+                                   float(params['stats_interval']))
+        stats_writer.start()
     
+    sources = source_names(config)
+    if sources:
+        aggregate(params, [source_params(config, name) for name in sources])
+        if stats_writer is not None:
+            stats_writer.stop()
+        return
+
     with Session(params) as session:
-        try:
-            with open(params['nmea_file']) as f:
-                logging.info('Established connection to NMEAd.')
-                while not stopped:
-                    with file_lock(f) as lock:
-                        if not lock:
-                            time.sleep(LOCK_SLEEP_TIME)
-                            continue
-                        try:
-                            f.seek(0)
-                            json_file = json.load(f)
-                        except ValueError:
-                            continue
-                    print 'Check!'
-                    session.check_add_position(json_file)
-                    time.sleep(float(params['polling_interval']))
-                    
-        except IOError, err:
-            if err.errno == errno.ENOENT:
-                logging.critical(('Failed to establish connection to '
-                                  'NMEAd through %s. Is NMEAd running? '
-                                  'Does SBScan have the '
-                                  'required permissions?'), 
-                                  params['nmea_file'])
-                sys.exit()
-            else:
-                raise
+        make_profiler(params, session)
+        metrics.gauge('session.positions', lambda: session.position_counter)
+        if session.fusion is not None:
+            metrics.gauge('fusion.fused', lambda: session.fusion.fused)
+            metrics.gauge('fusion.rejected', lambda: session.fusion.rejected)
+        if session.ingest is not None:
+            metrics.gauge('ingest.written', lambda: session.ingest.written)
+            metrics.gauge('ingest.dropped', lambda: session.ingest.dropped)
+            metrics.gauge('ingest.queued',
+                          lambda: session.ingest.queue.qsize())
+        follow(session, params)
+    stop_profiler()
+    if stats_writer is not None:
+        stats_writer.stop()
                 
 if __name__ == '__main__':
     signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGUSR1, handle_sigusr1)
     setproctitle.setproctitle('SBScan')
     main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""
+Columnar archive of closed sessions. Each archived session is a directory
+holding one NumPy array file per positions column plus a json metadata
+file (session times, UTM zone, row count, time and coordinate extent).
+Columns are stored with the narrowest type that keeps their precision and
+the NMEA lat/lon strings are left out, as they are derived from the
+decimal degree columns.
+
+Uncompressed archives are memory mapped when loaded, so a session is
+available as arrays without converting a single row; compressed archives
+(--compress) take less space but are decompressed into memory on load.
+After archiving, the session's positions are deleted from the database
+unless --keep is given; the sessions row stays. survey.py reads archived
+and live sessions alike.
+
+Run as: archive.py DB_FILE ARCHIVE_DIR [SESSION_ID ...] [--keep]
+                   [--compress] [--vacuum]
+"""
+
+import os
+import json
+import shutil
+import sqlite3
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+from migrate_db import table_columns
+from postprocess import ensure_schema
+
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 100000
+
+# Column, archived dtype and the value NULLs are stored as.
+ARCHIVE_COLUMNS = [('_id', '<i8', 0),
+                   ('passing_time', '<f8', np.nan),
+                   ('lat_deg', '<f8', np.nan),
+                   ('lon_deg', '<f8', np.nan),
+                   ('x', '<f8', np.nan),
+                   ('y', '<f8', np.nan),
+                   ('speed', '<f4', np.nan),
+                   ('heading', '<f4', np.nan),
+                   ('time_between', '<f4', np.nan),
+                   ('depth', '<f4', np.nan),
+                   ('flags', '<i2', -1)]
+
+
+class ArchiveError(Exception):
+    """Archive file related error"""
+    pass
+
+
+def column_query(db, where, extra=()):
+    """SELECT of the extra and the archived columns from positions p;
+       columns older databases lack (flags, or the numeric coordinates
+       before migration) read as NULL"""
+    present = table_columns(db, 'positions')
+    names = list(extra) + ['p.%s' % name if name in present else 'NULL'
+                           for name, dummy, dummy2 in ARCHIVE_COLUMNS]
+    return 'SELECT %s FROM positions p %s' % (', '.join(names), where)
+
+def rows_to_columns(rows):
+    """Turn result rows into {column: array} of archived dtypes"""
+    if rows:
+        data = np.array(rows, dtype=np.float64)
+    else:
+        data = np.zeros((0, len(ARCHIVE_COLUMNS)))
+    columns = {}
+    for index, (name, dtype, null) in enumerate(ARCHIVE_COLUMNS):
+        values = data[:, index]
+        if np.dtype(dtype).kind == 'i':
+            values = np.where(np.isnan(values), null, values)
+        columns[name] = values.astype(dtype)
+    return columns
+
+def concatenate(parts):
+    """Join a list of {column: array} into one"""
+    if not parts:
+        return rows_to_columns([])
+    if len(parts) == 1:
+        return parts[0]
+    return dict((name, np.concatenate([part[name] for part in parts]))
+                for name in parts[0])
+
+def read_session(db, session_id, chunk_size=CHUNK_SIZE):
+    """Read a session's positions from the database as columns, converting
+       chunk by chunk"""
+    cursor = db.execute(column_query(db, 'WHERE p.session_id = ? '
+                                     'ORDER BY p._id'), (session_id,))
+    parts = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        parts.append(rows_to_columns(rows))
+    return concatenate(parts)
+
+def session_meta(db, session_id, columns):
+    """Metadata stored next to an archived session's columns"""
+    row = db.execute('SELECT starttime, stoptime, utm_zone FROM sessions '
+                     'WHERE _id = ?', (session_id,)).fetchone()
+    if row is None:
+        raise ArchiveError, 'No session %d.' % session_id
+    meta = {'version': ARCHIVE_VERSION, 'session_id': session_id,
+            'starttime': row[0], 'stoptime': row[1], 'utm_zone': row[2],
+            'count': len(columns['_id']),
+            'columns': dict((name, dtype)
+                            for name, dtype, dummy in ARCHIVE_COLUMNS)}
+    for name in ('passing_time', 'lat_deg', 'lon_deg'):
+        values = columns[name]
+        values = values[np.isfinite(values)]
+        if len(values):
+            meta[name] = [float(values.min()), float(values.max())]
+        else:
+            meta[name] = None
+    return meta
+
+
+def load_column(fname):
+    """Memory map a column file; empty columns cannot be mapped"""
+    try:
+        return np.load(fname, mmap_mode='r')
+    except ValueError:
+        return np.load(fname)
+
+
+class Archive(object):
+    """Directory of archived sessions"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, session_id):
+        """Directory of an archived session"""
+        return os.path.join(self.directory, 'session-%08d' % session_id)
+
+    def session_ids(self):
+        """Ids of every archived session"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(int(name[8:]) for name in names
+                      if name.startswith('session-') and
+                      name[8:].isdigit())
+
+    def __contains__(self, session_id):
+        return os.path.isdir(self.path(session_id))
+
+    def meta(self, session_id):
+        """Metadata of an archived session"""
+        try:
+            with open(os.path.join(self.path(session_id), 'meta.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            raise ArchiveError, ('Unable to read archived session %d.' %
+                                 session_id)
+
+    def load(self, session_id):
+        """Return {column: array} of an archived session, memory mapped
+           unless it was archived compressed"""
+        path = self.path(session_id)
+        columns = {}
+        try:
+            packed = os.path.join(path, 'columns.npz')
+            if os.path.exists(packed):
+                with np.load(packed) as data:
+                    for name, dummy, dummy2 in ARCHIVE_COLUMNS:
+                        columns[name] = data[name]
+            else:
+                for name, dummy, dummy2 in ARCHIVE_COLUMNS:
+                    columns[name] = load_column(os.path.join(path,
+                                                             name + '.npy'))
+        except (IOError, KeyError, ValueError):
+            raise ArchiveError, ('Unable to read archived session %d.' %
+                                 session_id)
+        return columns
+
+    def store(self, db, session_id, compress=False,
+              chunk_size=CHUNK_SIZE):
+        """Archive a session read from db; the session directory appears
+           atomically once complete. Returns its metadata."""
+        columns = read_session(db, session_id, chunk_size)
+        meta = session_meta(db, session_id, columns)
+        path = self.path(session_id)
+        tmppath = path + '.tmp'
+        if os.path.exists(tmppath):
+            shutil.rmtree(tmppath)
+        os.makedirs(tmppath)
+        if compress:
+            np.savez_compressed(os.path.join(tmppath, 'columns.npz'),
+                                **columns)
+        else:
+            for name, values in columns.iteritems():
+                np.save(os.path.join(tmppath, name + '.npy'), values)
+        with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        os.rename(tmppath, path)
+        return meta
+
+def compact(db, archive, session_ids, keep=False, compress=False,
+            chunk_size=CHUNK_SIZE):
+    """
+    Archive the given sessions unless already archived and, unless keep,
+    delete their positions once the archive holds all of them. Returns
+    the number of positions archived.
+    """
+    archived = 0
+    for session_id in session_ids:
+        if session_id in archive:
+            count = archive.meta(session_id)['count']
+        else:
+            count = archive.store(db, session_id, compress,
+                                  chunk_size)['count']
+            archived += count
+            logging.info('Archived session %d, %d positions.', session_id,
+                         count)
+        if keep:
+            continue
+        live = db.execute('SELECT count(*) FROM positions '
+                          'WHERE session_id = ?', (session_id,)).fetchone()[0]
+        if live > count:
+            logging.error('Session %d has %d positions but its archive %d, '
+                          'positions kept.', session_id, live, count)
+        elif live:
+            db.execute('DELETE FROM positions WHERE session_id = ?',
+                       (session_id,))
+            db.commit()
+    return archived
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to compact')
+    apr.add_argument('archive_dir', help='Archive directory')
+    apr.add_argument('sessions', nargs='*', type=int,
+                     help='Session ids (defaults to every closed session)')
+    apr.add_argument('--keep', action='store_true',
+                     help='Keep archived positions in the database')
+    apr.add_argument('--compress', action='store_true',
+                     help='Compress the archive (loaded without mmap)')
+    apr.add_argument('--vacuum', action='store_true',
+                     help='VACUUM the database afterwards')
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help='Rows read at once (default %d)' % CHUNK_SIZE)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    archive = Archive(app.archive_dir)
+    try:
+        db = sqlite3.connect(app.db_file)
+        ensure_schema(db)
+        closed = set(row[0] for row in db.execute(
+            'SELECT _id FROM sessions WHERE stoptime IS NOT NULL'))
+        sessions = app.sessions or sorted(closed)
+        for session_id in sessions:
+            if session_id not in closed:
+                logging.critical('Session %d is not closed.', session_id)
+                sys.exit(1)
+        count = compact(db, archive, sessions, app.keep, app.compress,
+                        app.chunk)
+        if app.vacuum:
+            db.execute('VACUUM')
+        db.close()
+    except (sqlite3.Error, ArchiveError, OSError):
+        logging.critical('Archiving %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    logging.info('Done, %d positions archived.', count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+Append-only capture of every raw NMEA line NMEAd receives. Lines are
+gathered into blocks, each block is zlib compressed and appended to the
+current capture file, and files are rotated once they exceed a size
+limit. Next to every capture file an index file holds one entry per
+block with its time range and offset, so a time range is found by
+reading the small index and decompressing only the blocks it overlaps.
+
+Capture file layout (little endian):
+    header: magic
+    blocks: compressed size, raw size, line count, min toa, max toa,
+            zlib compressed lines of 'toa device sentence\\n'
+Index file layout:
+    entries: min toa, max toa, block offset
+
+Blocks are written before their index entry, so the index never points
+past the data; a missing or short index is rebuilt from the block
+headers. A block cut short by a crash is ignored.
+
+Run standalone, this module exports a time range in the recorded log
+format nmea_replay.py reads:
+
+    capture.py DIRECTORY [--prefix PREFIX] [--start TIME] [--end TIME]
+               [--device NAME] [--output FILE]
+"""
+
+import os
+import sys
+import glob
+import time
+import zlib
+import struct
+import argparse
+
+CAPTURE_MAGIC = 'NMCP'
+CAPTURE_SUFFIX = '.cap'
+INDEX_SUFFIX = '.idx'
+CAPTURE_COMPRESSION = 6
+
+BLOCK_HEADER_FMT = '<IIIdd'
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FMT)
+INDEX_FMT = '<ddQ'
+INDEX_SIZE = struct.calcsize(INDEX_FMT)
+
+
+class CaptureError(Exception):
+    """Capture file related error"""
+    pass
+
+
+class CaptureLog(object):
+    """Writes lines into compressed blocks of size rotated capture files.
+       Not thread safe; NMEAd feeds it from a single thread."""
+    def __init__(self, directory, prefix='nmea', max_size=64 << 20,
+                 block_size=64 << 10, flush_interval=1.0):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.raw_size = 0
+        self.min_toa = self.max_toa = None
+        self.deadline = None
+        self.file = self.index = None
+        self.fname = None
+        self.sequence = 0
+        self.files = 0
+        self.blocks = 0
+        self.written = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.rotate()
+
+    def rotate(self):
+        """Close the current capture file and start a new one"""
+        self.close_files()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        while True:
+            self.sequence += 1
+            fname = os.path.join(self.directory, '%s-%s-%04d%s' % (
+                self.prefix, stamp, self.sequence, CAPTURE_SUFFIX))
+            if not os.path.exists(fname):
+                break
+        self.file = open(fname, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.index = open(fname[:-len(CAPTURE_SUFFIX)] + INDEX_SUFFIX, 'wb')
+        self.fname = fname
+        self.files += 1
+
+    def append(self, toa, device, sentence):
+        """Buffer a line, writing the block out once it is full. A new
+           block goes to a new file if the current one is full."""
+        line = '%.6f %s %s\n' % (toa, device, sentence)
+        self.lines.append(line)
+        self.raw_size += len(line)
+        if self.deadline is None:
+            if self.file.tell() >= self.max_size:
+                self.rotate()
+            self.min_toa = self.max_toa = toa
+            self.deadline = time.time() + self.flush_interval
+        elif toa < self.min_toa:
+            self.min_toa = toa
+        elif toa > self.max_toa:
+            self.max_toa = toa
+        if self.raw_size >= self.block_size:
+            self.flush()
+
+    def flush_due(self):
+        """Write the pending block if it is older than the flush interval"""
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        """Compress and append the pending block"""
+        if not self.lines:
+            return
+        data = zlib.compress(''.join(self.lines), CAPTURE_COMPRESSION)
+        offset = self.file.tell()
+        self.file.write(struct.pack(BLOCK_HEADER_FMT, len(data),
+                                    self.raw_size, len(self.lines),
+                                    self.min_toa, self.max_toa))
+        self.file.write(data)
+        self.file.flush()
+        self.index.write(struct.pack(INDEX_FMT, self.min_toa, self.max_toa,
+                                     offset))
+        self.index.flush()
+        self.blocks += 1
+        self.written += len(self.lines)
+        self.lines = []
+        self.raw_size = 0
+        self.deadline = None
+
+    def close_files(self):
+        """Close the current capture and index files"""
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = self.index = None
+
+    def close(self):
+        """Write the pending block and close"""
+        self.flush()
+        self.close_files()
+
+
+def scan_blocks(fname):
+    """Return [(min toa, max toa, offset)] read from the block headers"""
+    entries = []
+    with open(fname, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise CaptureError, 'Not a capture file: %s' % fname
+        size = os.fstat(f.fileno()).st_size
+        offset = f.tell()
+        while offset + BLOCK_HEADER_SIZE <= size:
+            (csize, dummy, dummy2, min_toa,
+             max_toa) = struct.unpack(BLOCK_HEADER_FMT,
+                                      f.read(BLOCK_HEADER_SIZE))
+            if offset + BLOCK_HEADER_SIZE + csize > size:
+                break
+            entries.append((min_toa, max_toa, offset))
+            offset += BLOCK_HEADER_SIZE + csize
+            f.seek(offset)
+    return entries
+
+def read_index(fname):
+    """Return the block index of a capture file, rebuilding it from the
+       block headers if the index file is missing or incomplete"""
+    iname = fname[:-len(CAPTURE_SUFFIX)] + INDEX_SUFFIX
+    try:
+        with open(iname, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return scan_blocks(fname)
+    entries = [struct.unpack_from(INDEX_FMT, data, pos)
+               for pos in xrange(0, len(data) - INDEX_SIZE + 1, INDEX_SIZE)]
+    if entries:
+        with open(fname, 'rb') as f:
+            f.seek(entries[-1][2])
+            header = f.read(BLOCK_HEADER_SIZE)
+            if len(header) == BLOCK_HEADER_SIZE:
+                csize = struct.unpack(BLOCK_HEADER_FMT, header)[0]
+                end = entries[-1][2] + BLOCK_HEADER_SIZE + csize
+                if end < os.fstat(f.fileno()).st_size:
+                    return scan_blocks(fname)
+    elif os.path.getsize(fname) > len(CAPTURE_MAGIC):
+        return scan_blocks(fname)
+    return entries
+
+def read_block(f, offset):
+    """Return the decompressed lines of the block at offset"""
+    f.seek(offset)
+    csize = struct.unpack(BLOCK_HEADER_FMT, f.read(BLOCK_HEADER_SIZE))[0]
+    return zlib.decompress(f.read(csize)).splitlines()
+
+def capture_files(directory, prefix='nmea'):
+    """Capture files in a directory, oldest first"""
+    return sorted(glob.glob(os.path.join(directory, '%s-*%s' % (
+        prefix, CAPTURE_SUFFIX))))
+
+def read_range(files, start=None, end=None, device=None):
+    """
+    Yield (toa, device, sentence) for every captured line with start <=
+    toa <= end, in capture order. Only blocks whose time range overlaps
+    the requested one are decompressed.
+    """
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    for fname in files:
+        entries = [entry for entry in read_index(fname)
+                   if entry[1] >= start and entry[0] <= end]
+        if not entries:
+            continue
+        with open(fname, 'rb') as f:
+            for dummy, dummy2, offset in entries:
+                for line in read_block(f, offset):
+                    stamp, name, sentence = line.split(' ', 2)
+                    toa = float(stamp)
+                    if (start <= toa <= end and
+                            (device is None or name == device)):
+                        yield toa, name, sentence
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('directory', help='NMEAd capture directory')
+    apr.add_argument('--prefix', default='nmea',
+                     help='Capture file name prefix (default nmea)')
+    apr.add_argument('--start', type=float, help='First unix time exported')
+    apr.add_argument('--end', type=float, help='Last unix time exported')
+    apr.add_argument('--device',
+                     help='Only export lines from this device (e.g. GPS)')
+    apr.add_argument('--output', help='Output log file (default stdout)')
+    app = apr.parse_args()
+
+    files = capture_files(app.directory, app.prefix)
+    if not files:
+        sys.exit('No capture files in %s' % app.directory)
+    out = open(app.output, 'w') if app.output else sys.stdout
+    try:
+        for toa, dummy, sentence in read_range(files, app.start, app.end,
+                                               app.device):
+            out.write('%.6f %s\n' % (toa, sentence))
+    except CaptureError, err:
+        sys.exit(str(err))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
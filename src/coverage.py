@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+"""
+Survey coverage map. The survey area is a polygon of decimal degree
+vertices, read from a text file of "lat lon" lines or from a GeoJSON
+Polygon, and covered by a grid of square cells in local metres around
+its centroid. Every logged position marks the cells its swath reaches:
+a disc whose diameter grows with depth as 2 * depth * tan(beam angle /
+2), clamped between a minimum and a maximum swath, so a position costs
+at most one fixed size stencil of cells. Cells keep a saturating 8 bit
+count, and the number of covered cells inside the polygon is kept up to
+date as cells are first reached, so the covered percentage is always at
+hand. Uncovered gaps are found on demand as connected runs of empty
+cells.
+
+The map is stored in the coverage table of the database together with
+the last position it includes, so SBScan resumes it by reading only the
+positions logged since. The map is rebuilt from every position if the
+polygon or the swath parameters changed.
+
+Run as: coverage.py DB_FILE POLYGON_FILE [--cell-size METRES]
+                    [--beam-angle DEGREES] [--output REPORT_FILE] [--save]
+"""
+
+import os
+import math
+import json
+import zlib
+import sqlite3
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+from thinning import M_PER_DEG_LAT, M_PER_DEG_LON
+
+CHUNK_SIZE = 100000
+BATCH_CELLS = 1 << 22
+MAX_COUNT = 255
+
+COVERAGE_DDL = ('CREATE TABLE IF NOT EXISTS coverage('
+                'name TEXT PRIMARY KEY, params TEXT, last_id INTEGER, '
+                'shape TEXT, counts BLOB)')
+CATCH_UP_QUERY = ('SELECT _id, lat_deg, lon_deg, depth FROM positions '
+                  'WHERE _id > ? AND _id <= ? AND lat_deg BETWEEN ? AND ? '
+                  'AND lon_deg BETWEEN ? AND ? ORDER BY _id LIMIT ?')
+
+
+class CoverageError(Exception):
+    """Polygon or coverage state related error"""
+    pass
+
+
+def load_polygon(fname):
+    """Read [(lat, lon), ...] from a "lat lon" text file or the outer
+       ring of a GeoJSON Polygon (lon, lat ordered)"""
+    try:
+        with open(fname) as f:
+            text = f.read()
+        if text.lstrip().startswith('{'):
+            data = json.loads(text)
+            if data.get('type') == 'Feature':
+                data = data['geometry']
+            if data.get('type') == 'FeatureCollection':
+                data = data['features'][0]['geometry']
+            if data.get('type') != 'Polygon':
+                raise CoverageError, 'No Polygon in %s.' % fname
+            vertices = [(float(lat), float(lon))
+                        for lon, lat in (point[:2] for point
+                                         in data['coordinates'][0])]
+        else:
+            vertices = [tuple(float(value) for value in
+                              line.replace(',', ' ').split()[:2])
+                        for line in text.splitlines()
+                        if line.strip() and not line.startswith('#')]
+    except (IOError, ValueError, KeyError, IndexError, TypeError):
+        raise CoverageError, 'Unable to read survey polygon %s.' % fname
+    if vertices and vertices[0] == vertices[-1]:
+        vertices.pop()
+    if len(vertices) < 3:
+        raise CoverageError, ('Survey polygon %s has under 3 vertices.' %
+                              fname)
+    return vertices
+
+def inside_polygon(x, y, px, py):
+    """Even-odd rule test of point arrays against a polygon"""
+    inside = np.zeros(x.shape, dtype=bool)
+    for index in xrange(len(px)):
+        x1, y1 = px[index - 1], py[index - 1]
+        x2, y2 = px[index], py[index]
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        at = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < at)
+    return inside
+
+def disc(radius):
+    """(dy, dx) offsets of the cells whose centres lie within radius
+       cells of a cell centre"""
+    reach = int(math.floor(radius))
+    dy, dx = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    keep = dy * dy + dx * dx <= radius * radius
+    return dy[keep], dx[keep]
+
+
+class Coverage(object):
+    """Coverage count grid over a survey polygon"""
+    def __init__(self, polygon, cell_size=2.0, beam_angle=10.0,
+                 min_swath=1.0, max_swath=50.0):
+        self.polygon = [tuple(vertex) for vertex in polygon]
+        self.cell_size = float(cell_size)
+        self.beam_angle = float(beam_angle)
+        self.min_swath = float(min_swath)
+        self.max_swath = float(max_swath)
+        self.tan = math.tan(math.radians(self.beam_angle) / 2)
+        lat = np.array([vertex[0] for vertex in self.polygon])
+        lon = np.array([vertex[1] for vertex in self.polygon])
+        self.lat0 = float(lat.mean())
+        self.lon0 = float(lon.mean())
+        self.x_scale = math.cos(math.radians(self.lat0)) * M_PER_DEG_LON
+        px, py = self.local(lat, lon)
+        self.x0 = math.floor(px.min() / self.cell_size) * self.cell_size
+        self.y0 = math.floor(py.min() / self.cell_size) * self.cell_size
+        cols = int(math.ceil((px.max() - self.x0) / self.cell_size)) + 1
+        rows = int(math.ceil((py.max() - self.y0) / self.cell_size)) + 1
+        cx = self.x0 + (np.arange(cols) + 0.5) * self.cell_size
+        cy = self.y0 + (np.arange(rows) + 0.5) * self.cell_size
+        cx, cy = np.meshgrid(cx, cy)
+        self.mask = inside_polygon(cx, cy, px, py)
+        self.target = int(np.count_nonzero(self.mask))
+        self.counts = np.zeros((rows, cols), dtype=np.uint8)
+        self.covered = 0
+        self.last_id = 0
+        self.stencils = {}
+        # Positions further out than the widest swath cannot reach the
+        # polygon.
+        pad_lat = self.max_swath / M_PER_DEG_LAT
+        pad_lon = self.max_swath / self.x_scale
+        self.bounds = (float(lat.min()) - pad_lat,
+                       float(lat.max()) + pad_lat,
+                       float(lon.min()) - pad_lon,
+                       float(lon.max()) + pad_lon)
+
+    @property
+    def shape(self):
+        """(rows, columns) of the grid"""
+        return self.counts.shape
+
+    def params(self):
+        """Everything a stored map has to match to be resumed"""
+        return json.dumps({'polygon': self.polygon,
+                           'cell_size': self.cell_size,
+                           'beam_angle': self.beam_angle,
+                           'min_swath': self.min_swath,
+                           'max_swath': self.max_swath}, sort_keys=True)
+
+    def local(self, lat, lon):
+        """Local metres around the polygon's centroid"""
+        return ((lon - self.lon0) * self.x_scale,
+                (lat - self.lat0) * M_PER_DEG_LAT)
+
+    def degrees(self, x, y):
+        """Inverse of local"""
+        return (y / M_PER_DEG_LAT + self.lat0,
+                x / self.x_scale + self.lon0)
+
+    def radius_key(self, depth):
+        """Swath radius in quarter cells, the stencil cache key"""
+        swath = min(max(2 * depth * self.tan, self.min_swath),
+                    self.max_swath)
+        return int(math.floor(swath / 2 / self.cell_size * 4 + 0.5))
+
+    def stencil(self, key):
+        """Cached disc stencil of a radius key"""
+        stencil = self.stencils.get(key)
+        if stencil is None:
+            stencil = self.stencils[key] = disc(key / 4.0)
+        return stencil
+
+    def add(self, lat, lon, depth):
+        """Mark the swath of one position; cost is bounded by the
+           stencil of the maximum swath"""
+        if not depth > 0 or lat is None or lon is None:
+            return
+        x, y = self.local(lat, lon)
+        key = self.radius_key(depth)
+        reach = key // 4 + 1
+        ix = int(math.floor((x - self.x0) / self.cell_size))
+        iy = int(math.floor((y - self.y0) / self.cell_size))
+        rows, cols = self.counts.shape
+        if (ix < -reach or iy < -reach or ix >= cols + reach or
+                iy >= rows + reach):
+            return
+        dy, dx = self.stencil(key)
+        cy = dy + iy
+        cx = dx + ix
+        if ix < reach or iy < reach or ix >= cols - reach or \
+                iy >= rows - reach:
+            keep = (cy >= 0) & (cy < rows) & (cx >= 0) & (cx < cols)
+            cy = cy[keep]
+            cx = cx[keep]
+        cells = self.counts[cy, cx]
+        self.covered += int(np.count_nonzero((cells == 0) &
+                                             self.mask[cy, cx]))
+        self.counts[cy, cx] = np.where(cells < MAX_COUNT, cells + 1,
+                                       MAX_COUNT)
+
+    def add_points(self, lat, lon, depth):
+        """Mark the swaths of arrays of positions in bulk"""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        depth = np.asarray(depth, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(lat) & np.isfinite(lon) & (depth > 0)
+        x, y = self.local(lat[valid], lon[valid])
+        depth = depth[valid]
+        if not len(depth):
+            return
+        swath = np.clip(2 * depth * self.tan, self.min_swath, self.max_swath)
+        keys = np.floor(swath / 2 / self.cell_size * 4 +
+                        0.5).astype(np.int64)
+        ix = np.floor((x - self.x0) / self.cell_size).astype(np.int64)
+        iy = np.floor((y - self.y0) / self.cell_size).astype(np.int64)
+        rows, cols = self.counts.shape
+        added = np.zeros(rows * cols, dtype=np.int64)
+        for key in np.unique(keys):
+            dy, dx = self.stencil(int(key))
+            chosen = np.flatnonzero(keys == key)
+            step = max(1, BATCH_CELLS // len(dy))
+            for start in xrange(0, len(chosen), step):
+                part = chosen[start:start + step]
+                cy = (iy[part, None] + dy[None, :]).ravel()
+                cx = (ix[part, None] + dx[None, :]).ravel()
+                keep = (cy >= 0) & (cy < rows) & (cx >= 0) & (cx < cols)
+                added += np.bincount(cy[keep] * cols + cx[keep],
+                                     minlength=rows * cols)
+        counts = self.counts.reshape(-1)
+        self.covered += int(np.count_nonzero((counts == 0) & (added > 0) &
+                                             self.mask.reshape(-1)))
+        counts[:] = np.minimum(counts + added, MAX_COUNT)
+
+    def percent(self):
+        """Covered share of the polygon's cells in percent"""
+        return 100.0 * self.covered / self.target if self.target else 0.0
+
+    def gaps(self, min_cells=1):
+        """
+        Return the uncovered regions inside the polygon, 4-connected,
+        of at least min_cells cells, largest first, as dicts of cell
+        count, area in square metres, centroid and bounding box in
+        decimal degrees.
+        """
+        empty = self.mask & (self.counts == 0)
+        parent = []
+        def find(run):
+            while parent[run] != run:
+                parent[run] = parent[parent[run]]
+                run = parent[run]
+            return run
+        runs = []
+        previous = []
+        for row in xrange(empty.shape[0]):
+            edges = np.diff(np.concatenate(([0], empty[row].view(np.int8),
+                                            [0])))
+            current = []
+            for start, end in zip(np.flatnonzero(edges == 1).tolist(),
+                                  np.flatnonzero(edges == -1).tolist()):
+                run = len(runs)
+                runs.append((row, start, end))
+                parent.append(run)
+                current.append(run)
+            # Join overlapping runs of neighbouring rows.
+            above = 0
+            for run in current:
+                dummy, start, end = runs[run]
+                while above < len(previous) and \
+                        runs[previous[above]][2] <= start:
+                    above += 1
+                other = above
+                while other < len(previous) and \
+                        runs[previous[other]][1] < end:
+                    parent[find(run)] = find(previous[other])
+                    other += 1
+            previous = current
+        regions = {}
+        for run, (row, start, end) in enumerate(runs):
+            region = regions.setdefault(find(run), [0, 0.0, 0.0, row, row,
+                                                    start, end - 1])
+            length = end - start
+            region[0] += length
+            region[1] += (start + end - 1) * length / 2.0
+            region[2] += row * length
+            region[3] = min(region[3], row)
+            region[4] = max(region[4], row)
+            region[5] = min(region[5], start)
+            region[6] = max(region[6], end - 1)
+        gaps = []
+        for cells, sum_x, sum_y, row0, row1, col0, col1 in regions.values():
+            if cells < min_cells:
+                continue
+            lat, lon = self.degrees(self.x0 + (sum_x / cells + 0.5) *
+                                    self.cell_size,
+                                    self.y0 + (sum_y / cells + 0.5) *
+                                    self.cell_size)
+            south, west = self.degrees(self.x0 + col0 * self.cell_size,
+                                       self.y0 + row0 * self.cell_size)
+            north, east = self.degrees(self.x0 + (col1 + 1) * self.cell_size,
+                                       self.y0 + (row1 + 1) * self.cell_size)
+            gaps.append({'cells': cells,
+                         'area': cells * self.cell_size ** 2,
+                         'lat': lat, 'lon': lon,
+                         'bbox': [south, west, north, east]})
+        gaps.sort(key=lambda gap: -gap['cells'])
+        return gaps
+
+    def report(self, min_cells=1):
+        """Json serialisable coverage summary"""
+        return {'percent': self.percent(),
+                'covered_cells': self.covered,
+                'polygon_cells': self.target,
+                'cell_size': self.cell_size,
+                'last_id': self.last_id,
+                'gaps': self.gaps(min_cells)}
+
+    def catch_up(self, db, stop=None, chunk_size=CHUNK_SIZE):
+        """Add the positions logged after last_id, up to id stop (by
+           default the last one logged when called), that can reach the
+           polygon. Returns the number of positions read."""
+        if stop is None:
+            stop = db.execute('SELECT coalesce(max(_id), 0) '
+                              'FROM positions').fetchone()[0]
+        south, north, west, east = self.bounds
+        added = 0
+        while True:
+            rows = db.execute(CATCH_UP_QUERY, (self.last_id, stop, south,
+                                               north, west, east,
+                                               chunk_size)).fetchall()
+            if not rows:
+                break
+            data = np.array(rows, dtype=np.float64)
+            self.add_points(data[:, 1], data[:, 2], data[:, 3])
+            self.last_id = int(data[-1, 0])
+            added += len(rows)
+        self.last_id = max(self.last_id, stop)
+        return added
+
+    def save(self, db, name, live=()):
+        """
+        Store the map in db and commit. live lists the (first, last) id
+        ranges of stored positions that were marked with add as they were
+        logged; last_id advances over them, and positions between them
+        that were not marked are read from db first. Positions marked but
+        not yet stored are added again on resume, which only raises
+        their cells' counts.
+        """
+        for first, last in sorted(live):
+            if first > self.last_id + 1:
+                self.catch_up(db, first - 1)
+            self.last_id = max(self.last_id, last)
+        db.execute(COVERAGE_DDL)
+        db.execute('INSERT OR REPLACE INTO coverage(name, params, last_id, '
+                   'shape, counts) VALUES (?, ?, ?, ?, ?)',
+                   (name, self.params(), self.last_id,
+                    json.dumps(self.shape),
+                    sqlite3.Binary(zlib.compress(self.counts.tostring()))))
+        db.commit()
+
+    @classmethod
+    def resume(cls, db, name, *args, **kwargs):
+        """
+        Return the map stored in db under name, brought up to date with
+        the positions logged since, or a new one built from every
+        position if none matching the parameters was stored.
+        """
+        coverage = cls(*args, **kwargs)
+        db.execute(COVERAGE_DDL)
+        row = db.execute('SELECT params, last_id, shape, counts '
+                         'FROM coverage WHERE name = ?', (name,)).fetchone()
+        if row is not None and row[0] == coverage.params():
+            try:
+                counts = np.frombuffer(zlib.decompress(row[3]),
+                                       dtype=np.uint8)
+                coverage.counts = counts.reshape(json.loads(row[2])).copy()
+            except (zlib.error, ValueError, TypeError):
+                raise CoverageError, 'Stored coverage %s is corrupt.' % name
+            coverage.covered = int(np.count_nonzero(coverage.mask &
+                                                    (coverage.counts > 0)))
+            coverage.last_id = row[1]
+        elif row is not None:
+            logging.info('Coverage parameters changed, rebuilding %s.', name)
+        coverage.catch_up(db)
+        return coverage
+
+def write_report(report, fname):
+    """Atomically write a coverage report json file"""
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.rename(tmpname, fname)
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to read')
+    apr.add_argument('polygon_file', help='Survey polygon file')
+    apr.add_argument('--name', help='Stored map name (default: polygon '
+                     'file name)')
+    apr.add_argument('--cell-size', type=float, default=2.0,
+                     help='Cell size in metres (default 2)')
+    apr.add_argument('--beam-angle', type=float, default=10.0,
+                     help='Full beam angle in degrees (default 10)')
+    apr.add_argument('--min-swath', type=float, default=1.0,
+                     help='Minimum swath width in metres (default 1)')
+    apr.add_argument('--max-swath', type=float, default=50.0,
+                     help='Maximum swath width in metres (default 50)')
+    apr.add_argument('--min-gap', type=int, default=4,
+                     help='Smallest gap reported, in cells (default 4)')
+    apr.add_argument('--output', help='Write the report to a json file')
+    apr.add_argument('--save', action='store_true',
+                     help='Store the updated map in the database')
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    name = app.name or os.path.basename(app.polygon_file)
+    try:
+        polygon = load_polygon(app.polygon_file)
+        db = sqlite3.connect(app.db_file)
+        coverage = Coverage.resume(db, name, polygon, app.cell_size,
+                                   app.beam_angle, app.min_swath,
+                                   app.max_swath)
+        if app.save:
+            coverage.save(db, name)
+        db.close()
+        report = coverage.report(app.min_gap)
+        if app.output:
+            write_report(report, app.output)
+    except (sqlite3.Error, CoverageError, IOError, OSError):
+        logging.critical('Coverage of %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    logging.info('Covered %.1f%% of %d cells, %d gaps.', report['percent'],
+                 report['polygon_cells'], len(report['gaps']))
+    for gap in report['gaps'][:10]:
+        logging.info('Gap of %.0f m2 around %.6f, %.6f', gap['area'],
+                     gap['lat'], gap['lon'])
+
+if __name__ == '__main__':
+    main()
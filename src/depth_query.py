@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+
+"""
+Depth at arbitrary locations, for single points and along planned
+tracks. Clean soundings (positive depth, not flagged by postprocess.py)
+are kept in a persistent spatial index, a separate sqlite file of square
+buckets of decimal degrees holding the coordinates and depths of the
+soundings inside them. A query only reads the buckets within its search
+radius; recently used buckets are kept in memory in an LRU cache.
+
+Depths are interpolated with vectorised NumPy from the soundings within
+the search radius of each query point, either the nearest one or an
+inverse distance weighted (IDW) mean of the nearest few. Points without
+soundings within the radius get nan.
+
+The index records the last position it includes and is brought up to
+date incrementally from the positions SBScan logged since, touching only
+the buckets the new soundings fall into. Like reprocess.py, it also keeps
+a signature of every session's clean soundings, updated from the rows
+read. Checking them reads every position, so it is done on demand: the
+sessions flagged, reprocessed or edited after they were indexed are then
+taken out of the buckets they touched and indexed again. Readers in
+other processes drop just the rewritten buckets from their caches.
+
+Run as: depth_query.py DB_FILE [--index INDEX_FILE] [--point LAT LON]
+                       [--track TRACK_FILE] [--method idw|nearest]
+                       [--radius METRES] [--follow SECONDS] [options]
+"""
+
+import json
+import math
+import time
+import sqlite3
+import argparse
+import logging
+import collections
+import sys
+
+import numpy as np
+
+from archive import Archive, ArchiveError
+from migrate_db import table_columns
+from thinning import M_PER_DEG_LAT, M_PER_DEG_LON
+
+CHUNK_SIZE = 100000
+PENDING_POINTS = 1000000
+BUCKET_SIZE = 50.0      # Metres
+CACHE_BUCKETS = 4096
+RADIUS = 10.0           # Metres
+NEIGHBOURS = 8
+POWER = 2.0
+SPACING = 5.0           # Metres
+CHECK_INTERVAL = 3600   # Seconds
+BATCH_PAIRS = 1 << 22
+
+# Bucket keys pack the row and column of a bucket into one integer.
+KEY_BITS = 26
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+# Bumped whenever the layout of the index file changes.
+INDEX_VERSION = 2
+
+INDEX_DDL = ['CREATE TABLE IF NOT EXISTS index_meta('
+             'name TEXT PRIMARY KEY, value TEXT)',
+             'CREATE TABLE IF NOT EXISTS buckets('
+             'key INTEGER PRIMARY KEY, changed INTEGER, count INTEGER, '
+             'lat BLOB, lon BLOB, depth BLOB, session BLOB)',
+             'CREATE INDEX IF NOT EXISTS buckets_changed '
+             'ON buckets(changed)',
+             'CREATE TABLE IF NOT EXISTS sessions('
+             'session_id INTEGER PRIMARY KEY, rows INTEGER, id_sum INTEGER, '
+             'depth_sum INTEGER, keys BLOB)']
+
+# Per session signatures of the clean soundings up to a position: their
+# count and the integer sums of their ids and depths in centimetres, which
+# add up exactly as rows are read.
+SIGNATURE_QUERY = ('SELECT coalesce(session_id, 0), count(*), sum(_id), '
+                   'sum(CAST(round(%s * 100) AS INTEGER)) '
+                   'FROM positions WHERE _id <= ? AND %s '
+                   'GROUP BY coalesce(session_id, 0)')
+NO_SIGNATURE = (0, 0, 0)
+
+
+class QueryError(Exception):
+    """Depth index related error"""
+    pass
+
+
+def densify(lat, lon, spacing=SPACING):
+    """
+    densify(lat: ndarray, lon: ndarray, spacing: float) -> (ndarray,
+                                                           ndarray, ndarray)
+
+    Points every spacing metres along a polyline, its vertices included,
+    as (distance along the track, lat, lon).
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if len(lat) < 2:
+        return np.zeros(len(lat)), lat, lon
+    mid = np.radians((lat[1:] + lat[:-1]) / 2)
+    legs = np.hypot(np.diff(lon) * M_PER_DEG_LON * np.cos(mid),
+                    np.diff(lat) * M_PER_DEG_LAT)
+    steps = np.maximum(np.ceil(legs / spacing), 1).astype(np.int64)
+    leg = np.repeat(np.arange(len(legs)), steps)
+    first = np.cumsum(steps) - steps
+    fraction = (np.arange(steps.sum()) - first[leg]) / \
+        steps[leg].astype(np.float64)
+    start = np.concatenate(([0.0], np.cumsum(legs)))
+    distance = np.append(start[leg] + fraction * legs[leg], start[-1])
+    out_lat = np.append(lat[leg] + fraction * (lat[leg + 1] - lat[leg]),
+                        lat[-1])
+    out_lon = np.append(lon[leg] + fraction * (lon[leg + 1] - lon[leg]),
+                        lon[-1])
+    return distance, out_lat, out_lon
+
+def interpolate(qlat, qlon, plat, plon, pdepth, method='idw',
+                radius=RADIUS, neighbours=NEIGHBOURS, power=POWER):
+    """
+    Depths at query points from candidate soundings: the nearest one, or
+    the inverse distance weighted mean of the nearest neighbours, within
+    radius metres; nan where there are none.
+    """
+    result = np.empty(len(qlat))
+    limit = radius * radius
+    step = max(BATCH_PAIRS // max(len(plat), 1), 1)
+    k = min(neighbours, len(plat))
+    for start in xrange(0, len(qlat), step):
+        rows = slice(start, start + step)
+        scale = M_PER_DEG_LON * np.cos(np.radians(qlat[rows]))
+        dx = (plon[np.newaxis, :] - qlon[rows, np.newaxis]) * \
+            scale[:, np.newaxis]
+        dy = (plat[np.newaxis, :] - qlat[rows, np.newaxis]) * M_PER_DEG_LAT
+        dist2 = dx * dx + dy * dy
+        index = np.arange(len(dist2))[:, np.newaxis]
+        if method == 'nearest':
+            nearest = np.argmin(dist2, axis=1)
+            found = dist2[index[:, 0], nearest] <= limit
+            result[rows] = np.where(found, pdepth[nearest], np.nan)
+            continue
+        if k < len(plat):
+            nearest = np.argpartition(dist2, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(len(plat)), dist2.shape)
+        near2 = dist2[index, nearest]
+        # A sounding right at the query point outweighs every other one.
+        weights = np.where(near2 <= limit,
+                           np.maximum(near2, 1e-12) ** (-power / 2), 0)
+        total = weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[rows] = np.where(total > 0, (weights *
+                                                pdepth[nearest]).sum(axis=1)
+                                    / total, np.nan)
+    return result
+
+
+class DepthIndex(object):
+    """Persistent bucket index of soundings with an LRU bucket cache"""
+    def __init__(self, index_file, bucket_size=BUCKET_SIZE,
+                 depth_column='depth', cache_buckets=CACHE_BUCKETS):
+        self.bucket_size = float(bucket_size)
+        self.bucket_deg = self.bucket_size / M_PER_DEG_LAT
+        self.depth_column = depth_column
+        self.cache = collections.OrderedDict()
+        self.cache_buckets = cache_buckets
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        self.db = sqlite3.connect(index_file)
+        for statement in INDEX_DDL:
+            self.db.execute(statement)
+        meta = dict(self.db.execute('SELECT name, value FROM index_meta'))
+        if meta.get('params') != self.params:
+            if meta:
+                logging.info('Index parameters changed, rebuilding.')
+            self.db.execute('DROP TABLE buckets')
+            self.db.execute('DROP TABLE sessions')
+            for statement in INDEX_DDL:
+                self.db.execute(statement)
+            self.db.execute('DELETE FROM index_meta')
+            meta = {'params': self.params, 'last_id': '', 'generation': '0',
+                    'built': repr(time.time())}
+            self.db.executemany('INSERT INTO index_meta VALUES (?,?)',
+                                meta.items())
+        self.db.commit()
+        self.last_id = int(meta['last_id']) if meta['last_id'] else None
+        self.generation = int(meta['generation'])
+        self.built = meta['built']
+        self.data_version = self.version()
+
+    @property
+    def params(self):
+        """Parameters the stored index must have been built with"""
+        return json.dumps({'bucket_size': self.bucket_size,
+                           'depth_column': self.depth_column,
+                           'version': INDEX_VERSION},
+                          sort_keys=True)
+
+    def close(self):
+        """Close the index file"""
+        self.db.close()
+
+    def version(self):
+        """Changes whenever another connection commits to the index"""
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def cells(self, lat, lon):
+        """Bucket rows and columns of points"""
+        return (np.floor(lat / self.bucket_deg).astype(np.int64),
+                np.floor(lon / self.bucket_deg).astype(np.int64))
+
+    @staticmethod
+    def key(row, column):
+        """Bucket key of a bucket row and column"""
+        return ((row + KEY_OFFSET) << KEY_BITS) + (column + KEY_OFFSET)
+
+    def load(self, key, sessions=False):
+        """Read a bucket from the index file, with the session ids of its
+           soundings if sessions"""
+        row = self.db.execute('SELECT lat, lon, depth, session FROM buckets '
+                              'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            row = ('', '', '', '')
+        entry = (np.frombuffer(row[0], np.float64),
+                 np.frombuffer(row[1], np.float64),
+                 np.frombuffer(row[2], np.float32),
+                 np.frombuffer(row[3], np.int64))
+        return entry if sessions else entry[:3]
+
+    def store(self, key, generation, lat, lon, depth, session):
+        """Write a bucket, without committing"""
+        self.db.execute('INSERT OR REPLACE INTO buckets '
+                        'VALUES (?,?,?,?,?,?,?)',
+                        (key, generation, len(lat), buffer(lat.tobytes()),
+                         buffer(lon.tobytes()), buffer(depth.tobytes()),
+                         buffer(session.tobytes())))
+        self.cache.pop(key, None)
+
+    def bucket(self, key):
+        """A bucket's (lat, lon, depth) arrays, from the cache if hot;
+           empty buckets are cached too"""
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = self.load(key)
+        else:
+            self.hits += 1
+        self.cache[key] = entry
+        while len(self.cache) > self.cache_buckets:
+            self.cache.popitem(last=False)
+        return entry
+
+    def check(self):
+        """Drop cached buckets another process changed since"""
+        version = self.version()
+        if version == self.data_version:
+            return
+        self.data_version = version
+        meta = dict(self.db.execute('SELECT name, value FROM index_meta'))
+        generation = int(meta['generation'])
+        if meta['built'] != self.built:
+            # Rebuilt from scratch.
+            self.cache.clear()
+            self.built = meta['built']
+        else:
+            for (key,) in self.db.execute('SELECT key FROM buckets '
+                                          'WHERE changed > ?',
+                                          (self.generation,)):
+                self.cache.pop(key, None)
+        self.generation = generation
+
+    def add(self, lat, lon, depth, session):
+        """Queue soundings of the given sessions for the next flush"""
+        self.pending.append((np.asarray(lat, np.float64),
+                             np.asarray(lon, np.float64),
+                             np.asarray(depth, np.float32),
+                             np.asarray(session, np.int64)))
+
+    def flush(self, last_id, signatures=None):
+        """Append the queued soundings to their buckets and record
+           last_id and the session signatures, in one transaction"""
+        generation = self.generation + 1
+        if self.pending:
+            values = [np.concatenate(parts) for parts in zip(*self.pending)]
+            self.pending = []
+            keys = self.key(*self.cells(values[0], values[1]))
+            order = np.argsort(keys, kind='mergesort')
+            unique, starts = np.unique(keys[order], return_index=True)
+            stops = np.append(starts[1:], len(keys))
+            for key, start, stop in zip(unique.tolist(), starts, stops):
+                rows = order[start:stop]
+                self.store(key, generation,
+                           *[np.append(old, new[rows]) for old, new
+                             in zip(self.load(key, True), values)])
+            for session_id in np.unique(values[3]).tolist():
+                self.touched(session_id, np.unique(keys[values[3] ==
+                                                        session_id]))
+        for session_id, signature in (signatures or {}).items():
+            self.db.execute('INSERT OR IGNORE INTO sessions '
+                            'VALUES (?,0,0,0,?)', (session_id, buffer('')))
+            self.db.execute('UPDATE sessions SET rows = ?, id_sum = ?, '
+                            'depth_sum = ? WHERE session_id = ?',
+                            signature + (session_id,))
+        self.db.executemany('UPDATE index_meta SET value = ? WHERE name = ?',
+                            [(str(last_id), 'last_id'),
+                             (str(generation), 'generation')])
+        self.db.commit()
+        self.generation = generation
+        self.data_version = self.version()
+        self.last_id = last_id
+
+    def touched(self, session_id, keys):
+        """Add to the buckets a session has soundings in, without
+           committing"""
+        row = self.db.execute('SELECT keys FROM sessions '
+                              'WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            self.db.execute('INSERT INTO sessions VALUES (?,0,0,0,?)',
+                            (session_id, buffer(keys.tobytes())))
+        else:
+            keys = np.union1d(np.frombuffer(row[0], np.int64), keys)
+            self.db.execute('UPDATE sessions SET keys = ? '
+                            'WHERE session_id = ?',
+                            (buffer(keys.tobytes()), session_id))
+
+    def drop(self, session_ids):
+        """Take the soundings of sessions out of their buckets, without
+           committing"""
+        generation = self.generation + 1
+        keys = set()
+        for session_id in session_ids:
+            row = self.db.execute('SELECT keys FROM sessions '
+                                  'WHERE session_id = ?',
+                                  (session_id,)).fetchone()
+            if row is not None:
+                keys.update(np.frombuffer(row[0], np.int64).tolist())
+        for key in sorted(keys):
+            values = self.load(key, True)
+            keep = ~np.in1d(values[3], session_ids)
+            self.store(key, generation, *[value[keep] for value in values])
+        self.db.executemany('UPDATE sessions SET keys = ? '
+                            'WHERE session_id = ?',
+                            [(buffer(''), session_id)
+                             for session_id in session_ids])
+
+    def signatures(self, db, clean, stop):
+        """Per session signatures of the clean soundings up to stop, as
+           {session id: (rows, id sum, depth sum)}; reads every position"""
+        return dict((row[0], tuple(row[1:])) for row in db.execute(
+            SIGNATURE_QUERY % (self.depth_column, clean), (stop,)))
+
+    def changed(self, db, clean, stored):
+        """Sessions whose clean soundings no longer match their stored
+           signatures, and sessions gone from the database since; reads
+           every position"""
+        indexed = self.signatures(db, clean, self.last_id)
+        changed = []
+        gone = []
+        for session_id, signature in sorted(stored.items()):
+            if indexed.get(session_id, NO_SIGNATURE) == signature:
+                continue
+            if session_id not in indexed and db.execute(
+                    'SELECT 1 FROM positions WHERE coalesce(session_id, 0) '
+                    '= ? LIMIT 1', (session_id,)).fetchone() is None:
+                # Archived or deleted: its soundings stay indexed.
+                gone.append(session_id)
+                continue
+            logging.info('Session %d changed since it was indexed, '
+                         'indexing it again.', session_id)
+            changed.append(session_id)
+        return changed, gone
+
+    def read(self, db, where, first, stop, advance, signatures=None,
+             chunk_size=CHUNK_SIZE):
+        """Queue the soundings first < _id <= stop matching where, adding
+           them to signatures if given; flushes every PENDING_POINTS
+           soundings, moving last_id along if advance. Returns the number
+           of soundings queued."""
+        query = ('SELECT _id, coalesce(session_id, 0), lat_deg, lon_deg, %s, '
+                 'CAST(round(%s * 100) AS INTEGER) '
+                 'FROM positions WHERE _id > ? AND _id <= ? AND %s '
+                 'ORDER BY _id LIMIT ?' % (self.depth_column,
+                                           self.depth_column, where))
+        count = 0
+        pending = 0
+        while True:
+            rows = db.execute(query, (first, stop, chunk_size)).fetchall()
+            if not rows:
+                break
+            data = np.array(rows, dtype=np.float64)
+            self.add(data[:, 2], data[:, 3], data[:, 4], data[:, 1])
+            if signatures is not None:
+                ids, session, cents = data[:, [0, 1, 5]].astype(np.int64).T
+                for session_id in np.unique(session).tolist():
+                    mine = session == session_id
+                    signatures[session_id] = tuple(
+                        a + int(b) for a, b in zip(
+                            signatures.get(session_id, NO_SIGNATURE),
+                            (mine.sum(), ids[mine].sum(),
+                             cents[mine].sum())))
+            first = int(data[-1, 0])
+            count += len(data)
+            pending += len(data)
+            if pending >= PENDING_POINTS:
+                self.flush(first if advance else self.last_id)
+                pending = 0
+        return count
+
+    def update(self, db, archive_dir=None, check=True,
+               chunk_size=CHUNK_SIZE):
+        """
+        Add the clean soundings logged since the last update. With check,
+        also compare the signatures of the sessions already indexed, which
+        reads every position, and index the changed ones again. The first
+        update also reads the sessions archived in archive_dir. Returns
+        the number of soundings added.
+        """
+        columns = table_columns(db, 'positions')
+        if 'lat_deg' not in columns:
+            raise QueryError, 'Run migrate_db.py on the database first.'
+        if self.depth_column not in columns:
+            raise QueryError, 'No column positions.%s.' % self.depth_column
+        clean = 'lat_deg IS NOT NULL AND %s > 0' % self.depth_column
+        if 'flags' in columns:
+            clean += ' AND NOT coalesce(flags, 0) > 0'
+        # Positions committed from here on are left to the next update.
+        stop = db.execute('SELECT coalesce(max(_id), 0) '
+                          'FROM positions').fetchone()[0]
+        last_id = self.last_id or 0
+        stored = dict((row[0], tuple(row[1:])) for row in self.db.execute(
+            'SELECT session_id, rows, id_sum, depth_sum FROM sessions'))
+        signatures = dict(stored)
+        tally = signatures
+        changed = []
+        if self.last_id is None:
+            # Building reads every position anyway.
+            signatures = self.signatures(db, clean, stop)
+            tally = None
+        elif check:
+            changed, gone = self.changed(db, clean, stored)
+            for session_id in changed + gone:
+                signatures[session_id] = NO_SIGNATURE
+        added = 0
+        where = clean
+        if self.last_id is None and archive_dir:
+            added, where = self.add_archive(archive_dir, where)
+            self.flush(last_id)
+        if changed:
+            self.drop(changed)
+            self.read(db, clean + ' AND coalesce(session_id, 0) IN (%s)' %
+                      ','.join(str(sid) for sid in changed), 0, last_id,
+                      False, tally, chunk_size)
+        added += self.read(db, where, last_id, stop, True, tally, chunk_size)
+        signatures = dict((session_id, signature) for session_id, signature
+                          in signatures.items()
+                          if stored.get(session_id) != signature)
+        if self.pending or changed or signatures or self.last_id != stop:
+            self.flush(stop, signatures)
+        return added
+
+    def add_archive(self, archive_dir, where):
+        """Queue the soundings of every archived session; returns their
+           count and where narrowed to leave those sessions out of the
+           database query"""
+        if self.depth_column != 'depth':
+            logging.warning('Archived sessions have no %s column, '
+                            'skipped.', self.depth_column)
+            return 0, where
+        archive = Archive(archive_dir)
+        session_ids = sorted(archive.session_ids())
+        added = 0
+        for session_id in session_ids:
+            columns = archive.load(session_id)
+            with np.errstate(invalid='ignore'):
+                keep = np.flatnonzero((columns['flags'] <= 0) &
+                                      (columns['depth'] > 0) &
+                                      np.isfinite(columns['lat_deg']))
+            self.add(columns['lat_deg'][keep], columns['lon_deg'][keep],
+                     columns['depth'][keep],
+                     np.repeat(session_id, len(keep)))
+            added += len(keep)
+        if session_ids:
+            # Sessions archived with --keep are read from the archive.
+            where += ' AND coalesce(session_id, 0) NOT IN (%s)' % \
+                ','.join(str(sid) for sid in session_ids)
+        return added, where
+
+    def candidates(self, row, column, radius):
+        """Soundings of the buckets within radius metres of any point of
+           bucket (row, column)"""
+        span_lat = int(math.ceil(radius / self.bucket_size))
+        edge = min(max(abs(row), abs(row + 1)) * self.bucket_deg, 89.9)
+        span_lon = int(math.ceil(radius / (self.bucket_deg * M_PER_DEG_LON *
+                                           math.cos(math.radians(edge)))))
+        parts = [self.bucket(self.key(r, c))
+                 for r in xrange(row - span_lat, row + span_lat + 1)
+                 for c in xrange(column - span_lon, column + span_lon + 1)]
+        return [np.concatenate(values) for values in zip(*parts)]
+
+    def depths(self, lat, lon, method='idw', radius=RADIUS,
+               neighbours=NEIGHBOURS, power=POWER):
+        """
+        depths(lat: ndarray, lon: ndarray, method: str, radius: float,
+               neighbours: int, power: float) -> ndarray
+
+        Interpolated depths at arrays of points. Points are grouped by
+        bucket, so each group reads its neighbouring buckets once.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        self.check()
+        result = np.full(len(lat), np.nan)
+        rows, columns = self.cells(lat, lon)
+        keys = self.key(rows, columns)
+        order = np.argsort(keys, kind='mergesort')
+        dummy, starts = np.unique(keys[order], return_index=True)
+        stops = np.append(starts[1:], len(keys))
+        for start, stop in zip(starts, stops):
+            group = order[start:stop]
+            plat, plon, pdepth = self.candidates(rows[group[0]],
+                                                 columns[group[0]], radius)
+            if len(plat):
+                result[group] = interpolate(lat[group], lon[group], plat,
+                                            plon, pdepth, method, radius,
+                                            neighbours, power)
+        return result
+
+    def depth_at(self, lat, lon, **kwargs):
+        """Interpolated depth at one point, nan if unknown"""
+        return float(self.depths([lat], [lon], **kwargs)[0])
+
+    def track(self, lat, lon, spacing=SPACING, **kwargs):
+        """
+        Depths every spacing metres along a polyline, as (distance along
+        the track, lat, lon, depth) arrays.
+        """
+        distance, lat, lon = densify(lat, lon, spacing)
+        return distance, lat, lon, self.depths(lat, lon, **kwargs)
+
+
+def read_track(fname):
+    """Read a polyline of "lat lon" lines"""
+    try:
+        with open(fname) as f:
+            points = [[float(value) for value in line.split()[:2]]
+                      for line in f
+                      if line.strip() and not line.startswith('#')]
+    except (IOError, ValueError):
+        raise QueryError, 'Unable to read track %s.' % fname
+    if not points or min(len(point) for point in points) < 2:
+        raise QueryError, 'Track %s has no "lat lon" lines.' % fname
+    points = np.array(points)
+    return points[:, 0], points[:, 1]
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to index')
+    apr.add_argument('--index', help='Index file (default DB_FILE.index)')
+    apr.add_argument('--archive', help='Session archive directory, read '
+                     'when the index is built')
+    apr.add_argument('--depth-column', default='depth',
+                     help='Depth column, e.g. depth_v1 (default depth)')
+    apr.add_argument('--bucket-size', type=float, default=BUCKET_SIZE,
+                     help='Index bucket size in metres (default %d)' %
+                     BUCKET_SIZE)
+    apr.add_argument('--cache-buckets', type=int, default=CACHE_BUCKETS,
+                     help='Buckets cached in memory (default %d)' %
+                     CACHE_BUCKETS)
+    apr.add_argument('--point', type=float, nargs=2, action='append',
+                     default=[], metavar=('LAT', 'LON'),
+                     help='Print the depth at a point (repeatable)')
+    apr.add_argument('--track', help='Print depths along the polyline of '
+                     '"lat lon" lines in TRACK')
+    apr.add_argument('--spacing', type=float, default=SPACING,
+                     help='Metres between track points (default %d)' %
+                     SPACING)
+    apr.add_argument('--method', choices=['idw', 'nearest'], default='idw',
+                     help='Interpolation (default idw)')
+    apr.add_argument('--radius', type=float, default=RADIUS,
+                     help='Search radius in metres (default %d)' % RADIUS)
+    apr.add_argument('--neighbours', type=int, default=NEIGHBOURS,
+                     help='Soundings weighted by idw (default %d)' %
+                     NEIGHBOURS)
+    apr.add_argument('--power', type=float, default=POWER,
+                     help='idw distance power (default %d)' % POWER)
+    apr.add_argument('--follow', type=float, metavar='SECONDS',
+                     help='Keep updating the index every SECONDS')
+    apr.add_argument('--check-interval', type=float, default=CHECK_INTERVAL,
+                     metavar='SECONDS', help='Seconds between checks for '
+                     'sessions changed since indexed, with --follow '
+                     '(default %d)' % CHECK_INTERVAL)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    if app.bucket_size < 1:
+        apr.error('--bucket-size must be at least 1 metre')
+    options = {'method': app.method, 'radius': app.radius,
+               'neighbours': app.neighbours, 'power': app.power}
+    try:
+        db = sqlite3.connect(app.db_file)
+        index = DepthIndex(app.index or app.db_file + '.index',
+                           app.bucket_size, app.depth_column,
+                           app.cache_buckets)
+        added = index.update(db, app.archive)
+        if added:
+            logging.info('Indexed %d new soundings.', added)
+        for lat, lon in app.point:
+            print '%.8f %.8f %.2f' % (lat, lon, index.depth_at(lat, lon,
+                                                               **options))
+        if app.track:
+            for row in zip(*index.track(*read_track(app.track),
+                                        spacing=app.spacing, **options)):
+                print '%.1f %.8f %.8f %.2f' % row
+        checked = time.time()
+        while app.follow:
+            time.sleep(app.follow)
+            check = time.time() - checked >= app.check_interval
+            if check:
+                checked = time.time()
+            added = index.update(db, check=check)
+            if added:
+                logging.info('Indexed %d new soundings.', added)
+    except KeyboardInterrupt:
+        pass
+    except (sqlite3.Error, ArchiveError, QueryError, IOError):
+        logging.critical('Querying %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
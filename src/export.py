@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Streaming export of logged sessions. Positions are read through survey.py
+in fixed size chunks, live sessions by keyset paging over the database and
+archived ones from their memory mapped columns, formatted column by column
+and written straight out, so memory use does not depend on session size.
+Each session is written to its own file in the output directory,
+
+    session-00000012.csv       CSV with a header line
+    session-00000012.geojsonl  one GeoJSON Point Feature per line
+    session-00000012.xyz       "lon lat depth" (or "x y depth" with
+                               --projected), complete rows only
+
+optionally gzip compressed (.gz). Several sessions can be exported in
+parallel; a file appears under its final name once complete.
+
+Run as: export.py DB_FILE OUTPUT_DIR [SESSION_ID ...] [--format FORMAT]
+                  [--gzip] [--clean] [--projected] [--jobs N]
+"""
+
+import os
+import gzip
+import sqlite3
+import argparse
+import logging
+import multiprocessing
+import sys
+
+import numpy as np
+
+from archive import ArchiveError, CHUNK_SIZE
+from survey import Survey
+
+EXTENSIONS = {'csv': '.csv', 'geojson': '.geojsonl', 'xyz': '.xyz'}
+
+# Exported columns and their number formats.
+CSV_COLUMNS = [('session_id', '%d'), ('_id', '%d'),
+               ('passing_time', '%.3f'), ('lat_deg', '%.8f'),
+               ('lon_deg', '%.8f'), ('x', '%.3f'), ('y', '%.3f'),
+               ('speed', '%.2f'), ('heading', '%.2f'),
+               ('time_between', '%.3f'), ('depth', '%.2f'), ('flags', '%d')]
+PROPERTIES = ['session_id', '_id', 'passing_time', 'speed', 'heading',
+              'time_between', 'depth', 'flags']
+FORMATS = dict(CSV_COLUMNS)
+
+
+def format_column(values, fmt, null=''):
+    """Format an array as strings, nan (or -1 flags) as null"""
+    strings = np.char.mod(fmt, values)
+    if values.dtype.kind == 'f':
+        strings[~np.isfinite(values)] = null
+    elif fmt == '%d' and values.dtype.itemsize == 2:
+        strings[values < 0] = null
+    return strings
+
+def join_columns(columns, separator):
+    """Join equally long string arrays row by row into lines"""
+    return ''.join(separator.join(row) + '\n' for row in zip(*columns))
+
+def csv_lines(chunk):
+    """CSV lines of a chunk"""
+    return join_columns([format_column(chunk[name], fmt)
+                         for name, fmt in CSV_COLUMNS], ',')
+
+def geojson_lines(chunk):
+    """One GeoJSON Feature per line; positions without coordinates get a
+       null geometry"""
+    lon = format_column(chunk['lon_deg'], FORMATS['lon_deg'])
+    lat = format_column(chunk['lat_deg'], FORMATS['lat_deg'])
+    located = np.isfinite(chunk['lon_deg']) & np.isfinite(chunk['lat_deg'])
+    geometry = np.where(located, np.char.add(np.char.add(
+        np.char.add('{"type":"Point","coordinates":[', lon), ','),
+        np.char.add(lat, ']}')), 'null')
+    parts = [np.array(['{"type":"Feature","geometry":']), geometry,
+             np.array([',"properties":{'])]
+    for index, name in enumerate(PROPERTIES):
+        parts.append(np.array(['%s"%s":' % (',' if index else '', name)]))
+        parts.append(format_column(chunk[name], FORMATS[name], 'null'))
+    parts.append(np.array(['}}\n']))
+    lines = parts[0]
+    for part in parts[1:]:
+        lines = np.char.add(lines, part)
+    return ''.join(lines.tolist())
+
+def xyz_lines(chunk, projected=False):
+    """"lon lat depth" lines of the rows having all three"""
+    x, y = ('x', 'y') if projected else ('lon_deg', 'lat_deg')
+    keep = np.flatnonzero(np.isfinite(chunk[x]) & np.isfinite(chunk[y]) &
+                          np.isfinite(chunk['depth']))
+    return join_columns([format_column(chunk[x][keep], FORMATS[x]),
+                         format_column(chunk[y][keep], FORMATS[y]),
+                         format_column(chunk['depth'][keep], '%.2f')], ' ')
+
+def output_name(directory, session_id, fmt, compress):
+    """Export file of a session"""
+    return os.path.join(directory, 'session-%08d%s%s' %
+                        (session_id, EXTENSIONS[fmt],
+                         '.gz' if compress else ''))
+
+def export_session(args):
+    """Pool worker: export one session, return (session id, rows)"""
+    (db_file, archive_dir, session_id, directory, fmt, compress, clean,
+     projected, chunk_size) = args
+    survey = Survey(db_file, archive_dir)
+    fname = output_name(directory, session_id, fmt, compress)
+    tmpname = fname + '.tmp'
+    if compress:
+        out = gzip.open(tmpname, 'wb', 6)
+    else:
+        out = open(tmpname, 'wb')
+    rows = 0
+    try:
+        if fmt == 'csv':
+            out.write(','.join(name for name, dummy in CSV_COLUMNS) + '\n')
+        for chunk in survey.iter_chunks([session_id], chunk_size):
+            if clean:
+                keep = np.flatnonzero(chunk['flags'] <= 0)
+                chunk = dict((name, values[keep])
+                             for name, values in chunk.iteritems())
+            if fmt == 'csv':
+                out.write(csv_lines(chunk))
+            elif fmt == 'geojson':
+                out.write(geojson_lines(chunk))
+            else:
+                out.write(xyz_lines(chunk, projected))
+            rows += len(chunk['_id'])
+    finally:
+        out.close()
+        survey.close()
+    os.rename(tmpname, fname)
+    return session_id, rows
+
+def export_sessions(db_file, archive_dir, session_ids, directory,
+                    fmt='csv', compress=False, clean=False, projected=False,
+                    jobs=1, chunk_size=CHUNK_SIZE):
+    """
+    Export the given sessions to directory, jobs of them at a time.
+    Returns the number of positions read.
+    """
+    tasks = [(db_file, archive_dir, sid, directory, fmt, compress, clean,
+              projected, chunk_size) for sid in session_ids]
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(export_session, tasks)
+    else:
+        results = (export_session(task) for task in tasks)
+    total = 0
+    try:
+        for session_id, rows in results:
+            logging.info('Session %d: %d positions.', session_id, rows)
+            total += rows
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to export')
+    apr.add_argument('output_dir', help='Directory for the exported files')
+    apr.add_argument('sessions', nargs='*', type=int,
+                     help='Session ids (defaults to every session)')
+    apr.add_argument('--archive', help='Session archive directory')
+    apr.add_argument('--format', choices=sorted(EXTENSIONS), default='csv',
+                     help='Output format (default csv)')
+    apr.add_argument('--gzip', action='store_true',
+                     help='Compress the output files')
+    apr.add_argument('--clean', action='store_true',
+                     help='Leave out positions flagged by postprocess.py')
+    apr.add_argument('--projected', action='store_true',
+                     help='Write UTM x y instead of lon lat in xyz files')
+    apr.add_argument('--jobs', type=int,
+                     default=multiprocessing.cpu_count(),
+                     help='Sessions exported in parallel (default: cores)')
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help='Rows read at once (default %d)' % CHUNK_SIZE)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    try:
+        sessions = app.sessions
+        if not sessions:
+            survey = Survey(app.db_file, app.archive)
+            sessions = survey.session_ids()
+            survey.close()
+        if not os.path.isdir(app.output_dir):
+            os.makedirs(app.output_dir)
+        total = export_sessions(app.db_file, app.archive, sessions,
+                                app.output_dir, app.format, app.gzip,
+                                app.clean, app.projected, app.jobs,
+                                app.chunk)
+    except (sqlite3.Error, ArchiveError, IOError, OSError):
+        logging.critical('Exporting %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    logging.info('Done, %d positions exported.', total)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+GPS/sounder time fusion. Keeps short time ordered queues of GPS fixes and
+depth soundings and pairs every sounding with a position interpolated
+between the fixes around it, rejecting soundings whose nearest fix is
+more than maxdelta seconds away.
+"""
+import collections
+
+
+class Fusion(object):
+    """Pairs depth soundings with interpolated GPS positions"""
+    def __init__(self, maxdelta):
+        self.maxdelta = maxdelta
+        self.fixes = collections.deque()
+        self.depths = collections.deque()
+        self.clock = float('-inf')
+        self.fused = 0
+        self.rejected = 0
+
+    def add_fix(self, toa, lat, lon, speed, track):
+        """Queue a GPS fix; lat and lon in signed decimal degrees"""
+        if self.fixes and toa <= self.fixes[-1][0]:
+            return
+        self.fixes.append((toa, lat, lon, speed, track))
+        self.clock = max(self.clock, toa)
+
+    def add_depth(self, toa, depth):
+        """Queue a depth sounding"""
+        if self.depths and toa <= self.depths[-1][0]:
+            return
+        self.depths.append((toa, depth))
+        self.clock = max(self.clock, toa)
+
+    def fuse(self):
+        """
+        fuse() -> list of (toa, lat, lon, speed, track, time_between, depth)
+
+        Return every queued sounding that can be placed by now, oldest
+        first. time_between is the time of the nearest fix minus the
+        time of the sounding, as logged by SBScan. A sounding waits for
+        the fix following it for at most maxdelta seconds, after which
+        the preceding fix is used alone.
+        """
+        fused = []
+        fixes = self.fixes
+        depths = self.depths
+        maxdelta = self.maxdelta
+        while depths:
+            toa, depth = depths[0]
+            # Keep only the last fix at or before the sounding.
+            while len(fixes) >= 2 and fixes[1][0] <= toa:
+                fixes.popleft()
+            if not fixes:
+                if self.clock - toa > maxdelta:
+                    depths.popleft()
+                    self.rejected += 1
+                    continue
+                break
+
+            before = fixes[0]
+            if before[0] >= toa:
+                sample = self._place(toa, depth, before, None)
+            elif len(fixes) >= 2:
+                sample = self._place(toa, depth, before, fixes[1])
+            elif self.clock - toa > maxdelta:
+                sample = self._place(toa, depth, before, None)
+            else:
+                break
+
+            depths.popleft()
+            if sample is None:
+                self.rejected += 1
+            else:
+                self.fused += 1
+                fused.append(sample)
+
+        if not depths:
+            # Fixes too old to bracket any future sounding are dropped.
+            horizon = self.clock - maxdelta
+            while len(fixes) >= 2 and fixes[1][0] <= horizon:
+                fixes.popleft()
+        return fused
+
+    def _place(self, toa, depth, before, after):
+        """Position a sounding from its surrounding fixes, None if the
+           nearest one is too far away in time"""
+        nearest = before
+        if after is not None and after[0] - toa < abs(toa - before[0]):
+            nearest = after
+        if abs(nearest[0] - toa) > self.maxdelta:
+            return None
+
+        if after is None or after[0] == before[0]:
+            lat, lon = before[1], before[2]
+        else:
+            ratio = (toa - before[0]) / (after[0] - before[0])
+            dlon = after[2] - before[2]
+            if dlon > 180.0:
+                dlon -= 360.0
+            elif dlon < -180.0:
+                dlon += 360.0
+            lat = before[1] + (after[1] - before[1]) * ratio
+            lon = before[2] + dlon * ratio
+            if lon > 180.0:
+                lon -= 360.0
+            elif lon < -180.0:
+                lon += 360.0
+        return (toa, lat, lon, nearest[3], nearest[4],
+                nearest[0] - toa, depth)
@@ -0,0 +1,99 @@
+"""Coordinate conversion helpers for NMEA positions"""
+import math
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+UTM_K0 = 0.9996
+UTM_FALSE_EASTING = 500000.0
+UTM_FALSE_NORTHING = 10000000.0
+
+_E2 = WGS84_F * (2 - WGS84_F)
+_E4 = _E2 * _E2
+_E6 = _E4 * _E2
+_EP2 = _E2 / (1 - _E2)
+_M1 = 1 - _E2 / 4 - 3 * _E4 / 64 - 5 * _E6 / 256
+_M2 = 3 * _E2 / 8 + 3 * _E4 / 32 + 45 * _E6 / 1024
+_M3 = 15 * _E4 / 256 + 45 * _E6 / 1024
+_M4 = 35 * _E6 / 3072
+
+
+def nmea_to_degrees(value, hemisphere):
+    """
+    nmea_to_degrees(value: str, hemisphere: str) -> float
+
+    Convert an NMEA (d)ddmm.mmmm coordinate and its N/S/E/W indicator to
+    signed decimal degrees.
+    """
+    raw = float(value)
+    degrees = int(raw / 100)
+    degrees += (raw - degrees * 100) / 60.0
+    if hemisphere in ('S', 'W'):
+        return -degrees
+    return degrees
+
+def degrees_to_nmea(degrees, is_latitude):
+    """
+    degrees_to_nmea(degrees: float, is_latitude: bool) -> (str, str)
+
+    Convert signed decimal degrees back to an NMEA coordinate string
+    and its hemisphere indicator.
+    """
+    if is_latitude:
+        hemisphere = 'S' if degrees < 0 else 'N'
+        fmt = '%02d%07.4f'
+    else:
+        hemisphere = 'W' if degrees < 0 else 'E'
+        fmt = '%03d%07.4f'
+    degrees = abs(degrees)
+    whole = int(degrees)
+    minutes = round((degrees - whole) * 60.0, 4)
+    if minutes >= 60.0:
+        whole += 1
+        minutes -= 60.0
+    return fmt % (whole, minutes), hemisphere
+
+def utm_zone(lat, lon):
+    """
+    utm_zone(lat: float, lon: float) -> int
+
+    UTM zone number of a position, negative in the southern hemisphere.
+    """
+    zone = int((lon + 180.0) / 6.0) % 60 + 1
+    if lat < 0:
+        return -zone
+    return zone
+
+def to_utm(lat, lon, zone):
+    """
+    to_utm(lat: float, lon: float, zone: int) -> (float, float)
+
+    Project WGS84 decimal degrees to (easting, northing) in metres in the
+    given UTM zone, which may differ from the position's own zone.
+    """
+    phi = math.radians(lat)
+    lon0 = math.radians((abs(zone) - 1) * 6 - 180 + 3)
+    dlon = math.radians(lon) - lon0
+    if dlon > math.pi:
+        dlon -= 2 * math.pi
+    elif dlon < -math.pi:
+        dlon += 2 * math.pi
+
+    sin_phi = math.sin(phi)
+    cos_phi = math.cos(phi)
+    tan_phi = math.tan(phi)
+    n = WGS84_A / math.sqrt(1 - _E2 * sin_phi * sin_phi)
+    t = tan_phi * tan_phi
+    c = _EP2 * cos_phi * cos_phi
+    a = cos_phi * dlon
+    m = WGS84_A * (_M1 * phi - _M2 * math.sin(2 * phi) +
+                   _M3 * math.sin(4 * phi) - _M4 * math.sin(6 * phi))
+
+    easting = UTM_K0 * n * (a + (1 - t + c) * a ** 3 / 6 +
+                            (5 - 18 * t + t * t + 72 * c - 58 * _EP2) *
+                            a ** 5 / 120) + UTM_FALSE_EASTING
+    northing = UTM_K0 * (m + n * tan_phi * (
+        a * a / 2 + (5 - t + 9 * c + 4 * c * c) * a ** 4 / 24 +
+        (61 - 58 * t + t * t + 600 * c - 330 * _EP2) * a ** 6 / 720))
+    if zone < 0:
+        northing += UTM_FALSE_NORTHING
+    return easting, northing
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""
+Bathymetry gridding. Bins logged positions into a raster of square cells
+in UTM metres, keeping per-cell count, mean, minimum, maximum and
+standard deviation of depth. Positions are read from the database in
+chunks past a stored high-water mark, so a saved grid can be brought up
+to date with whatever SBScan logged since without touching older points,
+and memory use depends only on the gridded area. Positions flagged by
+postprocess.py are skipped. The gridded area can be limited to an extent,
+and never grows past a maximum number of cells: stray fixes far from the
+rest of the data are rejected rather than stretching the grid to them.
+
+Run as: grid.py DB_FILE GRID_FILE [--cell-size METRES] [--zone ZONE]
+                [--extent XMIN YMIN XMAX YMAX] [--max-cells N]
+"""
+
+import os
+import sqlite3
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+import npgeo
+from geo import utm_zone
+from migrate_db import table_columns
+
+CHUNK_SIZE = 100000
+GROW_MARGIN = 64
+MAX_CELLS = 1 << 22
+
+POSITION_QUERY = ('SELECT p._id, p.lat_deg, p.lon_deg, p.x, p.y, p.depth, '
+                  's.utm_zone FROM positions p '
+                  'LEFT JOIN sessions s ON s._id = p.session_id '
+                  'WHERE p._id > ? AND p.lat_deg IS NOT NULL%s '
+                  'ORDER BY p._id LIMIT ?')
+# Positions flagged by postprocess.py; unprocessed ones (NULL) are kept.
+FLAGS_FILTER = ' AND NOT coalesce(p.flags, 0) > 0'
+
+
+class GridError(Exception):
+    """Grid file or parameter related error"""
+    pass
+
+
+class DepthGrid(object):
+    """Incrementally updated per-cell depth statistics"""
+    def __init__(self, cell_size, zone=None, extent=None,
+                 max_cells=MAX_CELLS):
+        self.cell_size = float(cell_size)
+        self.zone = zone
+        self.extent_limit = tuple(extent) if extent is not None else None
+        self.max_cells = int(max_cells)
+        self.rejected = 0
+        self.last_id = 0
+        self.ix0 = self.iy0 = 0
+        self.count = np.zeros((0, 0), dtype=np.int64)
+        self.mean = np.zeros((0, 0))
+        self.m2 = np.zeros((0, 0))
+        self.min = np.zeros((0, 0))
+        self.max = np.zeros((0, 0))
+
+    @property
+    def shape(self):
+        """(rows, columns) of the grid"""
+        return self.count.shape
+
+    def extent(self):
+        """(xmin, ymin, xmax, ymax) covered by the grid, in metres"""
+        rows, cols = self.shape
+        return (self.ix0 * self.cell_size, self.iy0 * self.cell_size,
+                (self.ix0 + cols) * self.cell_size,
+                (self.iy0 + rows) * self.cell_size)
+
+    def std(self):
+        """Per-cell population standard deviation, nan for empty cells"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0,
+                            np.sqrt(self.m2 / self.count), np.nan)
+
+    def statistics(self):
+        """Return {name: 2D array} with empty cells set to nan"""
+        empty = self.count == 0
+        stats = {'count': self.count.copy(), 'std': self.std()}
+        for name in ('mean', 'min', 'max'):
+            stats[name] = np.where(empty, np.nan, getattr(self, name))
+        return stats
+
+    def _cells_needed(self, ixmin, ixmax, iymin, iymax):
+        """Number of cells the grid would have after _ensure"""
+        rows, cols = self.shape
+        if rows and cols:
+            ixmin = min(ixmin, self.ix0)
+            iymin = min(iymin, self.iy0)
+            ixmax = max(ixmax, self.ix0 + cols - 1)
+            iymax = max(iymax, self.iy0 + rows - 1)
+        return ((ixmax - ixmin + 1 + 2 * GROW_MARGIN) *
+                (iymax - iymin + 1 + 2 * GROW_MARGIN))
+
+    def _bounded(self, ix, iy):
+        """
+        Mask of the cell indices the grid can take without growing past
+        max_cells. If all of them do not fit, only those within a window
+        of max_cells around the current grid (or the median of the
+        points, for an empty grid) are kept, and failing that only those
+        inside the current grid.
+        """
+        keep = np.ones(len(ix), dtype=bool)
+        if self._cells_needed(ix.min(), ix.max(),
+                              iy.min(), iy.max()) <= self.max_cells:
+            return keep
+        rows, cols = self.shape
+        if rows and cols:
+            cx, cy = self.ix0 + cols // 2, self.iy0 + rows // 2
+        else:
+            cx, cy = int(np.median(ix)), int(np.median(iy))
+        half = max(int(np.sqrt(self.max_cells)) // 2 - GROW_MARGIN - 1, 0)
+        keep = (np.abs(ix - cx) <= half) & (np.abs(iy - cy) <= half)
+        if keep.any() and self._cells_needed(
+                ix[keep].min(), ix[keep].max(), iy[keep].min(),
+                iy[keep].max()) <= self.max_cells:
+            return keep
+        return ((ix >= self.ix0) & (ix < self.ix0 + cols) &
+                (iy >= self.iy0) & (iy < self.iy0 + rows))
+
+    def _ensure(self, ixmin, ixmax, iymin, iymax):
+        """Grow the arrays so the given cell index range fits"""
+        rows, cols = self.shape
+        if (rows and cols and ixmin >= self.ix0 and iymin >= self.iy0 and
+                ixmax < self.ix0 + cols and iymax < self.iy0 + rows):
+            return
+        if rows and cols:
+            ixmin = min(ixmin, self.ix0)
+            iymin = min(iymin, self.iy0)
+            ixmax = max(ixmax, self.ix0 + cols - 1)
+            iymax = max(iymax, self.iy0 + rows - 1)
+        ixmin -= GROW_MARGIN
+        iymin -= GROW_MARGIN
+        ixmax += GROW_MARGIN
+        iymax += GROW_MARGIN
+        shape = (iymax - iymin + 1, ixmax - ixmin + 1)
+        offset = (self.iy0 - iymin, self.ix0 - ixmin)
+        for name, fill in (('count', 0), ('mean', 0.0), ('m2', 0.0),
+                           ('min', np.inf), ('max', -np.inf)):
+            old = getattr(self, name)
+            new = np.full(shape, fill, dtype=old.dtype)
+            new[offset[0]:offset[0]+rows, offset[1]:offset[1]+cols] = old
+            setattr(self, name, new)
+        self.ix0 = ixmin
+        self.iy0 = iymin
+
+    def add_points(self, x, y, depth):
+        """
+        Bin arrays of projected coordinates and depths into the grid.
+        Points with missing coordinates or non-positive depths are
+        ignored; points outside the extent limit, or that would grow the
+        grid past max_cells, are rejected and counted in self.rejected.
+        Returns the number of points added.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        depth = np.asarray(depth, dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(x) & np.isfinite(y) & (depth > 0)
+        if not valid.any():
+            return 0
+        x, y, depth = x[valid], y[valid], depth[valid]
+        if self.extent_limit is not None:
+            xmin, ymin, xmax, ymax = self.extent_limit
+            inside = (x >= xmin) & (x < xmax) & (y >= ymin) & (y < ymax)
+            self.rejected += len(x) - int(np.count_nonzero(inside))
+            x, y, depth = x[inside], y[inside], depth[inside]
+            if not len(x):
+                return 0
+
+        ix = np.floor(x / self.cell_size).astype(np.int64)
+        iy = np.floor(y / self.cell_size).astype(np.int64)
+        keep = self._bounded(ix, iy)
+        if not keep.all():
+            rejected = len(ix) - int(np.count_nonzero(keep))
+            logging.warning('Rejected %d points that would grow the grid '
+                            'past %d cells.', rejected, self.max_cells)
+            self.rejected += rejected
+            ix, iy, depth = ix[keep], iy[keep], depth[keep]
+            if not len(ix):
+                return 0
+        self._ensure(int(ix.min()), int(ix.max()),
+                     int(iy.min()), int(iy.max()))
+        cols = self.shape[1]
+        flat = (iy - self.iy0) * cols + (ix - self.ix0)
+
+        order = np.argsort(flat, kind='mergesort')
+        flat = flat[order]
+        depth = depth[order]
+        cells, starts, counts = np.unique(flat, return_index=True,
+                                          return_counts=True)
+        chunk_mean = np.add.reduceat(depth, starts) / counts
+        deviation = depth - np.repeat(chunk_mean, counts)
+        chunk_m2 = np.add.reduceat(deviation * deviation, starts)
+
+        # Chan et al. pairwise merge of the chunk into the running stats.
+        count = self.count.reshape(-1)
+        mean = self.mean.reshape(-1)
+        m2 = self.m2.reshape(-1)
+        old_count = count[cells]
+        new_count = old_count + counts
+        delta = chunk_mean - mean[cells]
+        mean[cells] += delta * counts / new_count
+        m2[cells] += chunk_m2 + delta * delta * old_count * counts / new_count
+        count[cells] = new_count
+
+        cell_min = self.min.reshape(-1)
+        cell_max = self.max.reshape(-1)
+        cell_min[cells] = np.minimum(cell_min[cells],
+                                     np.minimum.reduceat(depth, starts))
+        cell_max[cells] = np.maximum(cell_max[cells],
+                                     np.maximum.reduceat(depth, starts))
+        return len(depth)
+
+    def update_from_db(self, db, chunk_size=CHUNK_SIZE):
+        """
+        Add every position logged after self.last_id, except those
+        flagged by postprocess.py. Positions projected to a different UTM
+        zone than the grid's are reprojected from their decimal degree
+        coordinates. Returns the number of points added.
+        """
+        query = POSITION_QUERY % (FLAGS_FILTER if 'flags' in
+                                  table_columns(db, 'positions') else '')
+        added = 0
+        while True:
+            rows = db.execute(query, (self.last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            data = np.array(rows, dtype=np.float64)
+            pid, lat, lon, x, y, depth, zones = data.T
+            if self.zone is None:
+                known = zones[np.isfinite(zones)]
+                if len(known):
+                    self.zone = int(known[0])
+                else:
+                    self.zone = utm_zone(lat[0], lon[0])
+            foreign = (zones != self.zone) | ~np.isfinite(x)
+            if foreign.any():
+                x = x.copy()
+                y = y.copy()
+                x[foreign], y[foreign] = npgeo.to_utm(lat[foreign],
+                                                      lon[foreign], self.zone)
+            added += self.add_points(x, y, depth)
+            self.last_id = int(pid[-1])
+        return added
+
+    def save(self, fname):
+        """Atomically write the grid to an npz file"""
+        extent = self.extent_limit or (np.nan,) * 4
+        meta = np.array([self.cell_size,
+                         np.nan if self.zone is None else self.zone,
+                         self.ix0, self.iy0, self.last_id, self.max_cells] +
+                        list(extent), dtype=np.float64)
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.savez_compressed(f, meta=meta, count=self.count,
+                                mean=self.mean, m2=self.m2,
+                                min=self.min, max=self.max)
+        os.rename(tmpname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Read a grid written by save"""
+        try:
+            data = np.load(fname)
+        except (IOError, ValueError):
+            raise GridError, 'Unable to read grid file %s.' % fname
+        meta = data['meta']
+        cell_size, zone, ix0, iy0, last_id, max_cells = meta[:6]
+        extent = tuple(meta[6:10])
+        grid = cls(cell_size, None if np.isnan(zone) else int(zone),
+                   None if np.isnan(extent).any() else extent,
+                   int(max_cells))
+        grid.ix0 = int(ix0)
+        grid.iy0 = int(iy0)
+        grid.last_id = int(last_id)
+        for name in ('count', 'mean', 'm2', 'min', 'max'):
+            setattr(grid, name, data[name])
+        return grid
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to read')
+    apr.add_argument('grid_file', help='Grid file to create or update')
+    apr.add_argument('--cell-size', type=float, default=5.0,
+                     help='Cell size in metres for a new grid (default 5)')
+    apr.add_argument('--zone', type=int,
+                     help=('UTM zone of a new grid, negative for south '
+                           '(defaults to that of the first session)'))
+    apr.add_argument('--extent', type=float, nargs=4,
+                     metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                     help='Only grid positions inside this UTM extent')
+    apr.add_argument('--max-cells', type=int,
+                     help='Maximum number of grid cells (default %d)' %
+                     MAX_CELLS)
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help='Positions read per query (default %d)' %
+                     CHUNK_SIZE)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    if os.path.exists(app.grid_file):
+        try:
+            grid = DepthGrid.load(app.grid_file)
+        except GridError:
+            logging.critical(str(sys.exc_info()[1]))
+            sys.exit(1)
+        logging.info('Updating grid from position %d.', grid.last_id)
+        if app.extent:
+            grid.extent_limit = tuple(app.extent)
+        if app.max_cells:
+            grid.max_cells = max(app.max_cells, grid.count.size)
+    else:
+        grid = DepthGrid(app.cell_size, app.zone, app.extent,
+                         app.max_cells or MAX_CELLS)
+
+    try:
+        db = sqlite3.connect(app.db_file)
+        added = grid.update_from_db(db, app.chunk)
+    except sqlite3.Error:
+        logging.critical('Reading %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    db.close()
+    grid.save(app.grid_file)
+    logging.info('Added %d points, grid is %dx%d cells.',
+                 added, grid.shape[1], grid.shape[0])
+    if grid.rejected:
+        logging.warning('Rejected %d points outside the grid limits.',
+                        grid.rejected)
+
+if __name__ == '__main__':
+    main()
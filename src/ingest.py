@@ -0,0 +1,123 @@
+"""
+Background batched sqlite3 ingest. Rows are queued by the logging loop
+and inserted with executemany by a dedicated thread owning its own
+connection, committing whenever a batch fills up or the flush interval
+elapses, whichever comes first.
+"""
+import sqlite3
+import threading
+import logging
+import time
+import Queue
+
+INGEST_QUEUE_SIZE = 100000
+STOP_WAIT = 0.5
+
+_STOP = object()
+
+
+def configure_db(db, journal_mode, synchronous):
+    """Apply journal mode and sync pragmas to a connection"""
+    db.execute('PRAGMA journal_mode=%s' % journal_mode)
+    db.execute('PRAGMA synchronous=%s' % synchronous)
+
+
+class Ingest(object):
+    """Batched writer thread for a single insert query"""
+    def __init__(self, db_file, query, batch_size, flush_interval,
+                 journal_mode='WAL', synchronous='NORMAL'):
+        self.db_file = db_file
+        self.query = query
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.queue = Queue.Queue(INGEST_QUEUE_SIZE)
+        self.error = None
+        self.written = 0
+        self.dropped = 0
+        # Row id of the last row written; a batch's rows get consecutive
+        # ids, as its transaction holds the database's write lock.
+        self.last_rowid = None
+        # Called from the writer thread with every committed batch.
+        self.on_commit = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start the writer thread"""
+        self.thread.start()
+
+    def put(self, row):
+        """Queue a row without blocking; count it as dropped if the
+           queue is full because the database stalled"""
+        try:
+            self.queue.put_nowait(row)
+        except Queue.Full:
+            if not self.dropped:
+                logging.warning('Ingest queue full, dropping rows.')
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        """Flush everything queued and wait for the thread to finish"""
+        # A writer that died leaves a full queue behind, so never block
+        # on it for longer than it takes to notice.
+        while self.thread.is_alive():
+            try:
+                self.queue.put(_STOP, True, STOP_WAIT)
+                break
+            except Queue.Full:
+                pass
+        self.thread.join()
+        if self.dropped:
+            logging.warning('Ingest dropped %d rows.', self.dropped)
+
+    def run(self):
+        """Writer thread body"""
+        try:
+            db = sqlite3.connect(self.db_file)
+            configure_db(db, self.journal_mode, self.synchronous)
+        except sqlite3.Error, err:
+            self.error = err
+            logging.critical('Ingest failed to open db file %s !',
+                             self.db_file)
+            return
+
+        batch = []
+        deadline = time.time() + self.flush_interval
+        try:
+            while True:
+                try:
+                    row = self.queue.get(True,
+                                         max(0, deadline - time.time()))
+                except Queue.Empty:
+                    row = None
+                if row is _STOP:
+                    break
+                if row is not None:
+                    batch.append(row)
+                if (len(batch) >= self.batch_size or
+                    time.time() >= deadline):
+                    self.flush(db, batch)
+                    batch = []
+                    deadline = time.time() + self.flush_interval
+            self.flush(db, batch)
+        except sqlite3.Error, err:
+            self.error = err
+            logging.critical('SQL operation failed: %s', self.query)
+        finally:
+            db.close()
+
+    def flush(self, db, batch):
+        """Insert and commit a batch"""
+        if not batch:
+            return
+        db.executemany(self.query, batch)
+        self.last_rowid = db.execute('SELECT last_insert_rowid()'
+                                     ).fetchone()[0]
+        db.commit()
+        self.written += len(batch)
+        if self.on_commit is not None:
+            self.on_commit(batch)
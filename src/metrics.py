@@ -0,0 +1,141 @@
+"""
+Low overhead runtime metrics shared by NMEAd and SBScan. Counters are
+plain per-group collections.Counter objects, each updated by a single
+thread, and histograms use fixed logarithmic buckets, so recording costs
+a dict update or a bisect. A StatsWriter thread periodically copies
+everything into a json stats file.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+import collections
+import logging
+
+# Latency bucket upper bounds in seconds: 50 us doubling up to ~105 s.
+LATENCY_BOUNDS = tuple(0.00005 * 2 ** i for i in range(22))
+
+
+class Histogram(object):
+    """Fixed bucket histogram; record must be called from one thread"""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Add a sample"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, counts, point):
+        """Upper bound of the bucket holding the given percentile"""
+        wanted = sum(counts) * point / 100.0
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= wanted:
+                if index < len(self.bounds):
+                    return self.bounds[index]
+                return self.max
+        return 0.0
+
+    def snapshot(self):
+        """Return a json serialisable copy of the histogram"""
+        counts = list(self.counts)
+        count = sum(counts)
+        return {'count': count,
+                'mean': self.total / count if count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(counts, 50),
+                'p90': self.percentile(counts, 90),
+                'p99': self.percentile(counts, 99),
+                'bounds': self.bounds,
+                'counts': counts}
+
+
+class Metrics(object):
+    """Registry of counter groups, histograms and gauges"""
+    def __init__(self):
+        self.started = time.time()
+        self.groups = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counters(self, group):
+        """Return the Counter for a group, creating it if needed"""
+        if group not in self.groups:
+            self.groups[group] = collections.Counter()
+        return self.groups[group]
+
+    def histogram(self, name, bounds=LATENCY_BOUNDS):
+        """Return the named Histogram, creating it if needed"""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def gauge(self, name, callable_):
+        """Register a callable evaluated whenever a snapshot is taken"""
+        self.gauges[name] = callable_
+
+    def snapshot(self):
+        """Return every metric as a json serialisable dict"""
+        now = time.time()
+        gauges = {}
+        for name, callable_ in self.gauges.items():
+            try:
+                gauges[name] = callable_()
+            except Exception:
+                logging.debug('Gauge %s failed.', name)
+        return {'time': now,
+                'uptime': now - self.started,
+                'counters': dict((name, dict(group)) for name, group
+                                 in self.groups.items()),
+                'histograms': dict((name, hist.snapshot()) for name, hist
+                                   in self.histograms.items()),
+                'gauges': gauges}
+
+
+class StatsWriter(object):
+    """Thread writing a Metrics snapshot to a file every interval"""
+    def __init__(self, metrics, fname, interval):
+        self.metrics = metrics
+        self.fname = fname
+        self.interval = interval
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start writing"""
+        self.thread.start()
+
+    def stop(self):
+        """Write a last snapshot and stop"""
+        self.stopped = True
+        self.write()
+
+    def run(self):
+        """Writer thread body; sleeps rather than waiting on an event so
+           an idle daemon is not woken up between snapshots"""
+        while True:
+            time.sleep(self.interval)
+            if self.stopped:
+                break
+            self.write()
+
+    def write(self):
+        """Atomically replace the stats file with a fresh snapshot"""
+        tmpname = self.fname + '.tmp'
+        with self.lock:
+            try:
+                with open(tmpname, 'w') as f:
+                    json.dump(self.metrics.snapshot(), f, sort_keys=True)
+                os.rename(tmpname, self.fname)
+            except (IOError, OSError):
+                logging.error('Failed to write stats file %s', self.fname)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Upgrades an SBScan database to the numeric coordinate schema: adds the
+decimal degree and projected columns to positions, the UTM zone and
+source id to sessions, the positions_rtree spatial index and the
+triggers keeping it in sync, then converts the existing NMEA lat/lon
+strings in bulk. Safe to run repeatedly; already converted rows are left
+alone.
+
+Should be run while SBScan is stopped.
+"""
+
+import sqlite3
+import argparse
+import logging
+import sys
+
+from geo import nmea_to_degrees, utm_zone, to_utm
+
+CHUNK_SIZE = 10000
+
+POSITION_COLUMNS = [('lat_deg', 'REAL'), ('lon_deg', 'REAL'),
+                    ('x', 'REAL'), ('y', 'REAL')]
+SESSION_COLUMNS = [('utm_zone', 'INTEGER'), ('source', 'TEXT')]
+
+RTREE_DDL = [
+    ('CREATE VIRTUAL TABLE IF NOT EXISTS positions_rtree USING rtree('
+     'id, min_lat, max_lat, min_lon, max_lon)'),
+    ('CREATE TRIGGER IF NOT EXISTS positions_rtree_insert '
+     'AFTER INSERT ON positions WHEN new.lat_deg IS NOT NULL BEGIN '
+     'INSERT INTO positions_rtree VALUES (new._id, new.lat_deg, '
+     'new.lat_deg, new.lon_deg, new.lon_deg); END'),
+    ('CREATE TRIGGER IF NOT EXISTS positions_rtree_update '
+     'AFTER UPDATE OF lat_deg, lon_deg ON positions '
+     'WHEN new.lat_deg IS NOT NULL BEGIN '
+     'INSERT OR REPLACE INTO positions_rtree VALUES (new._id, '
+     'new.lat_deg, new.lat_deg, new.lon_deg, new.lon_deg); END'),
+    ('CREATE TRIGGER IF NOT EXISTS positions_rtree_delete '
+     'AFTER DELETE ON positions BEGIN '
+     'DELETE FROM positions_rtree WHERE id = old._id; END')]
+
+
+def split_nmea(coordinate):
+    """Split a logged coordinate such as '4530.1234N' into
+       nmea_to_degrees arguments"""
+    return coordinate[:-1], coordinate[-1]
+
+def table_columns(db, table):
+    """Return the set of column names of a table"""
+    return set(row[1] for row in db.execute('PRAGMA table_info(%s)' % table))
+
+def schema_current(db):
+    """Check whether db already has the numeric coordinate schema"""
+    columns = table_columns(db, 'positions')
+    if not all(name in columns for name, dummy in POSITION_COLUMNS):
+        return False
+    if 'utm_zone' not in table_columns(db, 'sessions'):
+        return False
+    return bool(db.execute("SELECT 1 FROM sqlite_master WHERE "
+                           "name = 'positions_rtree'").fetchone())
+
+def upgrade_schema(db):
+    """Add the missing columns, the spatial index and its triggers"""
+    for table, wanted in (('positions', POSITION_COLUMNS),
+                          ('sessions', SESSION_COLUMNS)):
+        columns = table_columns(db, table)
+        for name, sqltype in wanted:
+            if name not in columns:
+                db.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                           (table, name, sqltype))
+                logging.info('Added column %s.%s', table, name)
+    for statement in RTREE_DDL:
+        db.execute(statement)
+    db.commit()
+
+def convert_positions(db, project=True, chunk_size=CHUNK_SIZE):
+    """
+    convert_positions(db, project: bool, chunk_size: int) -> int
+
+    Fill lat_deg/lon_deg (and x/y if project) for every row that lacks
+    them, chunk by chunk, choosing a UTM zone per session from its first
+    position. Returns the number of converted rows.
+    """
+    zones = dict(db.execute('SELECT _id, utm_zone FROM sessions'))
+    converted = 0
+    last_id = 0
+    while True:
+        rows = db.execute('SELECT _id, lat, lon, session_id FROM positions '
+                          'WHERE _id > ? AND lat_deg IS NULL '
+                          'ORDER BY _id LIMIT ?',
+                          (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for pid, lat, lon, sid in rows:
+            try:
+                lat_deg = nmea_to_degrees(*split_nmea(lat))
+                lon_deg = nmea_to_degrees(*split_nmea(lon))
+            except (TypeError, ValueError, IndexError):
+                logging.warning('Unparsable position %d: %r %r',
+                                pid, lat, lon)
+                continue
+            x = y = None
+            if project:
+                if zones.get(sid) is None:
+                    zones[sid] = utm_zone(lat_deg, lon_deg)
+                    db.execute('UPDATE sessions SET utm_zone = ? '
+                               'WHERE _id = ?', (zones[sid], sid))
+                x, y = to_utm(lat_deg, lon_deg, zones[sid])
+            updates.append((lat_deg, lon_deg, x, y, pid))
+        db.executemany('UPDATE positions SET lat_deg = ?, lon_deg = ?, '
+                       'x = ?, y = ? WHERE _id = ?', updates)
+        db.commit()
+        converted += len(updates)
+        last_id = rows[-1][0]
+        logging.info('Converted %d positions.', converted)
+    return converted
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to upgrade')
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help=('Rows converted per transaction (defaults '
+                           'to %d)' % CHUNK_SIZE))
+    apr.add_argument('--no-projection', action='store_true',
+                     help='Skip computing projected UTM coordinates')
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    try:
+        db = sqlite3.connect(app.db_file)
+        upgrade_schema(db)
+        count = convert_positions(db, not app.no_projection, app.chunk)
+    except sqlite3.Error:
+        logging.critical('Migration of %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    logging.info('Done, %d positions converted.', count)
+    db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the NMEAd -> SBScan pipeline. Each stage (checksum,
+parsing, driver reads, publishing, SBScan polling and inserting) is timed
+in isolation on recorded or synthetic NMEA, then the whole pipeline is
+run end to end in process: replayed ports, NMEAd's select engine and ring
+transport, and an SBScan session with fusion and batched ingest. End to
+end latency is measured from a sentence's arrival (toa) to the commit of
+the row logged from it.
+
+Results are written as json so runs can be compared between versions:
+
+    nmea_bench.py [--log LOG_FILE] [--output FILE] [--compare OLD_FILE]
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import itertools
+import threading
+import logging
+import sqlite3
+
+import NMEAd
+import SBScan
+from file_lock import file_lock
+from ring_buffer import RingReader
+from nmea_replay import synthesize, read_log
+
+BENCH_SENTENCES = 20000
+BENCH_DURATION = 5.0
+DRIVER_DEADLINE = 60.0
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return {'pN': value} for a list of samples, plus max and count"""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    result = dict(('p%d' % point,
+                   values[min(len(values) - 1, len(values) * point // 100)])
+                  for point in points)
+    result['max'] = values[-1]
+    result['count'] = len(values)
+    return result
+
+def timed(count, callable_):
+    """Run callable_ and return {'seconds', 'per_second'} for count items"""
+    start = time.time()
+    callable_()
+    elapsed = time.time() - start
+    return {'seconds': elapsed,
+            'per_second': count / elapsed if elapsed else float('inf')}
+
+def load_sentences(log_file, count):
+    """Return up to count sentences from a log, or synthetic ones"""
+    if log_file:
+        source = read_log(log_file)
+    else:
+        source = synthesize(('$GPRMC', '$SDDBT'), 10.0, 0.0, seed=1)
+    return [sentence for dummy, sentence in itertools.islice(source, count)]
+
+def make_driver(struct, log_file, batch_read):
+    """Driver replaying log_file as fast as it is read"""
+    params = {'replay': log_file, 'replay_speed': '0',
+              'check_checksums': 'True',
+              'batch_read': 'True' if batch_read else 'False'}
+    return NMEAd.Driver(struct, params, 'BENCH')
+
+def make_db(tmpdir, name):
+    """Create an empty SBScan database"""
+    db_file = os.path.join(tmpdir, name)
+    schema = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'sbdb.sql')
+    db = sqlite3.connect(db_file)
+    with open(schema) as f:
+        db.executescript(f.read())
+    db.close()
+    return db_file
+
+def session_params(db_file, **overrides):
+    """SBScan scanner section: its defaults, tuned for benchmarking"""
+    params = dict(SBScan.SCANNER_DEFAULTS)
+    params.update({'db_file': db_file, 'pause_on_stop': 'False',
+                   'polling_interval': '0.01', 'log_point_count': 'False',
+                   'ingest_flush_interval': '0.2', 'transport': 'ring'})
+    params.update(overrides)
+    return params
+
+def bench_checksum(sentences):
+    """chk_nmea_cs over every sentence"""
+    def run():
+        for sentence in sentences:
+            NMEAd.chk_nmea_cs(sentence)
+    return timed(len(sentences), run)
+
+def bench_parse(sentences, log_file):
+    """Driver.handle_line and handle_batch on in-memory data"""
+    results = {}
+    struct = NMEAd.SharedStruct()
+    driver = make_driver(struct, log_file, False)
+    driver.device.close()
+    lines = [sentence + '\r\n' for sentence in sentences]
+
+    def per_line():
+        toa = time.time()
+        for line in lines:
+            driver.handle_line(line, toa)
+    results['handle_line'] = timed(len(lines), per_line)
+    struct.pending.clear()
+
+    data = ''.join(lines)
+    def batched():
+        toa = time.time()
+        for start in xrange(0, len(data), 4096):
+            driver.handle_batch(data[start:start+4096], toa)
+    results['handle_batch'] = timed(len(lines), batched)
+    struct.pending.clear()
+    return results
+
+def bench_driver(count, log_file):
+    """Driver.repeat reading a replayed port, line by line and batched"""
+    results = {}
+    for mode, batch_read in (('readline', False), ('batch_read', True)):
+        struct = NMEAd.SharedStruct()
+        driver = make_driver(struct, log_file, batch_read)
+        deadline = time.time() + DRIVER_DEADLINE
+        def run():
+            while len(struct.pending) < count and time.time() < deadline:
+                driver.repeat()
+        results[mode] = timed(count, run)
+        results[mode]['parsed'] = len(struct.pending)
+        driver.cleanup()
+    return results
+
+def bench_publish(sentences, tmpdir):
+    """Writer.publish of a fresh snapshot to the json file and the ring"""
+    results = {}
+    struct = NMEAd.SharedStruct()
+    driver = make_driver(struct, os.devnull, False)
+    driver.device.close()
+    for line in sentences[:50]:
+        driver.handle_line(line, time.time())
+    count = min(len(sentences), 5000)
+    for transport in ('json', 'ring'):
+        writer = NMEAd.Writer(struct, {
+            'transport': transport,
+            'output_file': os.path.join(tmpdir, 'nmea.json'),
+            'ring_file': os.path.join(tmpdir, 'nmea.ring'),
+            'ring_slots': '1024', 'ring_slot_size': '4096'})
+        def run():
+            for line in itertools.islice(itertools.cycle(sentences), count):
+                driver.handle_line(line, time.time())
+                writer.publish()
+        results[transport] = timed(count, run)
+        writer.cleanup()
+    return results
+
+def bench_poll(tmpdir, count=5000):
+    """SBScan's json file poll and ring read, without sleeping"""
+    results = {}
+    fname = os.path.join(tmpdir, 'nmea.json')
+    with open(fname) as f:
+        def run_json():
+            for dummy in xrange(count):
+                with file_lock(f) as lock:
+                    if lock:
+                        f.seek(0)
+                        json.load(f)
+        results['json'] = timed(count, run_json)
+
+    reader = RingReader(os.path.join(tmpdir, 'nmea.ring'))
+    reader.cursor = max(0, reader.head() - reader.slot_count)
+    def run_ring():
+        for dummy, dummy2, payload in reader.read():
+            json.loads(payload)
+    records = reader.head() - reader.cursor
+    results['ring'] = timed(records, run_ring)
+    reader.close()
+    return results
+
+def bench_insert(tmpdir, count):
+    """Session.check_add_position with direct and batched inserts, and
+       with thinning"""
+    results = {}
+    for mode in ('direct', 'batched', 'thinned'):
+        db_file = make_db(tmpdir, 'insert_%s.db' % mode)
+        params = session_params(db_file, batched_ingest=str(
+            mode == 'batched'), thinning=str(mode == 'thinned'))
+        data = {'NS': ['N', 0], 'EW': ['E', 0], 'speed': ['4.0', 0],
+                'track': ['60.0', 0], 'longitude': ['01330.0000', 0],
+                'depthf': ['', 0], 'depthF': ['', 0]}
+        session = SBScan.Session(params)
+        with session:
+            def run():
+                for index in xrange(count):
+                    toa = 1000000.0 + index
+                    data['latitude'] = ['4530.%04d' % (index % 10000), toa]
+                    data['depthm'] = ['12.5', toa]
+                    session.check_add_position(data)
+            results[mode] = timed(count, run)
+        results[mode]['rows'] = session.position_counter
+    return results
+
+def bench_pipeline(tmpdir, duration, rate):
+    """Replayed ports -> NMEAd select engine -> ring -> SBScan fusion and
+       batched ingest, measuring toa to commit latency"""
+    ring_file = os.path.join(tmpdir, 'pipeline.ring')
+    struct = NMEAd.SharedStruct()
+    drivers = []
+    for name, header in (('GPS', '$GPRMC'), ('SOUNDER', '$SDDBT')):
+        drivers.append(NMEAd.Driver(struct, {
+            'replay': 'synthetic', 'replay_speed': '1.0',
+            'synth_sentences': header, 'synth_rate': str(rate),
+            'synth_error_ratio': '0.0', 'check_checksums': 'True'},
+            name, 0))
+    writer = NMEAd.Writer(struct, {
+        'transport': 'ring', 'output_file': '', 'ring_file': ring_file,
+        'ring_slots': '4096', 'ring_slot_size': '4096'})
+    loop = NMEAd.EventLoop(drivers, writer)
+    loop_thread = loop.start()
+
+    latencies = []
+    def on_commit(batch):
+        now = time.time()
+        latencies.extend(now - row[0] for row in batch)
+
+    params = session_params(make_db(tmpdir, 'pipeline.db'), fusion='True',
+                            batched_ingest='True', ring_file=ring_file)
+    session = SBScan.Session(params)
+    timer = threading.Timer(duration, setattr, (SBScan, 'stopped', True))
+    start = time.time()
+    with session:
+        session.ingest.on_commit = on_commit
+        timer.start()
+        SBScan.stopped = False
+        SBScan.follow_ring(session, params)
+    elapsed = time.time() - start
+    loop.terminate = True
+    loop_thread.join()
+
+    return {'seconds': elapsed,
+            'sentences_per_second': struct.version / elapsed,
+            'rows_per_second': session.position_counter / elapsed,
+            'rows': session.position_counter,
+            'fusion_rejected': session.fusion.rejected,
+            'writer_missed_updates': writer.consumer.missed,
+            'toa_to_commit_latency': percentiles(latencies)}
+
+def compare(old, new, path=()):
+    """Yield (stage path, old, new) for every per_second figure"""
+    for key, value in sorted(new.items()):
+        if isinstance(value, dict):
+            if isinstance(old.get(key), dict):
+                for item in compare(old[key], value, path + (key,)):
+                    yield item
+        elif key.endswith('per_second') and key in old:
+            yield '.'.join(path + (key,)), old[key], value
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('--log', help='Recorded NMEA log (default synthetic)')
+    apr.add_argument('--sentences', type=int, default=BENCH_SENTENCES,
+                     help='Sentences per stage (default %d)' %
+                     BENCH_SENTENCES)
+    apr.add_argument('--duration', type=float, default=BENCH_DURATION,
+                     help='End to end run time in seconds (default %.0f)' %
+                     BENCH_DURATION)
+    apr.add_argument('--rate', type=float, default=20.0,
+                     help='End to end sentences per second per port')
+    apr.add_argument('--output', default='bench_output.json',
+                     help='Result file (default bench_output.json)')
+    apr.add_argument('--compare', help='Earlier result file to compare with')
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.WARNING)
+    sentences = load_sentences(app.log, app.sentences)
+    tmpdir = tempfile.mkdtemp(prefix='nmea_bench')
+    try:
+        log_file = os.path.join(tmpdir, 'bench.nmea')
+        with open(log_file, 'w') as f:
+            f.write(''.join(sentence + '\n' for sentence in sentences))
+        results = {}
+        results['checksum'] = bench_checksum(sentences)
+        results['parse'] = bench_parse(sentences, log_file)
+        results['driver'] = bench_driver(len(sentences), log_file)
+        results['publish'] = bench_publish(sentences, tmpdir)
+        results['poll'] = bench_poll(tmpdir)
+        results['insert'] = bench_insert(tmpdir, min(len(sentences), 20000))
+        results['pipeline'] = bench_pipeline(tmpdir, app.duration, app.rate)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {'time': time.time(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'sentences': len(sentences),
+              'results': results}
+    with open(app.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print json.dumps(results, indent=2, sort_keys=True)
+
+    if app.compare:
+        with open(app.compare) as f:
+            old = json.load(f)['results']
+        for stage, before, after in compare(old, results):
+            print '%-40s %12.1f %12.1f %+7.1f%%' % (
+                stage, before, after, (after / before - 1) * 100)
+
+if __name__ == '__main__':
+    main()
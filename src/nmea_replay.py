@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+NMEA replay and simulation sources for driving NMEAd without hardware.
+Sentences come either from a recorded log or from a synthetic GPRMC/SDDBT
+generator, and are delivered at their original timing, sped up N times,
+or as fast as the reader consumes them.
+
+A recorded log holds one sentence per line, optionally preceded by its
+unix arrival time and a space. Lines without a time are sent without
+delay.
+
+NMEAd uses ReplayDevice in place of a serial port when a device section
+has a replay option. Run standalone, this module feeds a pseudo terminal
+and prints its path, so an unmodified NMEAd can read it as a serial port:
+
+    nmea_replay.py [--speed N] [--loop] [LOG_FILE | --synthetic HEADERS]
+"""
+
+import os
+import sys
+import time
+import math
+import random
+import select
+import fcntl
+import termios
+import struct
+import threading
+import argparse
+import pty
+import tty
+import errno
+import operator
+
+SYNTH_START = (45.3, 13.5)  # Decimal degrees
+SYNTH_SPEED = 4.0           # Knots
+SYNTH_TRACK = 60.0          # Degrees
+
+
+def read_log(fname):
+    """Yield (time or None, sentence) from a recorded log"""
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            stamp, sep, sentence = line.partition(' ')
+            if sep and sentence.startswith('$'):
+                try:
+                    yield float(stamp), sentence
+                    continue
+                except ValueError:
+                    pass
+            yield None, line
+
+def loop_log(fname):
+    """Yield a recorded log over and over, shifting its times so they
+       keep increasing"""
+    offset = 0.0
+    while True:
+        first = last = None
+        for stamp, sentence in read_log(fname):
+            if stamp is not None:
+                if first is None:
+                    first = stamp
+                last = stamp
+                stamp += offset
+            yield stamp, sentence
+        if first is None:
+            offset = 0.0
+        else:
+            offset += last - first + 1.0
+
+def with_checksum(body):
+    """Frame an NMEA sentence body as $body*CS"""
+    return '$%s*%02X' % (body, reduce(operator.xor, bytearray(body), 0))
+
+def corrupt(sentence, rng):
+    """Damage a sentence the way a noisy line would: a flipped character
+       (bad checksum) or a lost field (template mismatch)"""
+    if rng.random() < 0.5:
+        pos = rng.randrange(1, len(sentence) - 3)
+        return sentence[:pos] + chr(ord(sentence[pos]) ^ 0x01) + \
+            sentence[pos+1:]
+    cut = sentence.rfind(',', 0, len(sentence) - 3)
+    return sentence[:cut] + sentence[cut+1:]
+
+def synthesize(headers=('$GPRMC', '$SDDBT'), rate=10.0, error_ratio=0.0,
+               seed=None):
+    """
+    Yield (time, sentence) for a boat steaming at a constant speed and
+    track over a slowly varying seabed. Each header in headers is emitted
+    rate times per second; error_ratio of the sentences are corrupted.
+    """
+    rng = random.Random(seed)
+    period = 1.0 / rate
+    lat, lon = SYNTH_START
+    depth = 12.0
+    step = SYNTH_SPEED * 1852.0 / 3600.0 * period
+    dlat = step * math.cos(math.radians(SYNTH_TRACK)) / 111120.0
+    dlon = (step * math.sin(math.radians(SYNTH_TRACK)) /
+            (111120.0 * math.cos(math.radians(lat))))
+    stamp = time.time()
+    while True:
+        lat += dlat
+        lon += dlon
+        depth = max(1.0, depth + rng.gauss(0, 0.05))
+        for header in headers:
+            if header[3:] == 'RMC':
+                sentence = with_checksum(rmc_body(header[1:], stamp,
+                                                  lat, lon))
+            elif header[3:] == 'DBT':
+                sentence = with_checksum('%s,%.1f,f,%.1f,M,%.1f,F' % (
+                    header[1:], depth / 0.3048, depth, depth / 1.8288))
+            else:
+                continue
+            if error_ratio and rng.random() < error_ratio:
+                sentence = corrupt(sentence, rng)
+            yield stamp, sentence
+        stamp += period
+
+def rmc_body(talker, stamp, lat, lon):
+    """Body of an RMC sentence for the given time and position"""
+    tstruct = time.gmtime(stamp)
+    lat_min = (abs(lat) - int(abs(lat))) * 60
+    lon_min = (abs(lon) - int(abs(lon))) * 60
+    return '%s,%s.%02d,A,%02d%07.4f,%s,%03d%07.4f,%s,%.1f,%.1f,%s,,' % (
+        talker, time.strftime('%H%M%S', tstruct),
+        int((stamp % 1) * 100),
+        int(abs(lat)), lat_min, 'N' if lat >= 0 else 'S',
+        int(abs(lon)), lon_min, 'E' if lon >= 0 else 'W',
+        SYNTH_SPEED, SYNTH_TRACK, time.strftime('%d%m%y', tstruct))
+
+
+class Feeder(object):
+    """Thread writing (time, sentence) pairs to a file descriptor on
+       schedule; speed 0 means as fast as the reader keeps up"""
+    def __init__(self, source, fd, speed=1.0):
+        self.source = source
+        self.fd = fd
+        self.speed = speed
+        self.stopped = False
+        self.sent = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start feeding"""
+        self.thread.start()
+
+    def stop(self):
+        """Stop feeding after the current sentence"""
+        self.stopped = True
+
+    def run(self):
+        """Feeder thread body"""
+        first = None
+        start = time.time()
+        for stamp, sentence in self.source:
+            if self.stopped:
+                break
+            if self.speed and stamp is not None:
+                if first is None:
+                    first = stamp
+                delay = start + (stamp - first) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                os.write(self.fd, sentence + '\r\n')
+            except OSError, err:
+                if err.errno in (errno.EPIPE, errno.EBADF, errno.EIO):
+                    break
+                raise
+            self.sent += 1
+
+
+class ReplayDevice(object):
+    """In-process stand-in for serial.Serial fed by a Feeder through a
+       pipe, so both NMEAd engines can read it unchanged"""
+    def __init__(self, source, speed=1.0, timeout=None):
+        self.timeout = timeout
+        self.buffer = ''
+        self.rfd, self.wfd = os.pipe()
+        self.feeder = Feeder(source, self.wfd, speed)
+        self.feeder.start()
+
+    def fileno(self):
+        """Readable end of the pipe"""
+        return self.rfd
+
+    def inWaiting(self):
+        """Number of bytes that can be read without blocking"""
+        avail = struct.unpack('I', fcntl.ioctl(self.rfd, termios.FIONREAD,
+                                               '\0' * 4))[0]
+        return len(self.buffer) + avail
+
+    def _fill(self):
+        """Wait up to the timeout for data and buffer it; False on
+           timeout or once the feeder finished"""
+        if self.timeout is not None:
+            if not select.select([self.rfd], [], [], self.timeout)[0]:
+                return False
+        data = os.read(self.rfd, 4096)
+        self.buffer += data
+        return bool(data)
+
+    def read(self, size=1):
+        """Read up to size bytes, waiting at most the timeout for the
+           first one"""
+        if not self.buffer:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        """Read a line, or whatever arrived before the timeout"""
+        while '\n' not in self.buffer:
+            if not self._fill():
+                data, self.buffer = self.buffer, ''
+                return data
+        end = self.buffer.index('\n') + 1
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+    def close(self):
+        """Stop the feeder and close the pipe"""
+        self.feeder.stop()
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def make_source(params):
+    """Build a sentence source from a NMEAd device section"""
+    if params['replay'] == 'synthetic':
+        return synthesize(params['synth_sentences'].split(),
+                          float(params['synth_rate']),
+                          float(params['synth_error_ratio']))
+    if params.get('replay_loop') == 'True':
+        return loop_log(params['replay'])
+    return read_log(params['replay'])
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('log_file', nargs='?', help='Recorded NMEA log')
+    apr.add_argument('--speed', type=float, default=1.0,
+                     help=('Replay speed-up factor, 0 for as fast as '
+                           'possible (default 1)'))
+    apr.add_argument('--loop', action='store_true',
+                     help='Restart the log when it ends')
+    apr.add_argument('--synthetic', metavar='HEADERS',
+                     help=('Generate the given space separated sentence '
+                           'headers instead of replaying a log'))
+    apr.add_argument('--rate', type=float, default=10.0,
+                     help='Synthetic sentences per second (default 10)')
+    apr.add_argument('--error-ratio', type=float, default=0.0,
+                     help='Share of corrupted synthetic sentences')
+    app = apr.parse_args()
+
+    if app.synthetic:
+        source = synthesize(app.synthetic.split(), app.rate,
+                            app.error_ratio)
+    elif app.log_file:
+        source = loop_log(app.log_file) if app.loop else \
+            read_log(app.log_file)
+    else:
+        apr.error('either a log file or --synthetic is required')
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    print os.ttyname(slave)
+    sys.stdout.flush()
+    feeder = Feeder(source, master, app.speed)
+    feeder.start()
+    try:
+        while feeder.thread.is_alive():
+            feeder.thread.join(0.5)
+    except KeyboardInterrupt:
+        feeder.stop()
+    os.close(master)
+    os.close(slave)
+
+if __name__ == '__main__':
+    main()
@@ -35,4 +35,6 @@ nmea_templates={
           'depthF', #Depth in fathoms
           None],
 '$SDMTW':['temperature', #Water temperature
+          None],
+'$HEHDT':['heading', #True heading in degrees
           None]}
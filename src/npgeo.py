@@ -0,0 +1,55 @@
+"""
+NumPy counterparts of the geo module helpers, operating on whole arrays
+of coordinates at once. Formulas and constants are shared with geo.
+"""
+import numpy as np
+
+import geo
+
+
+def nmea_to_degrees(values, hemispheres):
+    """
+    nmea_to_degrees(values: array, hemispheres: array) -> ndarray
+
+    Convert arrays of NMEA (d)ddmm.mmmm coordinates and their N/S/E/W
+    indicators to signed decimal degrees.
+    """
+    raw = np.asarray(values, dtype=np.float64)
+    degrees = np.trunc(raw / 100.0)
+    degrees += (raw - degrees * 100.0) / 60.0
+    hemispheres = np.asarray(hemispheres)
+    south_west = (hemispheres == 'S') | (hemispheres == 'W')
+    return np.where(south_west, -degrees, degrees)
+
+def to_utm(lat, lon, zone):
+    """
+    to_utm(lat: array, lon: array, zone: int) -> (ndarray, ndarray)
+
+    Project WGS84 decimal degrees to UTM easting and northing in metres,
+    see geo.to_utm.
+    """
+    phi = np.radians(np.asarray(lat, dtype=np.float64))
+    lon0 = np.radians((abs(zone) - 1) * 6 - 180 + 3)
+    dlon = np.radians(np.asarray(lon, dtype=np.float64)) - lon0
+    dlon = (dlon + np.pi) % (2 * np.pi) - np.pi
+
+    sin_phi = np.sin(phi)
+    cos_phi = np.cos(phi)
+    tan_phi = np.tan(phi)
+    n = geo.WGS84_A / np.sqrt(1 - geo._E2 * sin_phi * sin_phi)
+    t = tan_phi * tan_phi
+    c = geo._EP2 * cos_phi * cos_phi
+    a = cos_phi * dlon
+    m = geo.WGS84_A * (geo._M1 * phi - geo._M2 * np.sin(2 * phi) +
+                       geo._M3 * np.sin(4 * phi) - geo._M4 * np.sin(6 * phi))
+
+    easting = geo.UTM_K0 * n * (a + (1 - t + c) * a ** 3 / 6 +
+                                (5 - 18 * t + t * t + 72 * c -
+                                 58 * geo._EP2) * a ** 5 / 120)
+    easting += geo.UTM_FALSE_EASTING
+    northing = geo.UTM_K0 * (m + n * tan_phi * (
+        a * a / 2 + (5 - t + 9 * c + 4 * c * c) * a ** 4 / 24 +
+        (61 - 58 * t + t * t + 600 * c - 330 * geo._EP2) * a ** 6 / 720))
+    if zone < 0:
+        northing += geo.UTM_FALSE_NORTHING
+    return easting, northing
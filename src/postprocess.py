@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Batch post-processing of logged sessions. Each session is read from the
+positions table in chunks into NumPy arrays and checked with vectorised
+filters:
+
+    depth spikes      depth deviating from its running median by more
+                      than a multiple of the running median absolute
+                      deviation (MAD)
+    speed             logged speed over ground above a limit
+    position jumps    fixes the boat could only have reached, and left
+                      again, faster than the speed limit
+    acceleration      speed changes into and out of a point faster than
+                      an acceleration limit
+    time gaps         GPS-sounder time_between above a threshold
+    no depth          missing or non-positive depth
+
+The result is stored per position as a bit mask in positions.flags, 0
+meaning the position passed every filter, so consumers can simply select
+'flags = 0'. Sessions are independent and are processed in parallel by a
+process pool; the database is only written by the main process.
+
+Run as: postprocess.py DB_FILE [SESSION_ID ...] [--jobs N] [options]
+"""
+
+import sqlite3
+import argparse
+import logging
+import multiprocessing
+import warnings
+import sys
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from migrate_db import table_columns
+
+CHUNK_SIZE = 100000
+KNOTS = 1852.0 / 3600.0
+
+FLAG_DEPTH_SPIKE = 1
+FLAG_SPEED = 2
+FLAG_POSITION_JUMP = 4
+FLAG_ACCELERATION = 8
+FLAG_TIME_GAP = 16
+FLAG_NO_DEPTH = 32
+FLAG_NAMES = [(FLAG_DEPTH_SPIKE, 'depth spike'), (FLAG_SPEED, 'speed'),
+              (FLAG_POSITION_JUMP, 'position jump'),
+              (FLAG_ACCELERATION, 'acceleration'),
+              (FLAG_TIME_GAP, 'time gap'), (FLAG_NO_DEPTH, 'no depth')]
+
+DEFAULT_PARAMS = {'spike_window': 11,      # Positions
+                  'spike_threshold': 3.5,  # MADs
+                  'spike_floor': 0.2,      # Metres
+                  'max_speed': 15.0,       # Knots
+                  'max_acceleration': 1.0, # m/s^2
+                  'max_gap': 1.0}          # Seconds
+
+SESSION_QUERY = ('SELECT _id, passing_time, speed, time_between, depth, '
+                 'x, y, lat_deg, lon_deg FROM positions '
+                 'WHERE session_id = ? ORDER BY _id')
+
+
+def ensure_schema(db):
+    """Add the flags column and the session index to older databases"""
+    if 'flags' not in table_columns(db, 'positions'):
+        db.execute('ALTER TABLE positions ADD COLUMN flags INTEGER')
+        logging.info('Added column positions.flags')
+    db.execute('CREATE INDEX IF NOT EXISTS positions_session '
+               'ON positions(session_id)')
+    db.commit()
+
+def load_session(db, session_id, chunk_size=CHUNK_SIZE):
+    """Return the session's rows as a 2D float array, one column per
+       SESSION_QUERY field and NULLs as nan"""
+    cursor = db.execute(SESSION_QUERY, (session_id,))
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.float64))
+    if not chunks:
+        return np.zeros((0, 9))
+    return np.concatenate(chunks)
+
+def rolling_median(values, window, chunk_size=CHUNK_SIZE):
+    """Centered running median ignoring nans, computed chunk by chunk
+       over a strided window view to bound memory use"""
+    half = window // 2
+    padded = np.pad(values, half, mode='edge')
+    result = np.empty(len(values))
+    stride = padded.strides[0]
+    with warnings.catch_warnings():
+        # All-nan windows yield nan, which is what we want.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for start in xrange(0, len(values), chunk_size):
+            stop = min(start + chunk_size, len(values))
+            view = as_strided(padded[start:], shape=(stop - start,
+                                                     2 * half + 1),
+                              strides=(stride, stride))
+            result[start:stop] = np.nanmedian(view, axis=1)
+    return result
+
+def both_sides(mask):
+    """True where both the step into and the step out of a point are
+       flagged in a per-step mask of length n - 1"""
+    result = np.zeros(len(mask) + 1, dtype=bool)
+    result[1:-1] = mask[:-1] & mask[1:]
+    return result
+
+def compute_flags(data, params=DEFAULT_PARAMS):
+    """
+    compute_flags(data: ndarray, params: dict) -> ndarray
+
+    Return the flag bit mask of every row of a load_session array.
+    """
+    (dummy, toa, speed, time_between, depth, x, y,
+     lat, lon) = data.T
+    flags = np.zeros(len(data), dtype=np.int64)
+    if not len(data):
+        return flags
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        no_depth = ~(depth > 0)
+        flags[no_depth] |= FLAG_NO_DEPTH
+        depth = np.where(no_depth, np.nan, depth)
+        median = rolling_median(depth, int(params['spike_window']))
+        deviation = np.abs(depth - median)
+        mad = rolling_median(deviation, int(params['spike_window']))
+        limit = np.maximum(params['spike_threshold'] * 1.4826 * mad,
+                           params['spike_floor'])
+        flags[deviation > limit] |= FLAG_DEPTH_SPIKE
+
+        max_speed = params['max_speed'] * KNOTS
+        flags[speed * KNOTS > max_speed] |= FLAG_SPEED
+        flags[np.abs(time_between) > params['max_gap']] |= FLAG_TIME_GAP
+
+        if len(data) < 3:
+            return flags
+        dt = np.diff(toa)
+        dt[dt <= 0] = np.nan
+        if np.isfinite(x).all():
+            dx = np.diff(x)
+            dy = np.diff(y)
+        else:
+            # Unprojected session: local equirectangular approximation.
+            dx = np.diff(lon) * np.cos(np.radians(lat[1:])) * 111320.0
+            dy = np.diff(lat) * 110540.0
+        step_speed = np.hypot(dx, dy) / dt
+        flags[both_sides(step_speed > max_speed)] |= FLAG_POSITION_JUMP
+
+        acceleration = np.abs(np.diff(speed * KNOTS)) / dt
+        flags[both_sides(acceleration > params['max_acceleration'])] |= \
+            FLAG_ACCELERATION
+    return flags
+
+def process_session(args):
+    """Pool worker: load and filter one session, return (session id, row
+       ids, flags)"""
+    db_file, session_id, params, chunk_size = args
+    db = sqlite3.connect(db_file)
+    try:
+        data = load_session(db, session_id, chunk_size)
+    finally:
+        db.close()
+    return session_id, data[:, 0].astype(np.int64), compute_flags(data,
+                                                                  params)
+
+def store_flags(db, session_id, ids, flags, chunk_size=CHUNK_SIZE):
+    """Write a session's flags back in bulk and commit. Most positions
+       pass, so the session is cleared in one statement and only flagged
+       rows are updated one by one."""
+    db.execute('UPDATE positions SET flags = 0 WHERE session_id = ?',
+               (session_id,))
+    flagged = np.flatnonzero(flags)
+    for start in xrange(0, len(flagged), chunk_size):
+        rows = flagged[start:start+chunk_size]
+        db.executemany('UPDATE positions SET flags = ? WHERE _id = ?',
+                       zip(flags[rows].tolist(), ids[rows].tolist()))
+    db.commit()
+
+def process_sessions(db_file, session_ids, params=DEFAULT_PARAMS, jobs=1,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Filter the given sessions, jobs of them at a time, and store their
+    flags. Returns {flag: count} over all processed positions.
+    """
+    db = sqlite3.connect(db_file)
+    ensure_schema(db)
+    tasks = [(db_file, sid, params, chunk_size) for sid in session_ids]
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(process_session, tasks)
+    else:
+        results = (process_session(task) for task in tasks)
+    totals = dict((flag, 0) for flag, dummy in FLAG_NAMES)
+    try:
+        for session_id, ids, flags in results:
+            store_flags(db, session_id, ids, flags, chunk_size)
+            for flag in totals:
+                totals[flag] += int(np.count_nonzero(flags & flag))
+            logging.info('Session %d: %d positions, %d flagged.', session_id,
+                         len(ids), np.count_nonzero(flags))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        db.close()
+    return totals
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to process')
+    apr.add_argument('sessions', nargs='*', type=int,
+                     help='Session ids (defaults to every closed session)')
+    apr.add_argument('--jobs', type=int,
+                     default=multiprocessing.cpu_count(),
+                     help='Sessions processed in parallel (default: cores)')
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help='Rows read or written at once (default %d)' %
+                     CHUNK_SIZE)
+    for name, value in sorted(DEFAULT_PARAMS.items()):
+        apr.add_argument('--' + name.replace('_', '-'), type=type(value),
+                         default=value, help='(default %s)' % value)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    params = dict((name, getattr(app, name)) for name in DEFAULT_PARAMS)
+    try:
+        sessions = app.sessions
+        if not sessions:
+            db = sqlite3.connect(app.db_file)
+            sessions = [row[0] for row in db.execute(
+                'SELECT _id FROM sessions WHERE stoptime IS NOT NULL '
+                'ORDER BY _id')]
+            db.close()
+        totals = process_sessions(app.db_file, sessions, params, app.jobs,
+                                  app.chunk)
+    except sqlite3.Error:
+        logging.critical('Processing %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    for flag, name in FLAG_NAMES:
+        logging.info('%-14s %d', name + ':', totals[flag])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+On-demand profiling of a running daemon, shared by NMEAd and SBScan.
+
+A Profiler samples the stacks of every thread from a thread of its own
+while it runs, so it needs no cooperation from the profiled threads and
+costs nothing while stopped. Samples are wall clock samples: a thread
+blocked in a read or a sleep is counted at the line it is blocked on,
+which tells idle threads from busy ones in the report.
+
+A Tracer adds timing spans to registered call sites (bound methods,
+module functions) and locks. They are patched in only while tracing is
+enabled and restored afterwards, so the call sites run their original
+code otherwise.
+"""
+import os
+import sys
+import time
+import thread
+import threading
+import collections
+import logging
+
+from metrics import Histogram
+
+PROFILE_INTERVAL = 0.005
+REPORT_LINES = 25
+NAME_REFRESH = 200
+
+# Span bucket upper bounds in seconds: 1 us doubling up to ~67 s.
+SPAN_BOUNDS = tuple(0.000001 * 2 ** i for i in range(27))
+
+
+def function_name(code):
+    """Readable name of a code object"""
+    return '%s (%s:%d)' % (code.co_name, code.co_filename,
+                           code.co_firstlineno)
+
+
+class TimedLock(object):
+    """Lock proxy recording how long every acquire waited"""
+    def __init__(self, lock, record):
+        self.lock = lock
+        self.record = record
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        acquired = self.lock.acquire(blocking)
+        self.record(time.time() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, dummy, dummy2, dummy3):
+        self.lock.release()
+
+
+class Tracer(object):
+    """Timing spans patched onto registered attributes while enabled"""
+    def __init__(self):
+        self.sites = []
+        self.patched = []
+        self.histograms = {}
+        self.enabled = False
+
+    def register(self, owner, attribute, name):
+        """Time calls to owner.attribute as span name"""
+        self.sites.append((owner, attribute, name, self.timed))
+
+    def register_lock(self, owner, attribute, name):
+        """Time waits for the lock owner.attribute as span lock.name"""
+        self.sites.append((owner, attribute, 'lock.' + name,
+                           self.timed_lock))
+
+    def recorder(self, name):
+        """Return a callable recording durations of span name into a
+           histogram of the calling thread"""
+        histograms = self.histograms
+        def record(elapsed):
+            key = (name, threading.current_thread().name)
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms.setdefault(key,
+                                                  Histogram(SPAN_BOUNDS))
+            histogram.record(elapsed)
+        return record
+
+    def timed(self, function, name):
+        """Wrap function in a span"""
+        record = self.recorder(name)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(time.time() - start)
+        return wrapper
+
+    def timed_lock(self, lock, name):
+        """Wrap lock in a waiting time recording proxy; it shares the
+           lock, so swapping it while held is safe"""
+        return TimedLock(lock, self.recorder(name))
+
+    def enable(self):
+        """Patch every registered site"""
+        if self.enabled:
+            return
+        self.histograms.clear()
+        for owner, attribute, name, wrap in self.sites:
+            shadowed = attribute in getattr(owner, '__dict__', {})
+            original = getattr(owner, attribute)
+            setattr(owner, attribute, wrap(original, name))
+            self.patched.append((owner, attribute, original, shadowed))
+        self.enabled = True
+
+    def disable(self):
+        """Restore every patched site"""
+        while self.patched:
+            owner, attribute, original, shadowed = self.patched.pop()
+            if shadowed:
+                setattr(owner, attribute, original)
+            else:
+                # A bound method looked up through the class.
+                delattr(owner, attribute)
+        self.enabled = False
+
+    def report(self):
+        """Text table of every span, per thread"""
+        lines = ['%-32s %-12s %9s %10s %10s %10s %10s' %
+                 ('span', 'thread', 'count', 'total s', 'mean us',
+                  'p99 us', 'max us')]
+        for (name, thread_name), histogram in sorted(
+                self.histograms.items()):
+            snapshot = histogram.snapshot()
+            lines.append('%-32s %-12s %9d %10.3f %10.1f %10.1f %10.1f' %
+                         (name, thread_name[:12], snapshot['count'],
+                          histogram.total, snapshot['mean'] * 1e6,
+                          snapshot['p99'] * 1e6, snapshot['max'] * 1e6))
+        return lines
+
+
+class Profiler(object):
+    """Sampling profiler of every thread, started and stopped on demand,
+       writing a text report to fname when stopped"""
+    def __init__(self, fname, interval=PROFILE_INTERVAL, tracer=None):
+        self.fname = fname
+        self.interval = interval
+        self.tracer = tracer
+        self.thread = None
+        self.stopped = False
+        self.samples = 0
+        self.started = None
+        self.cpu_started = None
+        self.own = collections.defaultdict(collections.Counter)
+        self.total = collections.defaultdict(collections.Counter)
+        self.lines = collections.defaultdict(collections.Counter)
+        self.thread_samples = collections.Counter()
+
+    @property
+    def running(self):
+        """Whether a profiling session is in progress"""
+        return self.thread is not None
+
+    def toggle(self):
+        """Start a session, or stop the running one and write its
+           report"""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        """Start sampling, and tracing if a tracer was given"""
+        for counters in (self.own, self.total, self.lines):
+            counters.clear()
+        self.thread_samples.clear()
+        self.samples = 0
+        self.started = time.time()
+        self.cpu_started = sum(os.times()[:2])
+        self.stopped = False
+        if self.tracer is not None:
+            self.tracer.enable()
+        self.thread = threading.Thread(target=self.run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('Profiling started.')
+
+    def stop(self):
+        """Stop sampling and tracing and write the report"""
+        self.stopped = True
+        self.thread.join()
+        self.thread = None
+        if self.tracer is not None:
+            self.tracer.disable()
+        try:
+            self.write()
+        except IOError:
+            logging.error('Failed to write profile %s', self.fname)
+        else:
+            logging.info('Profiling stopped, report written to %s',
+                         self.fname)
+
+    def run(self):
+        """Sampler thread body"""
+        own = thread.get_ident()
+        names = {}
+        while not self.stopped:
+            time.sleep(self.interval)
+            if not self.samples % NAME_REFRESH:
+                names = dict((t.ident, t.name)
+                             for t in threading.enumerate())
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.sample(names.get(ident, str(ident)), frame)
+
+    def sample(self, name, frame):
+        """Account one stack of thread name"""
+        self.thread_samples[name] += 1
+        code = frame.f_code
+        self.own[name][code] += 1
+        self.lines[name][(code, frame.f_lineno)] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                self.total[name][code] += 1
+            frame = frame.f_back
+
+    def write(self):
+        """Write the report of the last session"""
+        elapsed = time.time() - self.started
+        cpu = sum(os.times()[:2]) - self.cpu_started
+        seconds = elapsed / max(self.samples, 1)
+        out = ['Profile of %.1f s, %d samples every %.1f ms, process CPU '
+               '%.2f s (%.0f%%).' % (elapsed, self.samples, seconds * 1e3,
+                                     cpu, 100 * cpu / max(elapsed, 1e-9)),
+               'Times are wall clock: blocked threads count too.', '']
+        for name, count in sorted(self.thread_samples.items()):
+            out.append('Thread %s: %d samples' % (name, count))
+            out.append('  %10s %10s  %s' % ('own s', 'total s', 'function'))
+            for code, hits in self.own[name].most_common(REPORT_LINES):
+                out.append('  %10.3f %10.3f  %s' %
+                           (hits * seconds, self.total[name][code] * seconds,
+                            function_name(code)))
+            out.append('  %10s %10s  %s' % ('line s', '', 'executing line'))
+            for (code, lineno), hits in self.lines[name].most_common(
+                    REPORT_LINES):
+                out.append('  %10.3f %10s  %s:%d in %s' %
+                           (hits * seconds, '', code.co_filename, lineno,
+                            code.co_name))
+            out.append('')
+        if self.tracer is not None:
+            out.append('Spans:')
+            out.extend(self.tracer.report())
+        with open(self.fname, 'w') as f:
+            f.write('\n'.join(out) + '\n')
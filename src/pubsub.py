@@ -0,0 +1,120 @@
+"""
+Framing and client side of NMEAd's unix socket publish/subscribe
+interface. Every frame is a 4 byte big endian length followed by a json
+object. A client first sends a subscription frame:
+
+    {"fields": [field names], "headers": [sentence headers]}
+
+where an empty or missing list matches everything. The server answers
+with the current state, {"h": null, "s": {field: [value, toa]}}, and then
+pushes one frame per received sentence, {"h": header, "t": toa,
+"d": {field: value}}, limited to the subscribed fields.
+"""
+import json
+import errno
+import socket
+import struct
+
+FRAME_HEADER_FMT = '!I'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FMT)
+MAX_FRAME_SIZE = 1 << 20
+
+
+class FrameError(Exception):
+    """Malformed or oversized frame"""
+    pass
+
+
+def pack_frame(obj):
+    """Serialise obj into a length prefixed json frame"""
+    payload = json.dumps(obj, separators=(',', ':'))
+    return struct.pack(FRAME_HEADER_FMT, len(payload)) + payload
+
+
+class FrameBuffer(object):
+    """Accumulates received bytes and splits them into decoded frames"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add data and return a list of every complete frame decoded"""
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        start = 0
+        while len(buf) - start >= FRAME_HEADER_SIZE:
+            length = struct.unpack_from(FRAME_HEADER_FMT, buf, start)[0]
+            if length > MAX_FRAME_SIZE:
+                raise FrameError, 'Frame of %d bytes is too large.' % length
+            end = start + FRAME_HEADER_SIZE + length
+            if len(buf) < end:
+                break
+            try:
+                frames.append(json.loads(
+                    str(buf[start+FRAME_HEADER_SIZE:end])))
+            except ValueError:
+                raise FrameError, 'Frame is not valid json.'
+            start = end
+        del buf[:start]
+        return frames
+
+
+class Subscriber(object):
+    """
+    Client of NMEAd's publish/subscribe socket. Keeps a merged
+    {field: (value, toa)} view of everything received, in the same shape
+    as NMEAd's json file.
+    """
+    def __init__(self, path, fields=(), headers=(), timeout=1.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except socket.error:
+            self.sock.close()
+            raise
+        self.frames = FrameBuffer()
+        self.state = {}
+        self.sock.sendall(pack_frame({'fields': list(fields),
+                                      'headers': list(headers)}))
+
+    def receive(self, merge=True):
+        """
+        receive(merge: bool) -> list of (header, toa, data)
+
+        Wait up to the socket timeout for frames and, if merge, merge them
+        into self.state. The initial state frame is reported with header
+        None; a wait cut short by a signal returns no updates. Raises
+        EOFError once the server closes the connection.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return []
+        except socket.error, err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not data:
+            raise EOFError, 'NMEAd closed the connection.'
+        updates = []
+        for frame in self.frames.feed(data):
+            if frame.get('h') is None:
+                updates.append((None, None, frame.get('s', {})))
+            else:
+                updates.append((frame['h'], frame['t'], frame['d']))
+        if merge:
+            for update in updates:
+                self.apply(update)
+        return updates
+
+    def apply(self, update):
+        """Merge one (header, toa, data) update into self.state"""
+        header, toa, data = update
+        for name, value in data.iteritems():
+            self.state[name] = tuple(value) if header is None else (value,
+                                                                    toa)
+
+    def close(self):
+        """Close the connection"""
+        self.sock.close()
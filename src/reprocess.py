@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+Batch reprocessing of logged depths. The depths SBScan logs are raw
+sounder depths below the transducer; this reduces them to chart datum,
+
+    corrected = depth * sound_velocity / sounder_velocity + draft - tide
+
+where tide is the water level above chart datum at the position's
+passing time, interpolated linearly in a tide table. The corrections are
+read from a config file,
+
+    [corrections]           defaults for every session
+    tide_file = harbour.txt
+    draft = 0.5
+    [source boat2]          overrides for the sessions of a source
+    draft = 0.8
+    [session 42]            overrides for one session
+    sound_velocity = 1487
+
+and tide tables are text files of "YYYY-MM-DD HH:MM[:SS] HEIGHT" (UTC)
+or "EPOCH_SECONDS HEIGHT" lines.
+
+Corrected depths are written to a versioned column, positions.depth_vN,
+leaving positions.depth untouched. Positions that cannot be corrected (no
+depth, or a passing time outside the tide table) get NULL. The
+reprocessing table records, per version and session, a signature of the
+corrections used and of the rows covered (their count and the sums of
+their ids and depths), so a rerun only reprocesses sessions whose
+corrections, tide table, positions or logged depths changed.
+
+Sessions are processed chunk by chunk in a process pool; every tide table
+is parsed once and handed to the workers when the pool starts. The
+database is only written by the main process.
+
+Run as: reprocess.py DB_FILE CORRECTIONS_FILE [SESSION_ID ...]
+                     [--version N] [--jobs N] [--force]
+"""
+
+import os
+import json
+import time
+import calendar
+import hashlib
+import sqlite3
+import argparse
+import logging
+import multiprocessing
+import ConfigParser
+import sys
+
+import numpy as np
+
+from migrate_db import table_columns
+
+CHUNK_SIZE = 100000
+
+DEFAULT_CORRECTIONS = {'tide_file': '',
+                       'tide_time_offset': '0',     # Seconds
+                       'draft': '0',                # Metres
+                       'sound_velocity': '1500',    # m/s
+                       'sounder_velocity': '1500'}  # m/s
+
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M']
+
+REPROCESSING_DDL = ('CREATE TABLE IF NOT EXISTS reprocessing('
+                    'version INTEGER, session_id INTEGER, signature TEXT, '
+                    'rows INTEGER, id_sum INTEGER, depth_sum INTEGER, '
+                    'processed TIMESTAMP, PRIMARY KEY(version, session_id))')
+# Rows a session was processed with; integer sums, so edits show exactly.
+STATE_QUERY = ('SELECT count(*), sum(_id), '
+               'sum(CAST(round(depth * 100) AS INTEGER)) '
+               'FROM positions WHERE session_id = ?')
+
+# Tide tables of the worker processes, {path: (times, heights)}.
+tide_tables = {}
+
+
+class CorrectionError(Exception):
+    """Corrections or tide table related error"""
+    pass
+
+
+def depth_column(version):
+    """Name of the corrected depth column of a version"""
+    return 'depth_v%d' % version
+
+def parse_time(text):
+    """Epoch seconds of an epoch number or a UTC date and time"""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    text = text.replace('T', ' ').rstrip('Z')
+    for fmt in TIME_FORMATS:
+        try:
+            return float(calendar.timegm(time.strptime(text, fmt)))
+        except ValueError:
+            pass
+    raise ValueError, 'Unrecognised time %r' % text
+
+def parse_tide_table(fname):
+    """
+    parse_tide_table(fname: str) -> (ndarray, ndarray)
+
+    Read a tide table into arrays of epoch times, ascending, and water
+    levels in metres.
+    """
+    times = []
+    heights = []
+    try:
+        with open(fname) as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                try:
+                    times.append(parse_time(' '.join(fields[:-1])))
+                    heights.append(float(fields[-1]))
+                except ValueError:
+                    raise CorrectionError, ('%s:%d: unparsable tide entry.' %
+                                            (fname, number))
+    except IOError:
+        raise CorrectionError, 'Unable to read tide table %s.' % fname
+    if len(times) < 2:
+        raise CorrectionError, 'Tide table %s has under 2 entries.' % fname
+    times = np.array(times)
+    heights = np.array(heights)
+    order = np.argsort(times, kind='mergesort')
+    times = times[order]
+    if not (np.diff(times) > 0).all():
+        raise CorrectionError, 'Tide table %s repeats times.' % fname
+    return times, heights[order]
+
+
+class TideCache(object):
+    """Parsed tide tables by path, reparsed only when a file changes"""
+    def __init__(self):
+        self.tables = {}
+
+    def get(self, fname):
+        """Return (times, heights, digest) of a tide table"""
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            raise CorrectionError, 'Unable to read tide table %s.' % fname
+        key = (stat.st_mtime, stat.st_size)
+        cached = self.tables.get(fname)
+        if cached is None or cached[0] != key:
+            times, heights = parse_tide_table(fname)
+            digest = hashlib.sha1(times.tobytes() +
+                                  heights.tobytes()).hexdigest()
+            cached = self.tables[fname] = (key, times, heights, digest)
+        return cached[1:]
+
+
+def load_corrections(fname):
+    """Read a corrections file into a ConfigParser, tide_file paths
+       resolved relative to it"""
+    cfg = ConfigParser.SafeConfigParser()
+    try:
+        if not cfg.read(fname):
+            raise CorrectionError, ('Unable to read corrections file %s.' %
+                                    fname)
+    except ConfigParser.Error:
+        raise CorrectionError, 'Invalid corrections file %s: %s' % \
+            (fname, sys.exc_info()[1])
+    base = os.path.dirname(os.path.abspath(fname))
+    for section in cfg.sections():
+        if cfg.has_option(section, 'tide_file'):
+            tide_file = cfg.get(section, 'tide_file')
+            if tide_file:
+                cfg.set(section, 'tide_file', os.path.join(base, tide_file))
+    return cfg
+
+def session_corrections(cfg, session_id, source=None):
+    """Effective corrections of a session: the defaults, overridden by
+       [corrections], its [source NAME] and then its [session ID]
+       section"""
+    params = dict(DEFAULT_CORRECTIONS)
+    for section in ('corrections', 'source %s' % source,
+                    'session %d' % session_id):
+        if cfg.has_section(section):
+            params.update(cfg.items(section))
+    try:
+        result = dict((name, float(params[name])) for name
+                      in DEFAULT_CORRECTIONS if name != 'tide_file')
+    except ValueError:
+        raise CorrectionError, 'Invalid corrections for session %d.' % \
+            session_id
+    if not result['sounder_velocity'] > 0:
+        raise CorrectionError, 'Invalid sounder_velocity for session %d.' % \
+            session_id
+    result['tide_file'] = params['tide_file']
+    return result
+
+def signature(params, tide_digest):
+    """Digest of everything a session's corrected depths depend on"""
+    return hashlib.sha1(json.dumps([params, tide_digest],
+                                   sort_keys=True)).hexdigest()
+
+def correct_depths(toa, depth, params, tide=None):
+    """
+    correct_depths(toa: ndarray, depth: ndarray, params: dict,
+                   tide: (ndarray, ndarray)) -> ndarray
+
+    Corrected depths of a chunk of positions; nan where there is no depth
+    or the passing time lies outside the tide table.
+    """
+    with np.errstate(invalid='ignore'):
+        corrected = np.where(depth > 0, depth, np.nan)
+    corrected *= params['sound_velocity'] / params['sounder_velocity']
+    corrected += params['draft']
+    if tide is not None:
+        times, heights = tide
+        at = toa + params['tide_time_offset']
+        corrected -= np.interp(at, times, heights, left=np.nan,
+                               right=np.nan)
+    return corrected
+
+def init_worker(tables):
+    """Pool initializer: install the parsed tide tables"""
+    tide_tables.clear()
+    tide_tables.update(tables)
+
+def process_session(args):
+    """Pool worker: correct one session chunk by chunk, return (session
+       id, row ids, corrected depths)"""
+    db_file, session_id, params, chunk_size = args
+    tide = tide_tables[params['tide_file']] if params['tide_file'] else None
+    db = sqlite3.connect(db_file)
+    ids = []
+    corrected = []
+    last_id = 0
+    try:
+        while True:
+            rows = db.execute('SELECT _id, passing_time, depth FROM '
+                              'positions WHERE session_id = ? AND _id > ? '
+                              'ORDER BY _id LIMIT ?',
+                              (session_id, last_id, chunk_size)).fetchall()
+            if not rows:
+                break
+            data = np.array(rows, dtype=np.float64)
+            ids.append(data[:, 0].astype(np.int64))
+            corrected.append(correct_depths(data[:, 1], data[:, 2], params,
+                                            tide))
+            last_id = rows[-1][0]
+    finally:
+        db.close()
+    if not ids:
+        return session_id, np.zeros(0, np.int64), np.zeros(0)
+    return session_id, np.concatenate(ids), np.concatenate(corrected)
+
+def ensure_schema(db, version):
+    """Add the version's depth column and the reprocessing table"""
+    column = depth_column(version)
+    if column not in table_columns(db, 'positions'):
+        db.execute('ALTER TABLE positions ADD COLUMN %s REAL' % column)
+        logging.info('Added column positions.%s', column)
+    db.execute(REPROCESSING_DDL)
+    db.commit()
+
+def store_depths(db, version, session_id, ids, corrected, sig, state,
+                 chunk_size=CHUNK_SIZE):
+    """Write a session's corrected depths and its reprocessing record in
+       one transaction"""
+    statement = 'UPDATE positions SET %s = ? WHERE _id = ?' % \
+        depth_column(version)
+    values = np.where(np.isfinite(corrected), corrected, None)
+    for start in xrange(0, len(ids), chunk_size):
+        db.executemany(statement,
+                       zip(values[start:start+chunk_size].tolist(),
+                           ids[start:start+chunk_size].tolist()))
+    db.execute('INSERT OR REPLACE INTO reprocessing '
+               'VALUES (?,?,?,?,?,?,?)',
+               (version, session_id, sig) + state + (time.time(),))
+    db.commit()
+
+def plan(db, cfg, version, session_ids, tides, force=False):
+    """
+    Return the (session id, corrections, signature, row state) of the
+    given sessions that need reprocessing: those never processed at this
+    version, or whose signature, positions or depths changed since.
+    """
+    sources = dict(db.execute('SELECT _id, source FROM sessions')
+                   if 'source' in table_columns(db, 'sessions') else [])
+    done = dict((row[0], row[1:]) for row in db.execute(
+        'SELECT session_id, signature, rows, id_sum, depth_sum '
+        'FROM reprocessing '
+        'WHERE version = ?', (version,)))
+    todo = []
+    for session_id in session_ids:
+        params = session_corrections(cfg, session_id,
+                                     sources.get(session_id))
+        digest = None
+        if params['tide_file']:
+            digest = tides.get(params['tide_file'])[2]
+        sig = signature(params, digest)
+        state = db.execute(STATE_QUERY, (session_id,)).fetchone()
+        if not state[0]:
+            logging.info('Session %d: no positions in the database, '
+                         'skipped.', session_id)
+            continue
+        if not force and done.get(session_id) == (sig,) + state:
+            continue
+        todo.append((session_id, params, sig, state))
+    return todo
+
+def reprocess_sessions(db_file, corrections_file, session_ids, version=1,
+                       jobs=1, force=False, chunk_size=CHUNK_SIZE):
+    """
+    Correct the given sessions that changed since their last run at this
+    version, jobs of them at a time. Returns (sessions reprocessed,
+    positions corrected, positions left NULL).
+    """
+    cfg = load_corrections(corrections_file)
+    tides = TideCache()
+    db = sqlite3.connect(db_file)
+    try:
+        ensure_schema(db, version)
+        todo = plan(db, cfg, version, session_ids, tides, force)
+        tide_files = set(task[1]['tide_file'] for task in todo
+                         if task[1]['tide_file'])
+        tables = dict((fname, tides.get(fname)[:2]) for fname in tide_files)
+        signatures = dict((task[0], task[2:]) for task in todo)
+        tasks = [(db_file, task[0], task[1], chunk_size) for task in todo]
+        pool = None
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(jobs, init_worker, (tables,))
+            results = pool.imap_unordered(process_session, tasks)
+        else:
+            init_worker(tables)
+            results = (process_session(task) for task in tasks)
+        corrected_total = null_total = 0
+        try:
+            for session_id, ids, corrected in results:
+                sig, state = signatures[session_id]
+                store_depths(db, version, session_id, ids, corrected, sig,
+                             state, chunk_size)
+                nulls = int(np.count_nonzero(~np.isfinite(corrected)))
+                corrected_total += len(ids) - nulls
+                null_total += nulls
+                logging.info('Session %d: %d positions, %d left NULL.',
+                             session_id, len(ids), nulls)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        db.close()
+    return len(tasks), corrected_total, null_total
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to reprocess')
+    apr.add_argument('corrections_file', help='Corrections config file')
+    apr.add_argument('sessions', nargs='*', type=int,
+                     help='Session ids (defaults to every closed session)')
+    apr.add_argument('--version', type=int, default=1,
+                     help='Corrected depth column version (default 1)')
+    apr.add_argument('--jobs', type=int,
+                     default=multiprocessing.cpu_count(),
+                     help='Sessions processed in parallel (default: cores)')
+    apr.add_argument('--force', action='store_true',
+                     help='Reprocess unchanged sessions too')
+    apr.add_argument('--chunk', type=int, default=CHUNK_SIZE,
+                     help='Rows read or written at once (default %d)' %
+                     CHUNK_SIZE)
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    if app.version < 1:
+        apr.error('--version must be at least 1')
+    try:
+        sessions = app.sessions
+        if not sessions:
+            db = sqlite3.connect(app.db_file)
+            sessions = [row[0] for row in db.execute(
+                'SELECT _id FROM sessions WHERE stoptime IS NOT NULL '
+                'ORDER BY _id')]
+            db.close()
+        count, corrected, nulls = reprocess_sessions(
+            app.db_file, app.corrections_file, sessions, app.version,
+            app.jobs, app.force, app.chunk)
+    except (sqlite3.Error, CorrectionError, OSError):
+        logging.critical('Reprocessing %s failed: %s', app.db_file,
+                         sys.exc_info()[1])
+        sys.exit(1)
+    logging.info('Done, %d sessions reprocessed into %s: %d positions '
+                 'corrected, %d left NULL.', count, depth_column(app.version),
+                 corrected, nulls)
+
+if __name__ == '__main__':
+    main()
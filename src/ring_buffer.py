@@ -0,0 +1,147 @@
+"""
+Implements a single-writer, many-reader ring buffer of fixed-size
+timestamped records living in a memory-mapped file. The writer never
+waits for readers; readers keep their own cursor and detect overruns
+by comparing per-slot sequence numbers.
+
+File layout (little endian):
+    header: magic, version, slot_count, slot_size, head sequence
+    slots:  sequence, timestamp, payload length, payload
+"""
+import os
+import mmap
+import struct
+
+RING_MAGIC = 'NMRB'
+RING_VERSION = 1
+
+HEADER_FMT = '<4sIIIQ'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+HEAD_OFFSET = HEADER_SIZE - struct.calcsize('<Q')
+SLOT_HEADER_FMT = '<QdI'
+SLOT_HEADER_SIZE = struct.calcsize(SLOT_HEADER_FMT)
+
+
+class RingError(Exception):
+    """Ring buffer file related error"""
+    pass
+
+
+class RecordTooLarge(RingError):
+    """Record does not fit into a ring slot"""
+    pass
+
+
+def _slot_offset(seq, slot_count, slot_size):
+    """Offset of the slot holding record number seq"""
+    return HEADER_SIZE + (seq % slot_count) * slot_size
+
+
+class RingWriter(object):
+    """Appends records to a ring buffer file, creating it if needed"""
+    def __init__(self, fname, slot_count=1024, slot_size=4096):
+        if slot_size <= SLOT_HEADER_SIZE:
+            raise RingError, 'Slot size %d is too small.' % slot_size
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.payload_size = slot_size - SLOT_HEADER_SIZE
+        size = HEADER_SIZE + slot_count * slot_size
+
+        # Readers may still map the file of a previous writer; resizing
+        # it in place, rather than truncating it to zero first, keeps
+        # their pages valid.
+        self.file = os.fdopen(os.open(fname, os.O_RDWR | os.O_CREAT, 0644),
+                              'r+b')
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.head = 0
+        # Readers refuse the file until the magic is in place, so the
+        # header is written last.
+        struct.pack_into(HEADER_FMT, self.map, 0, '\0' * 4, RING_VERSION,
+                         slot_count, slot_size, self.head)
+        self.map[0:4] = RING_MAGIC
+
+    def append(self, payload, timestamp):
+        """Append a record, overwriting the oldest one if the ring is full"""
+        if len(payload) > self.payload_size:
+            raise RecordTooLarge, ('Record of %d bytes exceeds slot '
+                                   'payload size %d.') % (len(payload),
+                                                          self.payload_size)
+        seq = self.head + 1
+        offset = _slot_offset(seq, self.slot_count, self.slot_size)
+        # Zero sequence marks the slot as being rewritten.
+        struct.pack_into('<Q', self.map, offset, 0)
+        data_start = offset + SLOT_HEADER_SIZE
+        self.map[data_start:data_start+len(payload)] = payload
+        struct.pack_into(SLOT_HEADER_FMT, self.map, offset,
+                         seq, timestamp, len(payload))
+        struct.pack_into('<Q', self.map, HEAD_OFFSET, seq)
+        self.head = seq
+
+    def close(self):
+        """Unmap and close the ring file"""
+        self.map.close()
+        self.file.close()
+
+
+class RingReader(object):
+    """Reads records appended since the last call, tracking overruns"""
+    def __init__(self, fname):
+        self.file = open(fname, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER_SIZE:
+            self.file.close()
+            raise RingError, 'Ring file %s is not initialized.' % fname
+        self.map = mmap.mmap(self.file.fileno(), size,
+                             access=mmap.ACCESS_READ)
+        (magic, version, self.slot_count,
+         self.slot_size, head) = struct.unpack_from(HEADER_FMT, self.map, 0)
+        if magic != RING_MAGIC or version != RING_VERSION:
+            self.close()
+            raise RingError, 'Ring file %s has a bad header.' % fname
+        if size < HEADER_SIZE + self.slot_count * self.slot_size:
+            self.close()
+            raise RingError, 'Ring file %s is truncated.' % fname
+        self.cursor = head
+        self.overruns = 0
+
+    def head(self):
+        """Sequence number of the newest record"""
+        return struct.unpack_from('<Q', self.map, HEAD_OFFSET)[0]
+
+    def read(self):
+        """
+        read() -> list of (seq, timestamp, payload)
+
+        Return every record written since the previous call. Records that
+        were overwritten before they could be read are counted in
+        self.overruns and skipped.
+        """
+        head = self.head()
+        if head < self.cursor:
+            # The writer restarted and recreated the ring.
+            self.cursor = 0
+        if head - self.cursor > self.slot_count:
+            self.overruns += head - self.cursor - self.slot_count
+            self.cursor = head - self.slot_count
+
+        records = []
+        for seq in xrange(self.cursor + 1, head + 1):
+            offset = _slot_offset(seq, self.slot_count, self.slot_size)
+            slot_seq, timestamp, length = struct.unpack_from(
+                SLOT_HEADER_FMT, self.map, offset)
+            data_start = offset + SLOT_HEADER_SIZE
+            length = min(length, self.slot_size - SLOT_HEADER_SIZE)
+            payload = self.map[data_start:data_start+length]
+            if (slot_seq != seq or
+                struct.unpack_from('<Q', self.map, offset)[0] != seq):
+                self.overruns += 1
+                continue
+            records.append((seq, timestamp, payload))
+        self.cursor = head
+        return records
+
+    def close(self):
+        """Unmap and close the ring file"""
+        self.map.close()
+        self.file.close()
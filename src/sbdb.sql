@@ -1,7 +1,9 @@
 CREATE TABLE sessions(
 	_id          INTEGER PRIMARY KEY, 
 	starttime    TIMESTAMP, 
-	stoptime     TIMESTAMP);
+	stoptime     TIMESTAMP,
+	utm_zone     INTEGER,
+	source       TEXT);
 	
 CREATE TABLE positions(
 	_id          INTEGER PRIMARY KEY,
@@ -13,7 +15,36 @@ CREATE TABLE positions(
 	time_between REAL,
 	depth        REAL,
 	session_id   INTEGER,
+	lat_deg      REAL,
+	lon_deg      REAL,
+	x            REAL,
+	y            REAL,
+	flags        INTEGER,
 	FOREIGN KEY(session_id) REFERENCES sessions(_id));
+
+CREATE INDEX positions_session ON positions(session_id);
+
+CREATE VIRTUAL TABLE positions_rtree USING rtree(
+	id,
+	min_lat, max_lat,
+	min_lon, max_lon);
+
+CREATE TRIGGER positions_rtree_insert AFTER INSERT ON positions
+	WHEN new.lat_deg IS NOT NULL BEGIN
+	INSERT INTO positions_rtree VALUES (new._id, new.lat_deg, new.lat_deg,
+	                                    new.lon_deg, new.lon_deg);
+END;
+
+CREATE TRIGGER positions_rtree_update AFTER UPDATE OF lat_deg, lon_deg
+	ON positions WHEN new.lat_deg IS NOT NULL BEGIN
+	INSERT OR REPLACE INTO positions_rtree VALUES (new._id,
+	                                    new.lat_deg, new.lat_deg,
+	                                    new.lon_deg, new.lon_deg);
+END;
+
+CREATE TRIGGER positions_rtree_delete AFTER DELETE ON positions BEGIN
+	DELETE FROM positions_rtree WHERE id = old._id;
+END;
 	
 CREATE TABLE points(
 	_id          INTEGER PRIMARY KEY,
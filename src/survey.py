@@ -0,0 +1,251 @@
+"""
+Read access to a whole survey: the live positions in an SBScan database
+and the sessions archive.py moved into a columnar archive. Sessions and
+query results are returned as {column: array} dicts with the columns and
+types of archive.ARCHIVE_COLUMNS, whichever of the two a session lives
+in. Databases that predate the numeric coordinate columns are read too;
+their NMEA lat/lon strings are converted array by array.
+
+Decoded sessions are kept in a small LRU cache. A cached live session is
+checked against the database whenever the database changed since it was
+read, so sessions still being logged (or flagged by postprocess.py) are
+read again while finished ones are not. Cached arrays are shared between
+callers and therefore read-only.
+"""
+import sqlite3
+import collections
+
+import numpy as np
+
+import npgeo
+from migrate_db import table_columns
+from archive import (Archive, read_session, column_query, rows_to_columns,
+                     concatenate, CHUNK_SIZE)
+
+SESSION_CACHE_SIZE = 8
+
+
+def parse_coordinates(strings):
+    """
+    parse_coordinates(strings: sequence) -> ndarray
+
+    Convert logged NMEA coordinates such as '4530.1234N' to signed
+    decimal degrees; NULL or malformed ones become nan.
+    """
+    raw = np.array([value or '' for value in strings], dtype=np.str_)
+    if not len(raw):
+        return np.zeros(0)
+    lengths = np.char.str_len(raw)
+    chars = raw.view('S1').reshape(len(raw), -1)
+    hemispheres = chars[np.arange(len(raw)), np.maximum(lengths - 1, 0)]
+    numbers = np.char.rstrip(raw, 'NSEW')
+    valid = (np.char.isdigit(np.char.replace(numbers, '.', '')) &
+             (lengths > 1))
+    numbers[~valid] = 'nan'
+    return npgeo.nmea_to_degrees(numbers.astype(np.float64), hemispheres)
+
+def with_session_id(columns, session_id):
+    """Add a constant session_id column"""
+    columns = dict(columns)
+    columns['session_id'] = np.full(len(columns['_id']), session_id,
+                                    dtype=np.int64)
+    return columns
+
+def select(columns, index):
+    """Rows of every column at index (a slice, mask or index array)"""
+    return dict((name, values[index]) for name, values in columns.items())
+
+
+class Survey(object):
+    """Reader over a database and an optional archive directory"""
+    def __init__(self, db_file, archive_dir=None, chunk_size=CHUNK_SIZE,
+                 cache_size=SESSION_CACHE_SIZE):
+        self.db = sqlite3.connect(db_file)
+        self.archive = Archive(archive_dir) if archive_dir else None
+        self.chunk_size = chunk_size
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        present = table_columns(self.db, 'positions')
+        self.legacy = 'lat_deg' not in present
+        self.fingerprint_query = ('SELECT count(*), max(_id)%s FROM '
+                                  'positions WHERE session_id = ?' %
+                                  (', total(flags)' if 'flags' in present
+                                   else ''))
+
+    def close(self):
+        """Close the database connection"""
+        self.db.close()
+
+    def archived(self):
+        """Set of archived session ids"""
+        if self.archive is None:
+            return set()
+        return set(self.archive.session_ids())
+
+    def session_ids(self):
+        """Ids of every session, live or archived"""
+        ids = set(row[0] for row in self.db.execute('SELECT _id '
+                                                    'FROM sessions'))
+        return sorted(ids | self.archived())
+
+    def data_version(self):
+        """Changes whenever another connection commits to the database"""
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def fingerprint(self, session_id):
+        """Row count, last row id and flag total of a live session"""
+        return self.db.execute(self.fingerprint_query,
+                               (session_id,)).fetchone()
+
+    def decode(self, cursor, extra=0):
+        """Yield {column: array} chunks of a column_query cursor whose
+           rows start with extra leading columns, filling in degrees from
+           the NMEA strings on legacy databases"""
+        skip = extra + (2 if self.legacy else 0)
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            part = rows_to_columns([row[skip:] for row in rows])
+            if self.legacy:
+                part['lat_deg'] = parse_coordinates([row[extra]
+                                                     for row in rows])
+                part['lon_deg'] = parse_coordinates([row[extra+1]
+                                                     for row in rows])
+            if extra:
+                part['session_id'] = np.array([row[0] for row in rows],
+                                              dtype=np.int64)
+            yield part
+
+    def query(self, where, args=(), session_column=False):
+        """Run a column_query and yield decoded chunks"""
+        extra = ['p.session_id'] if session_column else []
+        if self.legacy:
+            extra += ['p.lat', 'p.lon']
+        cursor = self.db.execute(column_query(self.db, where, extra), args)
+        return self.decode(cursor, 1 if session_column else 0)
+
+    def read_live(self, session_id):
+        """Read a live session from the database"""
+        if not self.legacy:
+            return read_session(self.db, session_id, self.chunk_size)
+        return concatenate(list(self.query('WHERE p.session_id = ? '
+                                           'ORDER BY p._id', (session_id,))))
+
+    def load_session(self, session_id):
+        """Return a session's positions as read-only columns, from the
+           cache if it did not change since"""
+        archived = self.archive is not None and session_id in self.archive
+        version = self.data_version()
+        entry = self.cache.pop(session_id, None)
+        if entry is not None:
+            cached_version, fingerprint, columns = entry
+            if (archived or cached_version == version or
+                    fingerprint == self.fingerprint(session_id)):
+                self.hits += 1
+                self.cache[session_id] = (version, fingerprint, columns)
+                return columns
+        self.misses += 1
+        if archived:
+            fingerprint = None
+            columns = self.archive.load(session_id)
+        else:
+            # Taken before reading, so rows added meanwhile only cause a
+            # needless reload later.
+            fingerprint = self.fingerprint(session_id)
+            columns = self.read_live(session_id)
+        for values in columns.itervalues():
+            values.flags.writeable = False
+        self.cache[session_id] = (version, fingerprint, columns)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return columns
+
+    def clear_cache(self):
+        """Forget every cached session"""
+        self.cache.clear()
+
+    def iter_chunks(self, session_ids=None, chunk_size=None):
+        """
+        Yield the positions of the given sessions (default: all) as
+        columns with a session_id column, at most chunk_size rows at a
+        time, session by session in row order.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        if session_ids is None:
+            session_ids = self.session_ids()
+        for session_id in session_ids:
+            if self.archive is not None and session_id in self.archive:
+                columns = self.archive.load(session_id)
+                for start in xrange(0, len(columns['_id']), chunk_size):
+                    yield with_session_id(select(columns, slice(
+                        start, start + chunk_size)), session_id)
+                continue
+            last_id = -1
+            while True:
+                parts = list(self.query('WHERE p.session_id = ? AND '
+                                        'p._id > ? ORDER BY p._id LIMIT ?',
+                                        (session_id, last_id, chunk_size)))
+                if not parts:
+                    break
+                chunk = concatenate(parts)
+                last_id = int(chunk['_id'][-1])
+                yield with_session_id(chunk, session_id)
+
+    def load_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Return every position inside a decimal degree bounding box as
+        columns, plus a session_id column. Live positions are found
+        through the R*Tree index, archived sessions are skipped unless
+        their extent overlaps the box.
+        """
+        archived = self.archived()
+        parts = []
+        if self.legacy:
+            # No numeric coordinates to index: scan and filter.
+            for chunk in self.iter_chunks(sorted(set(self.session_ids()) -
+                                                 archived)):
+                parts.append(self._inside(chunk, min_lat, min_lon,
+                                          max_lat, max_lon))
+        else:
+            # The R*Tree stores rounded 32 bit bounds, so it only
+            # preselects and the exact test is done on the stored
+            # coordinates.
+            where = ('JOIN positions_rtree r ON r.id = p._id '
+                     'WHERE r.max_lat >= ?1 AND r.min_lat <= ?2 '
+                     'AND r.max_lon >= ?3 AND r.min_lon <= ?4 '
+                     'AND p.lat_deg BETWEEN ?1 AND ?2 '
+                     'AND p.lon_deg BETWEEN ?3 AND ?4')
+            if archived:
+                # Sessions archived with --keep are read from the archive.
+                where += ' AND p.session_id NOT IN (%s)' % ','.join(
+                    str(sid) for sid in sorted(archived))
+            parts.extend(self.query(where, (min_lat, max_lat,
+                                            min_lon, max_lon), True))
+
+        for session_id in sorted(archived):
+            meta = self.archive.meta(session_id)
+            if (meta['lat_deg'] is None or meta['lat_deg'][1] < min_lat or
+                    meta['lat_deg'][0] > max_lat or
+                    meta['lon_deg'][1] < min_lon or
+                    meta['lon_deg'][0] > max_lon):
+                continue
+            parts.append(self._inside(with_session_id(
+                self.archive.load(session_id), session_id),
+                min_lat, min_lon, max_lat, max_lon))
+
+        if not parts:
+            return with_session_id(rows_to_columns([]), 0)
+        return concatenate(parts)
+
+    @staticmethod
+    def _inside(columns, min_lat, min_lon, max_lat, max_lon):
+        """Rows of columns inside a bounding box"""
+        lat = columns['lat_deg']
+        lon = columns['lon_deg']
+        with np.errstate(invalid='ignore'):
+            return select(columns, np.flatnonzero(
+                (lat >= min_lat) & (lat <= max_lat) &
+                (lon >= min_lon) & (lon <= max_lon)))
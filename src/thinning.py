@@ -0,0 +1,61 @@
+"""
+Ingest-time spatial thinning. A position is dropped if one of the last N
+logged positions lies within a given distance of it and its depth
+differs by no more than a tolerance. Over a flat seabed this keeps about
+one sounding per distance; over a slope with gradient g, soundings closer
+than tolerance / g differ by more than the tolerance and are kept, so
+sampling tightens automatically where depth changes quickly.
+
+Recent positions are kept in a spatial hash of square cells one distance
+wide, so a lookup only visits the 3x3 cells around a position.
+"""
+import math
+import collections
+
+M_PER_DEG_LAT = 110540.0
+M_PER_DEG_LON = 111320.0
+
+
+def local_xy(lat, lon):
+    """Approximate metres for unprojected positions; only distances
+       between nearby points are meaningful"""
+    return (lon * math.cos(math.radians(lat)) * M_PER_DEG_LON,
+            lat * M_PER_DEG_LAT)
+
+
+class Thinner(object):
+    """Spatial hash of the last history accepted positions"""
+    def __init__(self, distance, history=64, depth_tolerance=0.1):
+        self.distance = float(distance)
+        self.distance2 = self.distance * self.distance
+        self.depth_tolerance = depth_tolerance
+        self.recent = collections.deque()
+        self.history = history
+        self.cells = {}
+        self.accepted = 0
+        self.dropped = 0
+
+    def accept(self, x, y, depth):
+        """Return False if (x, y, depth) duplicates a recent position,
+           otherwise remember it and return True"""
+        ix = int(math.floor(x / self.distance))
+        iy = int(math.floor(y / self.distance))
+        for cx in (ix - 1, ix, ix + 1):
+            for cy in (iy - 1, iy, iy + 1):
+                for px, py, pdepth in self.cells.get((cx, cy), ()):
+                    if ((px - x) ** 2 + (py - y) ** 2 <= self.distance2 and
+                            (depth is None or pdepth is None or
+                             abs(pdepth - depth) <= self.depth_tolerance)):
+                        self.dropped += 1
+                        return False
+        point = (x, y, depth)
+        self.cells.setdefault((ix, iy), []).append(point)
+        self.recent.append(((ix, iy), point))
+        if len(self.recent) > self.history:
+            cell, old = self.recent.popleft()
+            points = self.cells[cell]
+            points.remove(old)
+            if not points:
+                del self.cells[cell]
+        self.accepted += 1
+        return True
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+
+"""
+Local bathymetry tile server. Serves logged soundings at the usual web
+map z/x/y addresses, as 256x256 PNG rasters colored by depth
+
+    http://HOST:PORT/Z/X/Y.png
+
+and as GeoJSON point collections
+
+    http://HOST:PORT/Z/X/Y.geojson
+
+Tiles are rendered on demand from a bounding box query over the live
+database and the session archive (survey.py), skipping positions flagged
+by postprocess.py, and kept in a bounded in-memory LRU cache backed by a
+bounded on-disk LRU cache. A poller follows the positions SBScan logs
+and drops only the cached tiles the new points fall into, at every zoom
+level; its progress is stored with the disk cache, so points logged while
+the server was down are accounted for when it starts again.
+
+Run as: tiles.py DB_FILE [--archive DIR] [--host HOST] [--port PORT]
+                 [--cache-dir DIR] [options]
+"""
+
+import os
+import re
+import math
+import json
+import zlib
+import struct
+import sqlite3
+import argparse
+import logging
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import sys
+
+import numpy as np
+
+from survey import Survey
+
+TILE_SIZE = 256
+MIN_ZOOM = 8
+MAX_ZOOM = 22
+MEMORY_TILES = 512
+DISK_MB = 256
+POLL_INTERVAL = 2.0
+MAX_FEATURES = 5000
+RECENT_INVALIDATIONS = 100000
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(png|geojson)$')
+CONTENT_TYPES = {'png': 'image/png', 'geojson': 'application/geo+json'}
+
+# Depth color ramp: (fraction of the depth range, red, green, blue).
+COLOR_STOPS = [(0.0, 255, 255, 204), (0.25, 161, 218, 180),
+               (0.5, 65, 182, 196), (0.75, 44, 127, 184),
+               (1.0, 37, 52, 148)]
+
+
+def tile_bounds(z, x, y):
+    """(min_lat, min_lon, max_lat, max_lon) of a web mercator tile"""
+    count = 2.0 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi *
+                                                (1 - 2 * row / count))))
+    return lat(y + 1), x / count * 360 - 180, lat(y), \
+        (x + 1) / count * 360 - 180
+
+def world_pixels(lat, lon, z):
+    """Global pixel coordinates of degree arrays at zoom z"""
+    scale = TILE_SIZE * 2.0 ** z
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    px = (np.asarray(lon) + 180.0) / 360.0 * scale
+    py = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * scale
+    return px, py
+
+def png_chunk(tag, data):
+    """One length, tag, data and CRC framed PNG chunk"""
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+def encode_png(rgba):
+    """Encode an (h, w, 4) uint8 array as an RGBA PNG"""
+    height, width = rgba.shape[:2]
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8),
+                           rgba.reshape(height, width * 4)], axis=1)
+    return ('\x89PNG\r\n\x1a\n' +
+            png_chunk('IHDR', struct.pack('>IIBBBBB', width, height,
+                                          8, 6, 0, 0, 0)) +
+            png_chunk('IDAT', zlib.compress(rows.tostring(), 6)) +
+            png_chunk('IEND', ''))
+
+def color_ramp(fraction):
+    """RGB uint8 colors for depth fractions between 0 and 1"""
+    stops = np.array(COLOR_STOPS, dtype=np.float64)
+    return np.column_stack([np.interp(fraction, stops[:, 0],
+                                      stops[:, channel])
+                            for channel in (1, 2, 3)]).astype(np.uint8)
+
+
+class TileRenderer(object):
+    """Renders tiles from a per-thread Survey"""
+    def __init__(self, db_file, archive_dir, depth_min, depth_max,
+                 point_radius=1, max_features=MAX_FEATURES):
+        self.db_file = db_file
+        self.archive_dir = archive_dir
+        self.depth_min = depth_min
+        self.depth_max = depth_max
+        self.point_radius = point_radius
+        self.max_features = max_features
+        self.local = threading.local()
+
+    def survey(self):
+        """The calling thread's Survey; sqlite3 connections are per
+           thread"""
+        if not hasattr(self.local, 'survey'):
+            self.local.survey = Survey(self.db_file, self.archive_dir)
+        return self.local.survey
+
+    def points(self, z, x, y, margin=0):
+        """Clean soundings of a tile and margin pixels around it, with
+           their tile pixel coordinates"""
+        min_lat, min_lon, max_lat, max_lon = tile_bounds(z, x, y)
+        if margin:
+            pad = float(margin) / TILE_SIZE
+            dlat = (max_lat - min_lat) * pad
+            dlon = (max_lon - min_lon) * pad
+            min_lat, max_lat = min_lat - dlat, max_lat + dlat
+            min_lon, max_lon = min_lon - dlon, max_lon + dlon
+        columns = self.survey().load_bbox(min_lat, min_lon,
+                                          max_lat, max_lon)
+        with np.errstate(invalid='ignore'):
+            keep = np.flatnonzero((columns['flags'] <= 0) &
+                                  (columns['depth'] > 0))
+        columns = dict((name, values[keep])
+                       for name, values in columns.iteritems())
+        px, py = world_pixels(columns['lat_deg'], columns['lon_deg'], z)
+        return columns, px - x * TILE_SIZE, py - y * TILE_SIZE
+
+    def render_png(self, z, x, y):
+        """Mean depth per pixel, drawn as points point_radius wide"""
+        radius = self.point_radius
+        columns, px, py = self.points(z, x, y, radius)
+        ix = np.floor(px).astype(np.int64)
+        iy = np.floor(py).astype(np.int64)
+        depth = columns['depth'].astype(np.float64)
+        offsets = range(-radius, radius + 1)
+        ix = np.concatenate([ix + dx for dx in offsets for dy in offsets])
+        iy = np.concatenate([iy + dy for dx in offsets for dy in offsets])
+        depth = np.tile(depth, len(offsets) ** 2)
+        inside = ((ix >= 0) & (ix < TILE_SIZE) &
+                  (iy >= 0) & (iy < TILE_SIZE))
+        flat = iy[inside] * TILE_SIZE + ix[inside]
+        counts = np.bincount(flat, minlength=TILE_SIZE * TILE_SIZE)
+        sums = np.bincount(flat, depth[inside],
+                           minlength=TILE_SIZE * TILE_SIZE)
+        covered = counts > 0
+        rgba = np.zeros((TILE_SIZE * TILE_SIZE, 4), dtype=np.uint8)
+        fraction = ((sums[covered] / counts[covered] - self.depth_min) /
+                    (self.depth_max - self.depth_min))
+        rgba[covered, :3] = color_ramp(np.clip(fraction, 0, 1))
+        rgba[covered, 3] = 255
+        return encode_png(rgba.reshape(TILE_SIZE, TILE_SIZE, 4))
+
+    def render_geojson(self, z, x, y):
+        """Soundings of a tile as a GeoJSON FeatureCollection, evenly
+           sampled down to max_features"""
+        columns, dummy, dummy2 = self.points(z, x, y)
+        step = max(1, int(math.ceil(len(columns['_id']) /
+                                    float(self.max_features))))
+        features = [{'type': 'Feature',
+                     'geometry': {'type': 'Point',
+                                  'coordinates': [lon, lat]},
+                     'properties': {'depth': round(depth, 2),
+                                    'time': toa, 'session': sid}}
+                    for lon, lat, depth, toa, sid in zip(
+                        columns['lon_deg'][::step].tolist(),
+                        columns['lat_deg'][::step].tolist(),
+                        columns['depth'][::step].tolist(),
+                        columns['passing_time'][::step].tolist(),
+                        columns['session_id'][::step].tolist())]
+        return json.dumps({'type': 'FeatureCollection',
+                           'features': features}, separators=(',', ':'))
+
+
+class TileCache(object):
+    """Two level LRU cache of rendered tiles keyed by (z, x, y, ext):
+       a bounded number of tiles in memory over a size bounded directory.
+       Thread safe."""
+    def __init__(self, memory_tiles, directory=None, disk_bytes=0):
+        self.memory_tiles = memory_tiles
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.disk = collections.OrderedDict()
+        self.disk_used = 0
+        self.recent = collections.OrderedDict()
+        self.hits = self.misses = self.invalidated = 0
+        if directory:
+            self.scan()
+
+    def path(self, key):
+        """File name of a tile in the disk cache"""
+        z, x, y, ext = key
+        return os.path.join(self.directory, str(z), str(x),
+                            '%d.%s' % (y, ext))
+
+    def scan(self):
+        """Rebuild the disk LRU order from file modification times"""
+        found = []
+        for root, dummy, files in os.walk(self.directory):
+            for name in files:
+                parts = os.path.relpath(os.path.join(root, name),
+                                        self.directory).split(os.sep)
+                match = TILE_PATH.match('/' + '/'.join(parts))
+                if match is None:
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                key = tuple(int(part) for part in match.groups()[:3]) + \
+                    (match.group(4),)
+                found.append((stat.st_mtime, key, stat.st_size))
+        for dummy, key, size in sorted(found):
+            self.disk[key] = size
+            self.disk_used += size
+
+    def get(self, key):
+        """Cached tile data or None"""
+        with self.lock:
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory[key] = data
+                self.hits += 1
+                return data
+            if key in self.disk:
+                self.disk[key] = self.disk.pop(key)
+                try:
+                    with open(self.path(key), 'rb') as f:
+                        data = f.read()
+                    os.utime(self.path(key), None)
+                except (IOError, OSError):
+                    self.disk_used -= self.disk.pop(key)
+                else:
+                    self.remember(key, data)
+                    self.hits += 1
+                    return data
+            self.misses += 1
+            return None
+
+    def put(self, key, data, mark):
+        """Cache a tile rendered when the poller was at position id mark,
+           unless points newer than that invalidated it meanwhile"""
+        with self.lock:
+            if self.recent.get(key, -1) > mark:
+                return
+            self.remember(key, data)
+            if not self.directory or len(data) > self.disk_bytes:
+                return
+            fname = self.path(key)
+            try:
+                if not os.path.isdir(os.path.dirname(fname)):
+                    os.makedirs(os.path.dirname(fname))
+                with open(fname + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.rename(fname + '.tmp', fname)
+            except (IOError, OSError):
+                logging.error('Failed to write tile %s', fname)
+                return
+            self.disk_used += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+            while self.disk_used > self.disk_bytes:
+                old, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                self.remove_file(old)
+
+    def remember(self, key, data):
+        """Put a tile in the memory level; called with the lock held"""
+        self.memory.pop(key, None)
+        self.memory[key] = data
+        while len(self.memory) > self.memory_tiles:
+            self.memory.popitem(last=False)
+
+    def remove_file(self, key):
+        """Delete a tile file; called with the lock held"""
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def invalidate(self, tiles, mark):
+        """Drop every format of the given (z, x, y) tiles, remembering
+           that they changed with positions up to id mark"""
+        with self.lock:
+            for tile in tiles:
+                for ext in CONTENT_TYPES:
+                    key = tile + (ext,)
+                    self.recent.pop(key, None)
+                    self.recent[key] = mark
+                    if self.memory.pop(key, None) is not None:
+                        self.invalidated += 1
+                    if key in self.disk:
+                        self.disk_used -= self.disk.pop(key)
+                        self.remove_file(key)
+                        self.invalidated += 1
+            while len(self.recent) > RECENT_INVALIDATIONS:
+                self.recent.popitem(last=False)
+
+
+class Invalidator(object):
+    """Thread following newly logged positions and invalidating the
+       tiles they touch"""
+    def __init__(self, db_file, cache, min_zoom, max_zoom, margin,
+                 interval=POLL_INTERVAL, state_file=None):
+        self.db_file = db_file
+        self.cache = cache
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.margin = margin
+        self.interval = interval
+        self.state_file = state_file
+        self.stopped = threading.Event()
+        self.last_id = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Pick up where the previous run stopped and start polling"""
+        db = sqlite3.connect(self.db_file)
+        try:
+            if self.state_file and os.path.exists(self.state_file):
+                with open(self.state_file) as f:
+                    self.last_id = int(f.read())
+                self.poll(db)
+            else:
+                # An empty or unknown cache has nothing stale in it.
+                self.last_id = db.execute('SELECT coalesce(max(_id), 0) '
+                                          'FROM positions').fetchone()[0]
+                self.save()
+        finally:
+            db.close()
+        self.thread.start()
+
+    def stop(self):
+        """Stop polling"""
+        self.stopped.set()
+
+    def save(self):
+        """Store the last processed position id with the disk cache"""
+        if self.state_file:
+            with open(self.state_file + '.tmp', 'w') as f:
+                f.write(str(self.last_id))
+            os.rename(self.state_file + '.tmp', self.state_file)
+
+    def touched(self, lat, lon):
+        """Set of (z, x, y) tiles points are drawn on, margin included"""
+        tiles = set()
+        for z in xrange(self.min_zoom, self.max_zoom + 1):
+            px, py = world_pixels(lat, lon, z)
+            for dx in (-self.margin, self.margin):
+                for dy in (-self.margin, self.margin):
+                    tx = np.floor((px + dx) / TILE_SIZE).astype(np.int64)
+                    ty = np.floor((py + dy) / TILE_SIZE).astype(np.int64)
+                    tiles.update(zip([z] * len(tx), tx.tolist(),
+                                     ty.tolist()))
+        return tiles
+
+    def poll(self, db):
+        """Invalidate tiles touched by positions logged since last_id"""
+        while True:
+            rows = db.execute('SELECT _id, lat_deg, lon_deg FROM positions '
+                              'WHERE _id > ? AND lat_deg IS NOT NULL '
+                              'ORDER BY _id LIMIT 100000',
+                              (self.last_id,)).fetchall()
+            if not rows:
+                return
+            data = np.array(rows, dtype=np.float64)
+            self.last_id = int(data[-1, 0])
+            self.cache.invalidate(self.touched(data[:, 1], data[:, 2]),
+                                  self.last_id)
+            self.save()
+
+    def run(self):
+        """Poller thread body"""
+        db = sqlite3.connect(self.db_file)
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.poll(db)
+                except sqlite3.Error:
+                    logging.error('Polling new positions failed: %s',
+                                  sys.exc_info()[1])
+        finally:
+            db.close()
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves /Z/X/Y.png and /Z/X/Y.geojson"""
+    def do_GET(self):
+        match = TILE_PATH.match(self.path.split('?')[0])
+        if match is None:
+            self.send_error(404)
+            return
+        z, x, y = (int(part) for part in match.groups()[:3])
+        ext = match.group(4)
+        server = self.server
+        if (not server.min_zoom <= z <= server.max_zoom or
+                x >= 2 ** z or y >= 2 ** z):
+            self.send_error(404)
+            return
+        key = (z, x, y, ext)
+        data = server.cache.get(key)
+        if data is None:
+            mark = server.invalidator.last_id
+            try:
+                if ext == 'png':
+                    data = server.renderer.render_png(z, x, y)
+                else:
+                    data = server.renderer.render_geojson(z, x, y)
+            except sqlite3.Error:
+                logging.error('Rendering tile %s failed: %s', self.path,
+                              sys.exc_info()[1])
+                self.send_error(500)
+                return
+            server.cache.put(key, data, mark)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[ext])
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        logging.debug(fmt, *args)
+
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server holding the renderer, cache and invalidator"""
+    daemon_threads = True
+
+def main():
+    """Program entry point"""
+    apr = argparse.ArgumentParser()
+    apr.add_argument('db_file', help='SBScan database to serve')
+    apr.add_argument('--archive', help='Session archive directory')
+    apr.add_argument('--host', default='127.0.0.1',
+                     help='Address to listen on (default 127.0.0.1)')
+    apr.add_argument('--port', type=int, default=8080,
+                     help='Port to listen on (default 8080)')
+    apr.add_argument('--cache-dir', help='Disk tile cache directory')
+    apr.add_argument('--disk-mb', type=float, default=DISK_MB,
+                     help='Disk cache size in MB (default %d)' % DISK_MB)
+    apr.add_argument('--memory-tiles', type=int, default=MEMORY_TILES,
+                     help='Tiles cached in memory (default %d)' %
+                     MEMORY_TILES)
+    apr.add_argument('--min-zoom', type=int, default=MIN_ZOOM,
+                     help='Lowest zoom served (default %d)' % MIN_ZOOM)
+    apr.add_argument('--max-zoom', type=int, default=MAX_ZOOM,
+                     help='Highest zoom served (default %d)' % MAX_ZOOM)
+    apr.add_argument('--depth-range', type=float, nargs=2,
+                     default=(0.0, 50.0), metavar=('SHALLOW', 'DEEP'),
+                     help='Depths at the ends of the color ramp (0 50)')
+    apr.add_argument('--point-radius', type=int, default=1,
+                     help='Drawn point radius in pixels (default 1)')
+    apr.add_argument('--max-features', type=int, default=MAX_FEATURES,
+                     help='GeoJSON points per tile (default %d)' %
+                     MAX_FEATURES)
+    apr.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                     help='Seconds between checks for new positions')
+    app = apr.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] -\t%(message)s',
+                        level=logging.INFO)
+    if app.cache_dir and not os.path.isdir(app.cache_dir):
+        os.makedirs(app.cache_dir)
+    cache = TileCache(app.memory_tiles, app.cache_dir,
+                      int(app.disk_mb * (1 << 20)))
+    renderer = TileRenderer(app.db_file, app.archive, app.depth_range[0],
+                            app.depth_range[1], app.point_radius,
+                            app.max_features)
+    state_file = (os.path.join(app.cache_dir, 'last_position')
+                  if app.cache_dir else None)
+    invalidator = Invalidator(app.db_file, cache, app.min_zoom,
+                              app.max_zoom, app.point_radius,
+                              app.poll_interval, state_file)
+    try:
+        invalidator.start()
+        server = TileServer((app.host, app.port), TileHandler)
+    except (sqlite3.Error, IOError, ValueError):
+        logging.critical('Failed to start: %s', sys.exc_info()[1])
+        sys.exit(1)
+    server.min_zoom = app.min_zoom
+    server.max_zoom = app.max_zoom
+    server.cache = cache
+    server.renderer = renderer
+    server.invalidator = invalidator
+    logging.info('Serving tiles on http://%s:%d/', app.host, app.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    invalidator.stop()
+    server.server_close()
+
+if __name__ == '__main__':
+    main()